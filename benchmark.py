@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+# Offline benchmarks of detect_EMBL.py on the previous searches
+########################
+import argparse
+import gzip
+import json
+import os
+import platform
+import random
+import subprocess
+import sys
+import time
+
+import numpy
+
+import corpus
+import detect_EMBL
+import models
+import stub_europepmc
+from europepmc import EuropePMC
+
+#############################                   VARIABLES                   #############################
+
+output_dir="./benchmarks/" # Results of the benchmarks, one JSON file per run
+metrics=["items_per_second","p50_ms","p99_ms","peak_MB","import_seconds","first_verdict_seconds","first_geoloc_seconds","process_seconds"] # Metrics compared by --compare
+startup_affiliation="Department of Chemistry, University of Cambridge, Cambridge, United Kingdom" # Affiliation of the first results of the startup benchmark
+startup_script=""" # Run by startup() in a new process
+import json,sys,time
+start=time.time()
+import detect_EMBL
+imported=time.time()
+detect_EMBL.spacy_model=sys.argv[1]
+detect_EMBL.load_models()
+detect_EMBL.is_EMBL_batch([sys.argv[2]],site=True,proba=True)
+verdict=time.time()
+spacy="spacy" in sys.modules
+detect_EMBL.get_geoloc_batch([sys.argv[2]])
+print(json.dumps({"import_seconds":imported-start,"first_verdict_seconds":verdict-start,"first_geoloc_seconds":time.time()-start,"spacy":spacy}))
+"""
+
+#############################                   DEFINITIONS                   #############################
+
+def load_fixture(path=None,directory="./searches/"): #### Records and affiliations of the benchmarks
+    """This function will return the fixture corpus of the benchmarks
+    Description :
+            The fixture is made of the EuropePMC results rebuilt from the AllAffs tables of the searches and of the affiliations of the searches (see corpus.py).
+            If path is given, the fixture is read from this gzipped JSON file, or written there the first time, so the same fixture can be used between commits
+            even if the searches change.
+    Args :
+            path (str) :
+                    A gzipped JSON file of the fixture (None to build it from the searches)
+            directory (str) :
+                    The searches directory
+    Return :
+            fixture (dict) :
+                    {"records":[...], "affiliations":[...]}
+    """
+    if path is not None and os.path.exists(path):
+        with gzip.open(path,"rt",encoding="utf-8") as f:
+            return json.load(f)
+    fixture={
+        "records":corpus.searches_records(directory),
+        "affiliations":corpus.searches_affiliations(directory)}
+    if path is not None:
+        with gzip.open(path,"wt",encoding="utf-8") as f:
+            json.dump(fixture,f)
+    return fixture
+
+def reset_peak(): #### Reset the peak resident memory of the process (Linux only)
+    try:
+        with open("/proc/self/clear_refs","w") as f:
+            f.write("5")
+    except (IOError,OSError):
+        pass
+
+def measure(name,function,batches,size): #### Time a function on each batch
+    """This function will call function on each batch and return its statistics
+    Args :
+            name (str) :
+                    The name of the benchmark
+            function (function) :
+                    A function taking one batch
+            batches (list) :
+                    The batches (the first one is also used once to warm up)
+            size (function) :
+                    A function returning the number of items (affiliations, PMIDs) of a batch
+    Return :
+            stats (dict) :
+                    The number of calls and items, the total time, the throughput (items per second), the p50/p99 latencies of a call
+                    and the peak resident memory during the benchmark
+    """
+    function(batches[0])
+    reset_peak()
+    latencies=[]
+    items=0
+    start=time.perf_counter()
+    for batch in batches:
+        call=time.perf_counter()
+        function(batch)
+        latencies.append(time.perf_counter()-call)
+        items+=size(batch)
+    total=time.perf_counter()-start
+    stats={
+        "calls":len(batches),
+        "items":items,
+        "seconds":total,
+        "items_per_second":items/total if total else None,
+        "p50_ms":float(numpy.percentile(latencies,50))*1000,
+        "p99_ms":float(numpy.percentile(latencies,99))*1000,
+        "peak_MB":models.memory_usage()["peak"]}
+    print(name+": "+str(stats["items"])+" items in "+str(round(total,2))+" s, "+str(round(stats["items_per_second"],1))+" items/s, p50 "
+        +str(round(stats["p50_ms"],3))+" ms, p99 "+str(round(stats["p99_ms"],3))+" ms, peak "+str(round(stats["peak_MB"]))+" MB")
+    return stats
+
+def check_prefilter(affiliations): #### False negatives and skip ratio of the pre-filter of is_EMBL
+    """This function will predict every affiliation with and without the pre-filter (see prefilter.Prefilter) and compare the results
+    Args :
+            affiliations (list-str) :
+                    The affiliations
+    Return :
+            stats (dict) :
+                    The number of affiliations, the number and ratio of affiliations skipped by the pre-filter, the number of false negatives (EMBL without
+                    the pre-filter and not with it) and the number of other differences (choose, method, site or substring of an affiliation kept by the pre-filter)
+    """
+    prefilter=detect_EMBL.EMBL_prefilter
+    try:
+        detect_EMBL.EMBL_prefilter=None
+        expected=detect_EMBL.predict_EMBL_batch(affiliations,site=True,proba=True)
+    finally:
+        detect_EMBL.EMBL_prefilter=prefilter
+    results=detect_EMBL.predict_EMBL_batch(affiliations,site=True,proba=True)
+    prepared=detect_EMBL.normalizer.batch(affiliations)
+    rejected=[prefilter is not None and not prefilter.keep(request) for request in prepared]
+    skipped=sum(rejected)
+    keys=("choose","method","site","substring")
+    stats={
+        "affiliations":len(affiliations),
+        "skipped":skipped,
+        "skip_ratio":skipped/len(affiliations) if affiliations else None,
+        "false_negatives":sum(1 for before,after in zip(expected,results) if before["choose"] and not after["choose"]),
+        "differences":sum(1 for before,after,out in zip(expected,results,rejected) if not out and any(before.get(key)!=after.get(key) for key in keys))}
+    print("pre-filter: "+str(skipped)+" of "+str(len(affiliations))+" affiliations skipped ("+str(round(100.0*(stats["skip_ratio"] or 0),1))+" %), "
+        +str(stats["false_negatives"])+" false negatives, "+str(stats["differences"])+" differences")
+    return stats
+
+def check_resolver(affiliations): #### Parity of the resolver of detect_EMBL.classify() with the models
+    """This function will resolve every affiliation by name (see resolver.Resolver) and compare the site with the prediction of the models
+    Description :
+            The affiliations of the fixture have no ROR ID, only the canonical names are checked.
+    Args :
+            affiliations (list-str) :
+                    The affiliations
+    Return :
+            stats (dict) :
+                    The number of affiliations, the number and ratio resolved by name, and the number of disagreements (resolved affiliations which the models
+                    do not predict as EMBL of the same site)
+    """
+    resolved=[detect_EMBL.resolver.resolve(affiliation)[0] for affiliation in affiliations]
+    expected=detect_EMBL.predict_EMBL_batch([affiliation for affiliation,site in zip(affiliations,resolved) if site is not None],site=True,proba=True)
+    sites=[site for site in resolved if site is not None]
+    stats={
+        "affiliations":len(affiliations),
+        "resolved":len(sites),
+        "resolved_ratio":len(sites)/len(affiliations) if affiliations else None,
+        "disagreements":sum(1 for site,result in zip(sites,expected) if not result["choose"] or result["site"]!=site)}
+    print("resolver: "+str(stats["resolved"])+" of "+str(len(affiliations))+" affiliations resolved by name ("+str(round(100.0*(stats["resolved_ratio"] or 0),1))+" %), "
+        +str(stats["disagreements"])+" disagreements with the models")
+    return stats
+
+def startup(spacy_model,repeats=5,directory=None): #### Start of new processes of detect_EMBL.py
+    """This function will time the start of repeats new processes, each importing detect_EMBL then giving its first results
+    Description :
+            Each process imports detect_EMBL, loads the models and predicts startup_affiliation with is_EMBL_batch() (the first verdict), then extracts its countries
+            with get_geoloc_batch() (the first geolocation, which loads spaCy and the gazetteer). A first process is run and not counted, it writes the artifacts
+            built on first use (gazetteer, engine, memory mapped copies), so every counted process starts as a new run of detect_EMBL.py. The times are from
+            the start of the import, process_seconds is the whole life of the process (with the start of the interpreter), the median of the runs is kept.
+    Args :
+            spacy_model (str) :
+                    The spaCy model (name or path)
+            repeats (int) :
+                    The number of processes
+            directory (str) :
+                    The directory of the detect_EMBL.py to time (e.g. a git worktree of a previous commit), None for the one next to this file
+    Return :
+            stats (dict) :
+                    The median of import_seconds, first_verdict_seconds, first_geoloc_seconds and process_seconds, and spaCy_at_first_verdict (True if spaCy
+                    was already imported at the first verdict)
+    """
+    directory=os.path.abspath(directory or os.path.dirname(os.path.abspath(detect_EMBL.__file__)))
+    spacy_model=os.path.abspath(spacy_model) if os.path.exists(spacy_model) else spacy_model
+    runs=[]
+    for i in range(repeats+1):
+        start=time.perf_counter()
+        output=subprocess.check_output([sys.executable,"-c",startup_script,spacy_model,startup_affiliation],cwd=directory,env=dict(os.environ,PYTHONPATH=directory),stderr=subprocess.DEVNULL)
+        times=json.loads(output.decode("utf-8").strip().splitlines()[-1])
+        times["process_seconds"]=time.perf_counter()-start
+        if i>0:
+            runs.append(times)
+    stats={name:float(numpy.median([times[name] for times in runs])) for name in ("import_seconds","first_verdict_seconds","first_geoloc_seconds","process_seconds")}
+    stats["spaCy_at_first_verdict"]=any(times["spacy"] for times in runs)
+    print("startup: import "+str(round(stats["import_seconds"],2))+" s, first verdict "+str(round(stats["first_verdict_seconds"],2))+" s, first geolocation "
+        +str(round(stats["first_geoloc_seconds"],2))+" s, process "+str(round(stats["process_seconds"],2))+" s (median of "+str(repeats)+")")
+    return stats
+
+def run(fixture,sample=2000,batch_size=100,chunk_size=100,seed=0): #### Run every benchmark
+    """This function will run the benchmarks of detect_EMBL.py on the fixture, without the verdict cache and the response store
+    Description :
+            - is_EMBL : one affiliation per call (items are affiliations)
+            - is_EMBL_batch : batch_size affiliations per call
+            - get_geoloc_from : one affiliation per call
+            - get_geoloc_batch : batch_size affiliations per call
+            - process : one chunk of chunk_size PMIDs per call, the results being served by a local stub_europepmc.StubServer (items are PMIDs)
+            - categorization : process_chunk() (process() and the categorization of the EMBL PMIDs) on the same chunks
+            - prefilter : the false negatives and the skip ratio of the pre-filter on every affiliation of the fixture (see check_prefilter())
+            - resolver : the affiliations of the fixture resolved without the models and their parity with the models (see check_resolver())
+            The start of new processes is timed before, by startup().
+    Args :
+            fixture (dict) :
+                    See load_fixture()
+            sample (int) :
+                    Number of affiliations (taken at random with seed) of the affiliations benchmarks
+            batch_size (int) :
+                    Number of affiliations per call of the batch benchmarks
+            chunk_size (int) :
+                    Number of PMIDs per chunk
+            seed (int) :
+                    Seed of the sample
+    Return :
+            results (dict) :
+                    The statistics of each benchmark (see measure())
+    """
+    detect_EMBL.verdict_cache=None
+    detect_EMBL.response_store=None
+    detect_EMBL.offline=False
+    affiliations=random.Random(seed).sample(fixture["affiliations"],min(sample,len(fixture["affiliations"])))
+    batches=[affiliations[i:i+batch_size] for i in range(0,len(affiliations),batch_size)]
+    records={str(record["pmid"]):record for record in fixture["records"]}
+    pmids=list(records)
+    chunks=[pmids[i:i+chunk_size] for i in range(0,len(pmids),chunk_size)]
+    start=time.time()
+    detect_EMBL.load_models()
+    detect_EMBL.load_geoloc()
+    print("Models loaded in "+str(round(time.time()-start,2))+" s")
+    stub=stub_europepmc.StubServer(records)
+    detect_EMBL.europepmc=EuropePMC(stub.start(),requests_per_second=None)
+    results={}
+    try:
+        results["is_EMBL"]=measure("is_EMBL",lambda aff: detect_EMBL.is_EMBL(aff,site=True,proba=True),affiliations,lambda aff: 1)
+        results["is_EMBL_batch"]=measure("is_EMBL_batch",lambda batch: detect_EMBL.is_EMBL_batch(batch,site=True,proba=True),batches,len)
+        results["get_geoloc_from"]=measure("get_geoloc_from",detect_EMBL.get_geoloc_from,affiliations,lambda aff: 1)
+        results["get_geoloc_batch"]=measure("get_geoloc_batch",detect_EMBL.get_geoloc_batch,batches,len)
+        results["process"]=measure("process",detect_EMBL.process,chunks,len)
+        results["categorization"]=measure("categorization",detect_EMBL.process_chunk,chunks,len)
+        results["prefilter"]=check_prefilter(fixture["affiliations"])
+        results["resolver"]=check_resolver(fixture["affiliations"])
+    finally:
+        stub.stop()
+    return results
+
+def environment(): #### Commit and versions of the run
+    try:
+        commit=subprocess.check_output(["git","rev-parse","--short","HEAD"],stderr=subprocess.DEVNULL).decode("utf-8").strip()
+    except (OSError,subprocess.CalledProcessError):
+        commit=None
+    versions={}
+    for name in ("numpy","sklearn","spacy","joblib"):
+        try:
+            versions[name]=__import__(name).__version__
+        except ImportError:
+            versions[name]=None
+    return {
+        "commit":commit,
+        "date":time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "python":platform.python_version(),
+        "machine":platform.machine(),
+        "cpus":os.cpu_count(),
+        "versions":versions}
+
+def compare(old,new): #### Print the ratio new/old of the metrics of two runs
+    print("Comparison with "+str(old["environment"]["commit"])+" ("+old["environment"]["date"]+")")
+    for name in new["results"]:
+        if name not in old["results"]:
+            continue
+        ratios=[]
+        for metric in metrics:
+            before=old["results"][name].get(metric)
+            after=new["results"][name].get(metric)
+            if before and after is not None:
+                ratios.append(metric+" "+str(round(before,3))+" -> "+str(round(after,3))+" (x"+str(round(after/before,2))+")")
+        if ratios:
+            print("    "+name+": "+", ".join(ratios))
+
+#############################                   MAIN                   #############################
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser(description="Offline benchmarks of detect_EMBL.py on the previous searches")
+    parser.add_argument("--fixture",help="gzipped JSON file of the fixture, written from the searches if it does not exist (default: built from the searches at each run)")
+    parser.add_argument("--searches",default="./searches/",help="directory of the searches (default: %(default)s)")
+    parser.add_argument("--sample",type=int,default=2000,help="number of affiliations of the affiliations benchmarks (default: %(default)s)")
+    parser.add_argument("--batch-size",type=int,default=100,help="number of affiliations per call of the batch benchmarks (default: %(default)s)")
+    parser.add_argument("--chunk-size",type=int,default=100,help="number of PMIDs per chunk (default: %(default)s)")
+    parser.add_argument("--spacy-model",default=detect_EMBL.spacy_model,help="spacy model (name or path) of get_geoloc_from (default: %(default)s)")
+    parser.add_argument("-o","--output",help="JSON file of the results (default: "+output_dir+"<commit>_<date>.json)")
+    parser.add_argument("--compare",help="JSON file of a previous run to compare with")
+    parser.add_argument("--startup-repeats",type=int,default=5,help="number of new processes timed by the startup benchmark, 0 to skip it (default: %(default)s)")
+    parser.add_argument("--startup-tree",help="directory of another detect_EMBL.py timed by the startup benchmark, e.g. a git worktree of a previous commit (default: this one)")
+    args=parser.parse_args()
+    detect_EMBL.spacy_model=args.spacy_model
+    fixture=load_fixture(args.fixture,args.searches)
+    print("Fixture: "+str(len(fixture["records"]))+" records, "+str(len(fixture["affiliations"]))+" affiliations")
+    report={
+        "environment":environment(),
+        "parameters":{"sample":args.sample,"batch_size":args.batch_size,"chunk_size":args.chunk_size,"spacy_model":args.spacy_model,"fixture":args.fixture or args.searches,"startup_tree":args.startup_tree},
+        "results":{}}
+    if args.startup_repeats>0:
+        report["results"]["startup"]=startup(args.spacy_model,args.startup_repeats,args.startup_tree)
+    report["results"].update(run(fixture,args.sample,args.batch_size,args.chunk_size))
+    output=args.output or os.path.join(output_dir,str(report["environment"]["commit"])+"_"+time.strftime("%Y%m%d_%H%M%S")+".json")
+    if os.path.dirname(output):
+        os.makedirs(os.path.dirname(output),exist_ok=True)
+    with open(output,"w",encoding="utf-8") as f:
+        json.dump(report,f,indent=4)
+    print("Results written in "+output)
+    if args.compare:
+        with open(args.compare,"r",encoding="utf-8") as f:
+            compare(json.load(f),report)
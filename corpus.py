@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+# Affiliations of the previous searches
+########################
+import collections
+import csv
+import glob
+import os
+import re
+
+#############################                   DEFINITIONS                   #############################
+
+def searches_affiliations(directory="./searches/",unique=True): #### Extract every affiliation string of the previous searches
+    """This function will extract the affiliation strings found in the results of the previous searches
+    Description :
+            Here the function reads the affiliations of the AllAffs*.csv tables (AFF column), of the result.csv files (one PMID and its EMBL affiliations
+            separated by " /// " per line) and of the PMID_*_EMBL.csv tables (Affs column) of every search in the directory.
+    Args :
+            directory (str) :
+                    The searches directory
+            unique (boolean) :
+                    If True each affiliation is returned once, in the order of its first mention
+    Return :
+            affiliations (list-str) :
+                    A list of affiliation strings
+    """
+    csv.field_size_limit(1<<30)
+    affiliations=[]
+    for file in sorted(glob.glob(os.path.join(directory,"*","AllAffs*.csv"))):
+        with open(file,"r",encoding="utf-8") as f:
+            for row in csv.DictReader(f,delimiter="\t"):
+                if row.get("AFF"):
+                    affiliations.append(row["AFF"])
+    for file in sorted(glob.glob(os.path.join(directory,"*","PMID_*_EMBL.csv"))):
+        with open(file,"r",encoding="utf-8") as f:
+            for row in csv.DictReader(f,delimiter="\t"):
+                if row.get("Affs"):
+                    affiliations+=row["Affs"].split(" /// ")
+    for file in sorted(glob.glob(os.path.join(directory,"*","result.csv"))):
+        with open(file,"r",encoding="utf-8") as f:
+            for line in f:
+                fields=line.rstrip("\n").split("\t")
+                for field in fields[1:]:
+                    affiliations+=[aff for aff in field.split(" /// ") if re.search(r'[a-zA-Z]',aff)]
+    if unique:
+        affiliations=list(collections.OrderedDict.fromkeys(affiliations))
+    return affiliations
+
+def searches_records(directory="./searches/"): #### Rebuild EuropePMC results from the AllAffs tables of the previous searches
+    """This function will rebuild EuropePMC results (core format) from the author/affiliation tables of the previous searches
+    Description :
+            Each AllAffs*.csv table has one line per author and affiliation of a PMID. Here the function groups the lines by PMID and author (in the order of the table)
+            and returns one result per PMID with an author list : an author with one affiliation has the old "affiliation" field and an author with more affiliations
+            has the new "authorAffiliationDetailsList" field. A PMID met in different tables is returned once.
+    Args :
+            directory (str) :
+                    The searches directory
+    Return :
+            records (list-dict) :
+                    A list of results as in the resultList of a EuropePMC response
+    """
+    csv.field_size_limit(1<<30)
+    records=collections.OrderedDict()
+    for file in sorted(glob.glob(os.path.join(directory,"*","AllAffs*.csv"))):
+        authors=collections.OrderedDict()
+        with open(file,"r",encoding="utf-8") as f:
+            for row in csv.DictReader(f,delimiter="\t"):
+                if not row.get("PMID") or row["PMID"] in records:
+                    continue
+                author=authors.setdefault(row["PMID"],collections.OrderedDict()).setdefault(row["fullName"],{
+                    "fullName":row["fullName"],
+                    "firstName":row["firstName"],
+                    "lastName":row["lastName"],
+                    "initials":row["initials"],
+                    "affiliations":[]})
+                if row.get("AFF"):
+                    author["affiliations"].append(row["AFF"])
+        for pmid in authors:
+            author_list=[]
+            for author in authors[pmid].values():
+                affiliations=author.pop("affiliations")
+                if len(affiliations)==1:
+                    author["affiliation"]=affiliations[0]
+                elif affiliations:
+                    author["authorAffiliationDetailsList"]={"authorAffiliation":[{"affiliation":aff} for aff in affiliations]}
+                author_list.append(author)
+            records[pmid]={
+                "id":pmid,
+                "source":"MED",
+                "pmid":pmid,
+                "authorList":{"author":author_list}}
+    return list(records.values())
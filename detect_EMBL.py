@@ -3,30 +3,111 @@
 # THOUVENIN Arthur athouvenin@outlook.fr
 # 26/02/2020
 ########################
+import argparse # Used to read the command line arguments (https://docs.python.org/3/library/argparse.html)
+import collections
+import importlib.util
 import geonamescache # Allows to use data from Geonames database (http://www.geonames.org/)
-import joblib # Used to save and load machine learning models in files (https://joblib.readthedocs.io/en/latest/)
+import instrumentation # Per-stage timers and counters of a run (--instrument)
 import json # Used to load json from url response (https://docs.python.org/3/library/json.html)
+import models # Registry of the models and tables loaded by each process
+import multiprocessing
 import numpy # 
 import os
-import pycountry# Allows to load a dictionnary of iso-2 iso3 country codes
+import queue
 import re
-import requests
-import spacy # Allows to use pre-trained models for NER (Name Entity Recognition)
+import results # Columnar store of the results of the searches
+import sys
+import threading
 import time
 import tqdm
-from multiprocessing import Pool,Manager,cpu_count
+import verdict_cache as vc # Persistent cache of the verdicts shared by every process
+from europepmc import AdaptiveBatcher,EuropePMC,RateLimiter # Pooled, rate limited and retried access to the EuropePMC REST API
+from response_store import ResponseStore # Local store of the EuropePMC results
+from journal import Journal,chunk_id # Journal of the processed chunks
+from normalizer import Normalizer # Compiled version of the replacements
+from gazetteer import Gazetteer # Indexed names of countries and cities
+from prefilter import Prefilter # Lexical screen of the affiliations that cannot be EMBL
+from engine import LinearEngine # Fused inference of the EMBL and EMBL-sites models
+from resolver import Resolver,ror_id # Site of the affiliations with the ROR ID or a canonical name of an EMBL site
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import cpu_count
 
 #############################                   VARIABLES                   #############################
 
 search_name="test"
 search_file="test_pmid_EPMC.txt"
 directory="./searches/"+search_name+"/"
+cache_file="./searches/EMBL_cache.sqlite" # Verdict cache shared by every search (None to disable it)
+cache_size=1000000 # Maximum number of verdicts kept in the cache
+europepmc_url="https://www.ebi.ac.uk/europepmc/webservices/rest/" # EuropePMC REST API (or the URL of a stub_europepmc.StubServer)
+concurrency=4 # Maximum number of requests sent at the same time by each process
+requests_per_second=10 # Maximum number of requests per second sent by all processes
+store_file="./searches/EPMC_responses.sqlite" # Local store of the EuropePMC results shared by every search (None to disable it)
+store_ttl=30*24*3600 # Seconds a stored result is used before being fetched again
+offline=False # If True only the stored results are used, nothing is fetched (--offline)
+missing_file="EMBL_missing.csv" # PMIDs of the search without a result (not found on EuropePMC, failed queries, or not stored in offline mode), in the directory of the search
+journal_file="EMBL_journal.jsonl" # Results of each processed chunk in the directory of the search, a new run resumes from it (--restart to start again)
+incremental=False # If True the PMIDs already classified by a search of searches_dir with the current models are not processed again, their results are reused (--incremental)
+searches_dir="./searches/" # Directory of the searches whose results are reused by --incremental
+workers=cpu_count()+2 # Number of processes scoring the chunks (--workers)
+fetchers=4 # Number of threads of the main process fetching the chunks from the response store and EuropePMC (--fetchers)
+queue_size=8 # Maximum number of fetched chunks waiting for a worker (--queue-size)
+batch_size=1000 # Number of PMIDs per chunk, the unit of work of the workers and of the journal (--batch-size), the queries to EuropePMC are sized by batcher
+start_method=None # Start method of the workers, fork, spawn or forkserver (--start-method), None for the default of the platform
+mmap_dir="./models/mmap/" # Uncompressed copies of the models memory mapped by every process (None to load the models in the memory of each process)
+spacy_model="en_core_web_sm" # Model from spacy for NER (Name Entity Recognition)
+nlp_disable=["tagger","parser"] # Components of the spacy model not loaded, only the entities are used
+nlp_batch_size=256 # Number of affiliations per batch of nlp.pipe()
+nlp_processes=1 # Processes of nlp.pipe(), 1 in the Pool workers (they cannot start processes)
+preload_geoloc=False # If True the spaCy model and the gazetteer are loaded at start (by MAIN before the fork, or by each worker), else on first use by get_geoloc_batch() or extract_geoloc_from() (--preload-geoloc)
+gazetteer_file="./models/gazetteer.bin" # Tables of the names of countries and cities, built on first use (None to build them at each start)
+engine_file="./models/linear_engine.npz" # Arrays of the models used by LinearEngine, exported on first use and again when the models change (None to export them at each start)
+window_cache_size=100000 # Maximum number of sequences of words kept in window_scores
+prefilter_threshold=0.6 # The affiliations whose EMBL probability cannot reach it are not predicted (None to predict every affiliation)
+instrument=False # If True the time of each stage and the counters of the run are recorded by every process (--instrument)
+instrumentation_file="EMBL_instrumentation.json" # Summary of the instrumentation and every HTTP request, in the directory of the search
 
 ####    MODELS    ####
-EMBL_ID_Vecto=joblib.load("./models/EMBL_ID_Vecto.joblib") # TfidfVectorizer train to EMBL detection
-EMBL_ID_clf=joblib.load("./models/EMBL_ID_clfLR.joblib") # Logistic Regression train to EMBL detection
-EMBL_Sites_ID_Vecto=joblib.load("./models/EMBL_Sites_ID_Vecto.joblib") # TidfVectorizer train to EMBL-sites detection
-EMBL_Sites_ID_clfLR=joblib.load("./models/EMBL_Sites_ID_clfLR.joblib") # Logistic Regression train to EMBL-sites detection
+model_files=[ #List of models files, their content is the version of the is_EMBL verdicts in the cache
+    "./models/EMBL_ID_Vecto.joblib",
+    "./models/EMBL_ID_clfLR.joblib",
+    "./models/EMBL_Sites_ID_Vecto.joblib",
+    "./models/EMBL_Sites_ID_clfLR.joblib"]
+registry=models.Registry({ ### Models and tables, loaded once per process by load_models() and load_geoloc()
+    "EMBL_ID_Vecto":lambda: models.load_model(model_files[0],mmap_dir), # TfidfVectorizer train to EMBL detection
+    "EMBL_ID_clf":lambda: models.load_model(model_files[1],mmap_dir), # Logistic Regression train to EMBL detection
+    "EMBL_Sites_ID_Vecto":lambda: models.load_model(model_files[2],mmap_dir), # TidfVectorizer train to EMBL-sites detection
+    "EMBL_Sites_ID_clfLR":lambda: models.load_model(model_files[3],mmap_dir), # Logistic Regression train to EMBL-sites detection
+    "EMBL_engine":lambda: LinearEngine.load(engine_file,vc.hash_files(model_files),build_engine), # Probabilities of both models without sklearn
+    "EMBL_prefilter":lambda: Prefilter(registry.get("EMBL_ID_Vecto"),registry.get("EMBL_ID_clf"),prefilter_threshold) if prefilter_threshold is not None else None,
+    "nlp":lambda: load_nlp(),
+    "gazetteer":lambda: Gazetteer.load(gazetteer_file,gazetteer_version(),build_gazetteer)})
+EMBL_ID_Vecto=None # Set by load_models()
+EMBL_ID_clf=None
+EMBL_Sites_ID_Vecto=None
+EMBL_Sites_ID_clfLR=None
+EMBL_engine=None
+EMBL_prefilter=None
+nlp=None # Set by load_geoloc()
+gazetteer=None
+window_scores=collections.OrderedDict() # EMBL probability of the sequences of words already scored by score_windows()
+worker_globals=[ #List of the globals set in MAIN and sent to the Pool workers (see init_worker())
+    "offline",
+    "europepmc",
+    "verdict_cache",
+    "response_store",
+    "mmap_dir",
+    "spacy_model",
+    "nlp_disable",
+    "preload_geoloc",
+    "gazetteer_file",
+    "engine_file",
+    "prefilter_threshold",
+    "instrument"]
+verdict_cache=None # VerdictCache opened in MAIN
+europepmc=EuropePMC(europepmc_url,concurrency=concurrency,requests_per_second=requests_per_second) # Shared with the Pool workers
+batcher=AdaptiveBatcher() # Number of PMIDs per query to EuropePMC, tuned by each process from the responses
+response_store=None # ResponseStore opened in MAIN
 EMBL_sites={ ### Dictionary of classes (1 site/1 int)
     0:"EMBL Australia",
     1:"EMBL Barcelona",
@@ -51,15 +132,46 @@ replacements=[ #List of tuples for string preparation (regex pattern, replacemen
     (r'^\s+',''),
     (r'Electronic address\s*:',''),
     (r'Current address\s*:','')]
-EMBL_RORs=[ #List of ROR IDs for the different EMBL sites
-    "https://ror.org/00yx5cw48", # Australia 1st
-    "https://ror.org/050589e39", # Hamburg
-    "https://ror.org/03mstc592", # Heidelberg
-    "https://ror.org/010jaxs89", # Barcelona
-    "https://ror.org/01zjc6908", # Grenoble
-    "https://ror.org/01yr73893", # Rome
-    "https://ror.org/052c7a780", # Australia 2nd
-    "https://ror.org/02catss52"] # EBI
+normalizer=Normalizer(replacements) # Same output as one re.sub per replacement, in order
+EMBL_RORs={ ### Dictionary of ROR IDs for the different EMBL sites (ROR ID/site)
+    "https://ror.org/00yx5cw48":"EMBL Australia", # Australia 1st
+    "https://ror.org/050589e39":"EMBL Hamburg",
+    "https://ror.org/03mstc592":"EMBL Heidelberg",
+    "https://ror.org/010jaxs89":"EMBL Barcelona",
+    "https://ror.org/01zjc6908":"EMBL Grenoble",
+    "https://ror.org/01yr73893":"EMBL Rome",
+    "https://ror.org/052c7a780":"EMBL Australia", # Australia 2nd
+    "https://ror.org/02catss52":"EMBL-EBI"}
+EMBL_common_names=["European Molecular Biology Laboratory","European Molecular Biology Laboratory (EMBL)","EMBL"] # Names of every site, only canonical when followed by a place of EMBL_places
+EMBL_names={ ### Dictionary of the names of each EMBL site, an affiliation which is one of them, alone or followed by a place of the site, is resolved without the models (see resolver.Resolver)
+    "EMBL Australia":["EMBL Australia"],
+    "EMBL Barcelona":["EMBL Barcelona"]+EMBL_common_names,
+    "EMBL-EBI":[
+        "EMBL-EBI",
+        "European Bioinformatics Institute",
+        "European Bioinformatics Institute (EMBL-EBI)",
+        "EMBL European Bioinformatics Institute",
+        "European Molecular Biology Laboratory, European Bioinformatics Institute",
+        "European Molecular Biology Laboratory, European Bioinformatics Institute (EMBL-EBI)"],
+    "EMBL Grenoble":["EMBL Grenoble"]+EMBL_common_names,
+    "EMBL Hamburg":["EMBL Hamburg"]+EMBL_common_names,
+    "EMBL Heidelberg":["EMBL Heidelberg"]+EMBL_common_names,
+    "EMBL Nordic":["Nordic EMBL Partnership for Molecular Medicine"],
+    "EMBL Rome":["EMBL Rome","EMBL Monterotondo"]+EMBL_common_names}
+EMBL_places={ ### Dictionary of the places which can follow the names of each EMBL site
+    "EMBL Australia":["Australia","Adelaide, Australia","Melbourne, Australia","Clayton, Australia"],
+    "EMBL Barcelona":["Barcelona","Barcelona, Spain"],
+    "EMBL-EBI":[
+        "Hinxton","Hinxton, UK","Hinxton, United Kingdom","Hinxton, Cambridge, UK","Hinxton, Cambridge, United Kingdom",
+        "Wellcome Genome Campus, Hinxton, UK","Wellcome Genome Campus, Hinxton, United Kingdom",
+        "Wellcome Genome Campus, Hinxton, Cambridge, UK","Wellcome Genome Campus, Hinxton, Cambridge, United Kingdom",
+        "Wellcome Genome Campus, Hinxton, Cambridge CB10 1SD, UK","Wellcome Genome Campus, Hinxton, Cambridge CB10 1SD, United Kingdom",
+        "Wellcome Trust Genome Campus, Hinxton, Cambridge, UK","Wellcome Trust Genome Campus, Hinxton, Cambridge CB10 1SD, UK"],
+    "EMBL Grenoble":["Grenoble","Grenoble, France","Grenoble Outstation","71 avenue des Martyrs, 38042 Grenoble, France"],
+    "EMBL Hamburg":["Hamburg","Hamburg, Germany","Hamburg Outstation","c/o DESY, Hamburg, Germany","Notkestrasse 85, 22607 Hamburg, Germany"],
+    "EMBL Heidelberg":["Heidelberg","Heidelberg, Germany","69117 Heidelberg, Germany","Meyerhofstrasse 1, 69117 Heidelberg, Germany","Meyerhofstraße 1, 69117 Heidelberg, Germany"],
+    "EMBL Rome":["Rome","Rome, Italy","Monterotondo","Monterotondo, Italy","Monterotondo, Rome, Italy","Monterotondo Scalo, Italy","Monterotondo Scalo, Rome, Italy"]}
+resolver=Resolver(EMBL_RORs,EMBL_names,EMBL_places) # Affiliations resolved before the models, None to predict every affiliation
 member_states=[ #List of EMBL member states
     "Austria",
     "Belgium",
@@ -90,6 +202,11 @@ member_states=[ #List of EMBL member states
 associate_member_states=[ #List of EMBL associate member states
     "Argentina",
     "Australia"]
+abrevs={ ### Dictionary of countries abreviations often met 
+    'UK':'United Kingdom',
+    'USA':'United States',
+    "US":'United States',
+    'Czech':"Czech Republic"}
 
 #############################                   DEFINITIONS                   #############################
 
@@ -114,6 +231,45 @@ def chunkIt(seq, num): #### Create a list of sublist
         last += avg
     return out
 
+def read_pmids(inputs): #### Read PMIDs lazily from files or the standard input
+    """This function will yield the PMIDs found in files, line by line, without reading whole files
+    Args :
+            inputs (list-str) :
+                    A list of file paths, "-" for the standard input
+    Return :
+            pmid (str) :
+                    Each PMID (every number) found, in the order of the files
+    """
+    for path in inputs:
+        f=sys.stdin if path=="-" else open(path,"r",encoding="utf-8")
+        try:
+            for line in f:
+                for pmid in re.findall(r'([0-9]+)',line):
+                    yield pmid
+        finally:
+            if f is not sys.stdin:
+                f.close()
+
+def chunk_stream(pmids,size): #### Create chunks of a given size from a stream of PMIDs
+    """This function will yield lists of size PMIDs (the last one can be smaller) from any iterable, only one chunk is kept in memory
+    Args :
+            pmids (iterable-str) :
+                    The PMIDs
+            size (int) :
+                    The number of PMIDs per chunk
+    Return :
+            chunk (list-str) :
+                    Each chunk
+    """
+    chunk=[]
+    for pmid in pmids:
+        chunk.append(pmid)
+        if len(chunk)>=size:
+            yield chunk
+            chunk=[]
+    if chunk:
+        yield chunk
+
 def gen_list_extract(var, key):
     if isinstance(var, dict):
         for k, v in var.items():
@@ -125,43 +281,428 @@ def gen_list_extract(var, key):
         for d in var:
             yield from gen_list_extract(d, key)
 
-def main(): #### Create a queue of process, each process will process a chunk of PMIDs
-    """This function process a list of chunk containing diverse PMIDs
+def load_geonames(): #### Tables of countries and cities names
+    """This function will build the tables of countries and cities used by extract_geoloc_from()
+    Description :
+            It is only called to build the gazetteer (see build_gazetteer()), the other runs read the tables saved in gazetteer_file.
+    Return :
+            tables (dict) :
+                    {"countries_list":[...], "countries_iso2":{...}, "countries_iso3":{...}, "cities_list":[...]}
+    """
+    import pycountry # Allows to load a dictionnary of iso-2 iso3 country codes
+    gc=geonamescache.GeonamesCache() # load data from geonamescache
+    tables={
+        "countries_list":[*gen_list_extract(gc.get_countries(), 'name')], # Creation of Countries list
+        "countries_iso2":{},
+        "countries_iso3":{},
+        "cities_list":[*gen_list_extract(gc.get_cities(), 'name')]} # Creation of Cities list
+    for country in pycountry.countries:
+        tables["countries_iso2"][country.alpha_2] = country.name
+        tables["countries_iso3"][country.alpha_3] = country.name
+    return tables
+
+def distribution_version(name): #### Version of an installed distribution, for the packages without __version__
+    try:
+        from importlib.metadata import version # Python 3.8+
+    except ImportError:
+        try:
+            from importlib_metadata import version # Backport of importlib.metadata
+        except ImportError:
+            import pkg_resources
+            return pkg_resources.get_distribution(name).version
+    return version(name)
+
+def gazetteer_version(): #### Version of the gazetteer, a new version of the tables or of abrevs gives a new gazetteer
+    return "geonamescache "+geonamescache.__version__+" pycountry "+distribution_version("pycountry")+" abrevs "+json.dumps(abrevs,sort_keys=True)
+
+def build_gazetteer(): #### Gazetteer of the tables of load_geonames() and abrevs
+    tables=load_geonames()
+    return Gazetteer(tables["countries_list"],tables["cities_list"],tables["countries_iso2"],tables["countries_iso3"],abrevs,version=gazetteer_version())
+
+def load_nlp(): #### spaCy model, spaCy is only imported here as its import is most of the start of a run
+    import spacy # Allows to use pre-trained models for NER (Name Entity Recognition)
+    return spacy.load(spacy_model,disable=nlp_disable)
+
+def spacy_version(): #### Name and version of the spaCy model, read in its meta.json without importing spaCy when the model is not loaded
+    path=spacy_model
+    if not os.path.isdir(path): # Name of an installed model package
+        try:
+            spec=importlib.util.find_spec(spacy_model)
+        except (ImportError,ValueError):
+            spec=None
+        path=os.path.dirname(spec.origin) if spec is not None and spec.origin else ""
+    if registry.loaded("nlp") or not os.path.exists(os.path.join(path,"meta.json")):
+        meta=registry.get("nlp").meta
+    else:
+        with open(os.path.join(path,"meta.json"),"r",encoding="utf-8") as f:
+            meta=json.load(f)
+    return meta["name"]+" "+meta["version"]
+
+def open_verdict_cache(): #### VerdictCache of cache_file, its is_EMBL verdicts versioned by the models and the pre-filter and its geoloc verdicts by the spaCy model and the gazetteer
+    return vc.VerdictCache(cache_file,{
+        "is_EMBL":vc.hash_files(model_files)+" prefilter "+str(prefilter_threshold), # The resolver is applied before is_EMBL_batch (see classify()), its verdicts are not cached
+        "geoloc":"spacy "+spacy_version()+" "+gazetteer_version()},max_entries=cache_size)
+
+def build_engine(): #### Arrays of the LinearEngine of the models
+    return LinearEngine.export(registry.get("EMBL_ID_Vecto"),registry.get("EMBL_ID_clf"),registry.get("EMBL_Sites_ID_Vecto"),registry.get("EMBL_Sites_ID_clfLR"),version=vc.hash_files(model_files))
+
+def load_models(): #### Set the models of the registry as globals
+    global EMBL_ID_Vecto,EMBL_ID_clf,EMBL_Sites_ID_Vecto,EMBL_Sites_ID_clfLR,EMBL_engine,EMBL_prefilter
+    EMBL_ID_Vecto=registry.get("EMBL_ID_Vecto")
+    EMBL_ID_clf=registry.get("EMBL_ID_clf")
+    EMBL_Sites_ID_Vecto=registry.get("EMBL_Sites_ID_Vecto")
+    EMBL_Sites_ID_clfLR=registry.get("EMBL_Sites_ID_clfLR")
+    EMBL_engine=registry.get("EMBL_engine")
+    EMBL_prefilter=registry.get("EMBL_prefilter")
+
+def load_geoloc(): #### Set the spaCy model and the gazetteer of the registry as globals
+    global nlp,gazetteer
+    nlp=registry.get("nlp")
+    gazetteer=registry.get("gazetteer")
+
+def init_worker(settings,reports): #### Initializer of the Pool workers
+    """This function prepares a new Pool worker before its first chunk
     Description :
-            This function will use mutliprocessing to process a huge list of PMIDs by splitting it in different chunks and create different process for each chunk.
+            Here the function sets the globals of MAIN (see worker_globals) in the worker, which is needed with the spawn and forkserver start methods
+            where the worker imports the module again, then it loads the models (inherited from the parent with fork). The spaCy model and the gazetteer are only loaded
+            here with preload_geoloc, else on first use, so the workers which never categorize an EMBL PMID never import spaCy. The time it took and the memory of the worker
+            are put in the reports queue, and again when the worker exits with the stats of its instrumentation. The queue is drained by a thread of the main process
+            while the pool runs (see collect_reports()), so a worker never waits on a full pipe to exit.
     Args :
-            Nor args
-    Return : 
-            No return
+            settings (dict) :
+                    A dictionary with the name of each global of worker_globals as key and its value in MAIN as value
+            reports (multiprocessing.Queue) :
+                    The queue of the reports of the workers (see report_workers())
+    """
+    start=time.time()
+    globals().update(settings)
+    instrumentation.enable(instrument)
+    load_models()
+    if preload_geoloc:
+        load_geoloc()
+    reports.put({"pid":os.getpid(),"event":"ready","seconds":time.time()-start,"time":time.time(),"memory":models.memory_usage()})
+    multiprocessing.util.Finalize(None,lambda: reports.put({"pid":os.getpid(),"event":"exit","time":time.time(),"memory":models.memory_usage(),
+        "instrumentation":instrumentation.snapshot() if instrument else None}),exitpriority=10)
+
+def collect_reports(reports,events): #### Thread of the main process taking the reports of the workers from the queue until None, in events by pid and event
+    while True:
+        report=reports.get()
+        if report is None:
+            return
+        events.setdefault(report["pid"],{})[report["event"]]=report
+
+def report_workers(events,started): #### Print the startup time and the memory of each worker, add the stats of their instrumentation to the stats of this process
+    for worker in events.values():
+        if worker.get("exit",{}).get("instrumentation") is not None:
+            instrumentation.add(worker["exit"]["instrumentation"])
+    ready=[worker["ready"] for worker in events.values() if "ready" in worker]
+    if not ready:
+        return
+    print("Workers ready in "+str(round(max(report["time"] for report in ready)-started,2))+" s")
+    megabytes=lambda value: "?" if value is None else str(int(round(value)))
+    for pid in sorted(events):
+        worker=events[pid]
+        line="    worker "+str(pid)+":"
+        if "ready" in worker:
+            line+=" loaded in "+str(round(worker["ready"]["seconds"],2))+" s, RSS "+megabytes(worker["ready"]["memory"]["RSS"])+" MB ("+megabytes(worker["ready"]["memory"]["shared"])+" MB shared)"
+        if "exit" in worker:
+            line+=", peak RSS "+megabytes(worker["exit"]["memory"]["peak"])+" MB"
+        print(line)
+
+def main(chunks,workers,method=None): #### Fetch, score and write the chunks of PMIDs in a pipeline
+    """This function process a stream of chunks containing diverse PMIDs
+    Description :
+            The chunks go through three stages running at the same time, each stage waiting when the next one is full :
+                - fetch : fetchers threads of this process fetch the chunks (see fetch_chunk()) and put them in a queue of at most queue_size chunks
+                - score : the processes of the pool take the fetched chunks from the queue and predict and categorize them (see score_chunk()), at most 2 chunks per worker
+                - write : this process appends the results of each chunk to the journal as soon as the chunk is done
+            So the requests to EuropePMC of the next chunks are sent while the workers score the previous ones. The chunks already in the journal are skipped.
+            The chunks are read from the stream only when a fetcher is free, so the input is never fully loaded.
+    Args :
+            chunks (iterable-list) :
+                    The chunks of PMIDs (see chunk_stream())
+            workers (int) :
+                    The number of processes
+            method (str) :
+                    The start method of the processes (fork, spawn or forkserver), None for the default of the platform
+    Return :
+            count (dict) :
+                    The number of PMIDs and chunks read, the number of chunks skipped because already in the journal and the identifiers of the chunks read ("ids")
     """
-    global EMBL_pmids
-    global Sites
-    manager=Manager()
-    q=manager.Queue()
-    pool=Pool(cpu_count()+2)
-    for i in tqdm.tqdm(pool.imap_unordered(process,PMIDs),total=len(PMIDs)):
-        EMBL_pmids+=i[0]
-        for si in i[1]:
-            Sites[si]+=i[1][si]
-    q.put(str(EMBL_pmids))
-    q.put('kill')
+    done=journal.done()
+    count={"PMIDs":0,"chunks":0,"skipped":0,"ids":set()}
+    fetched=queue.Queue(queue_size) # Fetched chunks waiting for a worker, then None at the end (or the exception of the fetch stage)
+    fetching=threading.BoundedSemaphore(fetchers) # Chunks being fetched or waiting for a place in the queue
+    slots=threading.BoundedSemaphore(2*workers) # Chunks sent to the pool and not written in the journal yet
+    def fetch(chunk):
+        try:
+            fetched.put(fetch_chunk(chunk))
+        except BaseException as exception:
+            fetched.put(exception)
+        finally:
+            fetching.release()
+    def produce():
+        try:
+            with ThreadPoolExecutor(max_workers=fetchers) as executor:
+                for chunk in chunks:
+                    count["PMIDs"]+=len(chunk)
+                    count["chunks"]+=1
+                    count["ids"].add(chunk_id(chunk))
+                    if chunk_id(chunk) in done:
+                        count["skipped"]+=1
+                        continue
+                    fetching.acquire()
+                    executor.submit(fetch,chunk)
+        except BaseException as exception:
+            fetched.put(exception)
+        finally:
+            fetched.put(None)
+    def feed():
+        while True:
+            chunk=fetched.get()
+            if chunk is None:
+                return
+            if isinstance(chunk,BaseException):
+                raise chunk
+            slots.acquire()
+            yield chunk
+    for store in (verdict_cache,response_store):
+        if store is not None:
+            store.close() # Each worker opens its own connection
+    context=multiprocessing.get_context(method)
+    europepmc.limiter=RateLimiter(europepmc.limiter.rate,context) # Shared with the workers of this start method
+    reports=context.Queue()
+    events={}
+    started=time.time()
+    pool=context.Pool(workers,initializer=init_worker,initargs=({name:globals()[name] for name in worker_globals},reports))
+    producer=threading.Thread(target=produce,daemon=True) # Started after the pool, no thread is running when the workers are forked
+    producer.start()
+    collector=threading.Thread(target=collect_reports,args=(reports,events),daemon=True)
+    collector.start()
+    for entry in tqdm.tqdm(pool.imap_unordered(score_chunk,feed()),unit="chunk"):
+        journal.append(entry)
+        slots.release()
     pool.close()
     pool.join()
+    producer.join()
+    reports.put(None) # Every worker has exited, so its last report is before this one
+    collector.join()
+    report_workers(events,started)
+    if count["skipped"]:
+        print(str(count["skipped"])+" chunks already processed in "+journal.path)
+    return count
+
+def process_chunk(sublist): #### Process and categorize a chunk of PMIDs, both stages in the current process (see score_chunk())
+    return score_chunk(fetch_chunk(sublist))
+
+def fetch_chunk(sublist): #### Fetch stage of a chunk of PMIDs : the affiliations of each PMID
+    """This function will return the affiliations of the PMIDs of a chunk, from the response store or EuropePMC (see fetch_results())
+    Description :
+            Only the affiliations and their ROR IDs are kept, they are sent to the workers instead of the whole EuropePMC results.
+    Args :
+            sublist (list) :
+                    A list of pmid in this format : ['24929366', '28316114', '26078129']
+    Return :
+            fetched (dict) :
+                    {
+                        "chunk":chunk_id(sublist),
+                        "records":[(pmid, affiliations, rors)],     (for each PMID found, see get_affiliation_details())
+                        "lost":{reason:[...]}               (see fetch_results())
+                    }
+    """
+    with instrumentation.timer("fetch"):
+        found,lost=fetch_results(sublist)
+        records=[]
+        for result in found:
+            details=get_affiliation_details(result)
+            records.append((result["pmid"],[affiliation for affiliation,rors in details],[rors for affiliation,rors in details]))
+        return {
+            "chunk":chunk_id(sublist),
+            "records":records,
+            "lost":lost}
+
+def score_chunk(fetched): #### Score stage of a chunk of PMIDs : detect the EMBL PMIDs and categorize them
+    """This function will detect the EMBL PMIDs of a fetched chunk and categorize them
+    Args :
+            fetched (dict) :
+                    The chunk returned by fetch_chunk()
+    Return :
+            entry (dict) :
+                    The results of the chunk for the journal :
+                        {
+                            "chunk":chunk_id(sublist),
+                            "affiliated":[...],           (see process())
+                            "sites":{site:[...]},         (see process())
+                            "categories":{pmid:{...}},    (see categorize())
+                            "classified":[...],           (see process())
+                            "lost":{reason:[...]},        (see fetch_results())
+                            "paths":{path:...}            (see classify())
+                        }
+    """
+    with instrumentation.timer("chunk"):
+        affiliated,sub_sites,sub_records,classified,lost,paths=classify(fetched)
+        others=[affiliation for record in sub_records.values() for affiliation,site in record if not site]
+        geolocs=dict(zip(others,get_geoloc_batch(others))) # Countries of the affiliations which are not EMBL, at once
+        return {
+            "chunk":fetched["chunk"],
+            "affiliated":affiliated,
+            "sites":sub_sites,
+            "categories":dict(categorize(record,geolocs) for record in sub_records.items()),
+            "classified":classified,
+            "lost":lost,
+            "paths":paths}
+
+def write_results(journal,metadata=None,index=None,reused=(),chunks=None): #### Write the outputs of a search from its journal
+    """This function will write the results store of the search, then the EMBL_PMIDs.txt file and the categories file of each site from the store
+    Description :
+            Here the journal is read chunk by chunk (only the chunks of the current input), each PMID of a site being kept once, and the results are written at once in the results store (see results.write()),
+            then exported in the text files of the previous versions (see results.export_pmids() and results.export_categories()).
+            With --incremental, the results of the PMIDs already classified by previous searches are taken from their stores and come first.
+            The PMIDs without a result (see fetch_results()) are written in missing_file with their reason, and counted in the metadata.
+    Args :
+            journal (Journal) :
+                    The journal of the search
+            metadata (dict) :
+                    Metadata of the run saved in the results store (e.g. the hash of the models and the timings)
+            index (results.Index) :
+                    The PMIDs classified by previous searches (see known_pmids()), None when nothing is reused
+            reused (list-str) :
+                    The PMIDs of the search found in index
+            chunks (set-str) :
+                    The identifiers of the chunks of the current input (see main()), None to use every chunk of the journal
+    Return :
+            EMBL_pmids (list) :
+                    The list of EMBL PMIDs
+    """
+    EMBL_pmids=[]
+    rows=[]
+    if index is not None:
+        EMBL_pmids,rows=index.results(reused)
+    classified=collections.OrderedDict.fromkeys(reused)
+    written={si:set() for si in EMBL_sites.values()}
+    for si,pmid,categories in rows:
+        written[si].add(pmid)
+    lost=collections.OrderedDict()
+    paths=collections.Counter()
+    for entry in journal.entries(chunks):
+        paths.update(entry.get("paths",{}))
+        EMBL_pmids+=[pmid for pmid in entry["affiliated"] if pmid not in classified]
+        classified.update((pmid,None) for pmid in entry.get("classified",entry["affiliated"]))
+        for reason,pmids in entry.get("lost",{}).items():
+            lost.update((pmid,reason) for pmid in pmids)
+        for si in entry["sites"]:
+            for pmid in entry["sites"][si]:
+                if pmid in written[si]:
+                    continue
+                written[si].add(pmid)
+                rows.append((si,pmid,entry["categories"][pmid]))
+    for pmid in classified: # Found by a later chunk
+        lost.pop(pmid,None)
+    with open(directory+missing_file,"w",encoding="utf-8") as f:
+        f.write("PMID\tReason\n"+"".join(pmid+"\t"+reason+"\n" for pmid,reason in lost.items()))
+    reasons=collections.Counter(lost.values())
+    if lost:
+        print(str(len(lost))+" PMIDs without a result ("+", ".join(reason+" "+str(n) for reason,n in sorted(reasons.items()))+") written in "+directory+missing_file)
+    if paths:
+        print("Affiliations resolved by ROR ID: "+str(paths["ROR"])+", by name: "+str(paths["Name"])+", predicted by the models: "+str(paths["Models"]))
+    metadata=dict(metadata or {},missing=dict(reasons),paths=dict(paths))
+    results.write(directory+results.results_file,EMBL_pmids,rows,metadata,list(classified))
+    store=results.read(directory+results.results_file)
+    results.export_pmids(store,directory+"EMBL_PMIDs.txt")
+    results.export_categories(store,directory)
+    return EMBL_pmids
+
+def known_pmids(pmids,index,count): #### Skip the PMIDs already classified with the current models
+    """This function will yield, from a stream of PMIDs, only the new PMIDs and the stale ones (classified with other models), for --incremental
+    Args :
+            pmids (iterable-str) :
+                    The PMIDs
+            index (results.Index) :
+                    The PMIDs classified by previous searches
+            count (dict) :
+                    Filled while the stream is read : "reused" the list of the PMIDs found in index, "stale" and "new" the number of PMIDs processed of each kind
+    Return :
+            pmid (str) :
+                    Each PMID to process
+    """
+    for pmid in pmids:
+        if pmid in index:
+            count["reused"].append(pmid)
+            continue
+        count["stale" if int(pmid) in index.stale else "new"]+=1
+        yield pmid
+
+def fetch_results(sublist): #### EuropePMC results of a sublist of PMIDs
+    """This function will return the EuropePMC results (core format) of a list of PMIDs, from the response store first, and the PMIDs without a result
+    Description :
+            Here the function reads the results of the PMIDs from the response store, fetches the missing (or expired) ones from EuropePMC in queries sized
+            by batcher (see europepmc.AdaptiveBatcher) and stores them. Every PMID of the sublist either has a result or is returned in lost with the reason.
+            In offline mode nothing is fetched.
+    Args :
+            sublist (list) :
+                    A list of pmid in this format : ['24929366', '28316114', '26078129']
+    Return :
+            results (list-dict) :
+                    The results found, in the order of the sublist
+            lost (dict) :
+                    The PMIDs without a result : {"not found":[...], "failed":[...], "offline":[...]} (not returned by EuropePMC, query failed even alone, not in the store in offline mode)
+    """
+    with instrumentation.timer("response store"):
+        stored=response_store.get_many(sublist) if response_store is not None else {}
+    missing=list(collections.OrderedDict.fromkeys(pmid for pmid in sublist if pmid not in stored))
+    lost={"not found":[],"failed":[],"offline":[]}
+    if missing and offline:
+        lost["offline"]=missing
+    elif missing:
+        requested=set(missing)
+        with instrumentation.timer("HTTP"):
+            fetched,lost["failed"]=batcher.fetch(europepmc,missing)
+        fetched=[result for result in fetched if "pmid" in result and str(result["pmid"]) in requested]
+        if response_store is not None:
+            with instrumentation.timer("response store"):
+                response_store.put_many(fetched)
+        stored.update((str(result["pmid"]),result) for result in fetched)
+        failed=set(lost["failed"])
+        lost["not found"]=[pmid for pmid in missing if pmid not in stored and pmid not in failed]
+    for reason,pmids in lost.items():
+        instrumentation.count("PMIDs "+reason,len(pmids))
+    return [stored[pmid] for pmid in collections.OrderedDict.fromkeys(sublist) if pmid in stored],lost
 
 def process(sublist): #### Extract PMIDs from a sublist
     """This function extract EMBL pmid thanks to the affiliation and the algorithm to detect EMBL affiliation (is_EMBL())
     Description : 
-            This function will first make a POST request to the EuropePMC's REST API, this request is based on sublist of PMIDs gave as argument.
-            Then the function goes through all results and for each PMID go through each affiliation and predict if it's an EMBL affiliation or not.
-            If the PMID contains an EMBL affiliation in the end it returns a list of PMIDs affiliated to EMBL and corresponding sites.
+            This function will first get the affiliations of the sublist of PMIDs gave as argument with fetch_chunk() (response store then a POST request to the EuropePMC's REST API),
+            then detect the EMBL PMIDs with classify().
     Args : 
             sublist (list) : 
                     A list of pmid in this format : ['24929366', '28316114', '26078129']
+    Return :
+            The values of classify()
+    """
+    return classify(fetch_chunk(sublist))
+
+def classify(fetched): #### Extract EMBL PMIDs from a fetched chunk
+    """This function goes through the affiliations of a fetched chunk and detect the EMBL PMIDs
+    Description : 
+            The function goes through all records and for each PMID go through each affiliation and predict if it's an EMBL affiliation or not (all the affiliations at once with is_EMBL_batch()).
+            The affiliations with the ROR ID or a canonical name of an EMBL site are resolved first by the resolver (see resolver.Resolver), only the others are predicted.
+            If the PMID contains an EMBL affiliation in the end it returns a list of PMIDs affiliated to EMBL and corresponding sites.
+    Args : 
+            fetched (dict) :
+                    The chunk returned by fetch_chunk()
     Return :
             affiliated (list) :
                     A list of PMIDs affiliated to EMBL
             sub_sites(dict) :
                     A dictionnary of EMBL Sites and their associated (detected) PMIDs
+            sub_records (dict) :
+                    A dictionnary of EMBL PMIDs and the list of their affiliations as (affiliation, site) with site the detected site or "" if the affiliation is not EMBL
+            classified (list) :
+                    A list of the PMIDs found on EuropePMC, EMBL or not
+            lost (dict) :
+                    The PMIDs without a result by reason (see fetch_results())
+            paths (dict) :
+                    The number of affiliations resolved by ROR ID ("ROR"), by name ("Name") and predicted by the models ("Models")
     """
     sub_sites={
         "EMBL Australia":[],
@@ -173,55 +714,178 @@ def process(sublist): #### Extract PMIDs from a sublist
         "EMBL Nordic":[],
         "EMBL Rome":[]}
     affiliated=[]
-    postm={
-        "query":"EXT_ID:"+str(" OR EXT_ID:".join(sublist)),
-        "resultType":"core",
-        "pageSize":1000,
-        "format":"json"}
-    url="https://www.ebi.ac.uk/europepmc/webservices/rest/searchPOST"
-    req=requests.post(url,data=postm)
-    query=json.loads(req.text)
-    for result in query["resultList"]["result"]:
-        if "pmid" in result:
-            if str(result["pmid"]) in sublist:
-                aff=False
-                PMID_sites={
-                    "EMBL Australia":False,
-                    "EMBL Barcelona":False,
-                    "EMBL-EBI":False,
-                    "EMBL Grenoble":False,
-                    "EMBL Hamburg":False,
-                    "EMBL Heidelberg":False,
-                    "EMBL Nordic":False,
-                    "EMBL Rome":False}
-                pmid=result["pmid"]
-                try:
-                    for author in result["authorList"]["author"]:
-                        try:
-                            if "affiliation" in author: # OLD VERSION of affiliation within EuropePMC (one affiliation/author)
-                                is_embl=is_EMBL(author["affiliation"],site=True,proba=True)
-                                if is_embl["choose"]:
-                                    aff=True
-                                    PMID_sites[is_embl["site"]]=True
-                            elif "authorAffiliationDetailsList" in author: # NEW VERSION of multiple affiliations/author within EuropePMC
-                                for aff in author["authorAffiliationDetailsList"]["authorAffiliation"]:
-                                    is_embl=is_EMBL(aff["affiliation"],site=True,proba=True)
-                                    if is_embl["choose"]:
-                                        aff=True
-                                        PMID_sites[is_embl["site"]]=True
-                        except KeyError:
-                            continue
-                except (KeyError, TypeError, IndexError) as error:
-                    print(str(error))
-                    pass
-                if aff==True:
-                    affiliated.append(pmid)
-                for si in PMID_sites:
-                    if PMID_sites[si]:
-                        sub_sites[si].append(pmid)
-    return affiliated,sub_sites
-
-def is_EMBL(request,site=False,proba=False): #### Predict if request is EMBL and the site or not
+    sub_records={}
+    records=fetched["records"] # (pmid, affiliations, rors) of each requested PMID of the page
+    lost=fetched["lost"]
+    resolved=[resolver.resolve(aff,aff_rors) if resolver is not None else (None,None) for pmid,affiliations,rors in records for aff,aff_rors in zip(affiliations,rors)]
+    paths={"ROR":0,"Name":0,"Models":0}
+    for site,method in resolved:
+        paths[method or "Models"]+=1
+    affs=[aff for pmid,affiliations,rors in records for aff in affiliations]
+    predicted=iter(is_EMBL_batch([aff for aff,(site,method) in zip(affs,resolved) if site is None],site=True,proba=True))
+    resolved=iter(resolved)
+    for pmid,affiliations,rors in records:
+        aff=False
+        PMID_sites={
+            "EMBL Australia":False,
+            "EMBL Barcelona":False,
+            "EMBL-EBI":False,
+            "EMBL Grenoble":False,
+            "EMBL Hamburg":False,
+            "EMBL Heidelberg":False,
+            "EMBL Nordic":False,
+            "EMBL Rome":False}
+        record=[]
+        for affiliation in affiliations:
+            site,method=next(resolved)
+            is_embl=resolver.result(affiliation,site,method) if site is not None else next(predicted)
+            instrumentation.count('method "'+is_embl["method"]+'"')
+            if is_embl["choose"]:
+                aff=True
+                PMID_sites[is_embl["site"]]=True
+            record.append((affiliation,is_embl["site"] if is_embl["choose"] else ""))
+        if aff==True:
+            affiliated.append(pmid)
+            sub_records[pmid]=record
+        for si in PMID_sites:
+            if PMID_sites[si]:
+                sub_sites[si].append(pmid)
+    if verdict_cache is not None:
+        verdict_cache.flush_stats()
+    return affiliated,sub_sites,sub_records,[pmid for pmid,affiliations,rors in records],lost,paths
+
+def categorize(record,geolocs=None): #### Categorize an EMBL PMID
+    """This function will categorize an EMBL PMID from its affiliations
+    Description :
+            Here the function goes through the affiliations of the PMID (as returned by process()). An EMBL affiliation of a partnership site (Nordic, Australia)
+            makes the PMID a "Partnership" one. For each other affiliation the countries are extracted with get_geoloc_from(), if one of them is an EMBL member state
+            or associate member state the PMID is a "Member states" one, else it is a "Worldwide" one.
+    Args :
+            record (tuple) :
+                    A tuple (pmid, affiliations) with affiliations a list of (affiliation, site) as in the sub_records returned by process()
+            geolocs (dict) :
+                    A dictionary with the affiliations as key and their result of get_geoloc_from() as value (see get_geoloc_batch()), None to call get_geoloc_from()
+    Return :
+            pmid (str) :
+                    The PMID
+            categories (dict) :
+                    A dictionary of the categories (EMBL, Member states, Worldwide, Partnership) and a boolean for each one
+    """
+    pmid,affiliations=record
+    categories={
+        "EMBL":True,
+        "Member states":False,
+        "Worldwide":False,
+        "Partnership":False}
+    for affiliation,site in affiliations:
+        if site:
+            if site == "EMBL Nordic" or site == "EMBL Australia":
+                categories["Partnership"]=True
+        else:
+            C=geolocs[affiliation] if geolocs is not None else get_geoloc_from(affiliation)
+            if any(country in C for country in member_states+associate_member_states):
+                categories["Member states"]=True
+            else:
+                categories["Worldwide"]=True
+    return pmid,categories
+
+def get_affiliations(result): #### Extract affiliations of a EuropePMC result
+    """This function will extract every affiliation string of a EuropePMC result
+    Description :
+            Here the function goes through the author list of a result (core format) and collect affiliations from both the old (one affiliation/author)
+            and the new (multiple affiliations/author) version of affiliations within EuropePMC.
+    Args :
+            result (dict) :
+                    A result from the resultList of a EuropePMC response in core format
+    Return :
+            affiliations (list) :
+                    A list of affiliation strings in the order they appear in the author list
+    """
+    return [affiliation for affiliation,rors in get_affiliation_details(result)]
+
+def get_affiliation_details(result): #### Extract affiliations of a EuropePMC result with their ROR IDs
+    """This function will extract every affiliation string of a EuropePMC result and the ROR IDs given with it
+    Description :
+            Same as get_affiliations(), the ROR IDs of an affiliation of the new version are the ROR IDs (or their URL) found in the other fields of the affiliation
+            (e.g. its organisation identifier). The affiliations of the old version have no ROR ID.
+    Args :
+            result (dict) :
+                    A result from the resultList of a EuropePMC response in core format
+    Return :
+            affiliations (list-tuple) :
+                    A list of (affiliation, rors) in the order they appear in the author list, with rors a list of ROR IDs
+    """
+    affiliations=[]
+    try:
+        for author in result["authorList"]["author"]:
+            try:
+                if "affiliation" in author: # OLD VERSION of affiliation within EuropePMC (one affiliation/author)
+                    affiliations.append((author["affiliation"],[]))
+                elif "authorAffiliationDetailsList" in author: # NEW VERSION of multiple affiliations/author within EuropePMC
+                    for aff in author["authorAffiliationDetailsList"]["authorAffiliation"]:
+                        rors=[ror_id(value) for key,value in aff.items() if key!="affiliation" and isinstance(value,str) and ror_id(value)]
+                        affiliations.append((aff["affiliation"],rors))
+            except KeyError:
+                continue
+    except (KeyError, TypeError, IndexError) as error:
+        print(str(error))
+    return affiliations
+
+def prepare_request(request): #### Prepare a string for the prediction
+    """This function will prepare an affiliation string before the prediction
+    Description :
+            Here the function applies, in order, every (regex pattern, replacement) of the replacements list to the request (see normalizer.Normalizer).
+    Args :
+            request (string) :
+                    An affiliation string
+    Return :
+            request (string) :
+                    The prepared string
+    """
+    return normalizer(request)
+
+def dump_verdict(result,request): #### Serialize a result for the verdict cache
+    """This function will serialize a result dictionary to store it in the verdict cache
+    Description :
+            The "string" of a result is the request itself except for the ";" method, so to share the verdict between requests giving the same prepared string
+            it is stored as null when it is the request and restored by load_verdict().
+    Args :
+            result (dict) :
+                    A result dictionary (see is_EMBL() or get_geoloc_from())
+            request (string) :
+                    The request of the result
+    Return :
+            value (string) :
+                    The JSON of the result
+    """
+    if result.get("string")==request:
+        result=dict(result,string=None)
+    return json.dumps(result)
+
+def load_verdict(value,request): #### Deserialize a result of the verdict cache
+    result=json.loads(value)
+    if "string" in result and result["string"] is None:
+        result["string"]=request
+    return result
+
+def is_EMBL(request,site=False,proba=False): #### Predict if request is EMBL and the site or not, using the verdict cache
+    """This function will return the result of predict_EMBL() for the request, from the verdict cache when it has already been predicted
+    Args :
+            request (string) :
+                    A string to predict if the string is an EMBL one or not
+            site (boolean) :
+                    A boolean corresponding to the result wanted, if the site is wanted, it returns it
+            proba (boolean) :
+                    A boolean corresponding to the result wanted, if the proba is wanted, it returns it
+    Return :
+            result (dict) :
+                    See predict_EMBL()
+    """
+    if verdict_cache is None:
+        return predict_EMBL(request,site=site,proba=proba)
+    return is_EMBL_batch([request],site=site,proba=proba)[0]
+
+def predict_EMBL(request,site=False,proba=False): #### Predict if request is EMBL and the site or not
     """This function will predict if the affiliation is EMBL or not and return some information about the prediction
     Description :
             This function will first prepare the request (str) for the prediction, then it predict on prepared request.
@@ -230,6 +894,9 @@ def is_EMBL(request,site=False,proba=False): #### Predict if request is EMBL and
             If the EMBL affiliation is still ot predict as "choose" it will check if first words of EMBL (EMBL EBI or European) are present in the string. If it's the case then it will take 6 words after
             this first word and predict on this sequence of 7 words. If it reach 0.9 then results are returned. In the end if it's still not predict as EMBL it check if the full name of EMBL is in the string.
             If results are not returned during the prediction then it return the result of the prediction but as not choose etc..
+            Before any prediction, the requests rejected by the pre-filter (see prefilter.Prefilter and prefilter_threshold) are returned as not choose, without being predicted :
+            their score_EMBL is the upper bound of the pre-filter (below prefilter_threshold), their site "" and their score_site 0.0.
+            The probabilities of both models are computed by the LinearEngine (see engine.py), they are the ones of the sklearn models.
     Args :
             request (string) : 
                     A string to predict if the string is an EMBL one or not
@@ -250,20 +917,20 @@ def is_EMBL(request,site=False,proba=False): #### Predict if request is EMBL and
     """
     patterns=[";","EMBL","EBI","European","European Molecular Biology","European Bioinformatics Institute"]
     # EMBL_obvious=r"[^0-9a-zA-Z]*(EMBL)[^0-9a-zA-Z]*|[^0-9a-zA-Z]*(EBI)[^0-9a-zA-Z]*|[^0-9a-zA-Z]*(European Molecular Biology Laboratory)[^0-9a-zA-Z]*|[^0-9a-zA-Z]*(European Bioinformatics Institute)[^0-9a-zA-Z]*"
+    if EMBL_ID_clf is None:
+        load_models()
     result={
         "choose":False,
         "method":"",
         "string":request}
-    for old, new in replacements: # String preparation
-        request=re.sub(old,new,request)
-    X_test_tfidf=EMBL_ID_Vecto.transform([request])
-    y_pred=EMBL_ID_clf.predict_proba(X_test_tfidf)
+    request=prepare_request(request) # String preparation
+    if EMBL_prefilter is not None and not EMBL_prefilter.keep(request):
+        return skipped_result(result,request,site=site,proba=proba)
+    y_pred,y_pred_site=EMBL_engine.predict_proba([request],sites=site) # Both models in one pass (see engine.LinearEngine)
     ## Default value score & site
     if proba:
         result["score_EMBL"]=y_pred[0][1]
     if site:
-        X_test_tfidf=EMBL_Sites_ID_Vecto.transform([request])
-        y_pred_site=EMBL_Sites_ID_clfLR.predict_proba(X_test_tfidf)
         result["site"]=EMBL_sites[numpy.argmax(y_pred_site[0])]
         if proba:
             result["score_site"]=y_pred_site[0][numpy.argmax(y_pred_site[0])]
@@ -272,8 +939,6 @@ def is_EMBL(request,site=False,proba=False): #### Predict if request is EMBL and
         result["method"]="Complete sentence"
         result["choose"]=True
         if site:
-            X_test_tfidf=EMBL_Sites_ID_Vecto.transform([request])
-            y_pred_site=EMBL_Sites_ID_clfLR.predict_proba(X_test_tfidf)
             result["site"]=EMBL_sites[numpy.argmax(y_pred_site[0])]
             if proba:
                 result["score_site"]=y_pred_site[0][numpy.argmax(y_pred_site[0])]
@@ -295,50 +960,222 @@ def is_EMBL(request,site=False,proba=False): #### Predict if request is EMBL and
                     if not proba:
                         del is_embl["score_EMBL"]
                     return is_embl
-        for patt in ["European","EMBL","EBI"]:
-            if patt in request:
+        windows=words_windows(request)
+        for (patt,sub_EU),score in zip(windows,score_windows([sub_EU for patt,sub_EU in windows])):
+            if score>0.9:
+                result["method"]="Substring '"+patt+"'"
+                result["choose"]=True
+                result["substring"]=sub_EU
+                if site:
+                    result["site"]=EMBL_sites[numpy.argmax(y_pred_site[0])]
+                    if proba:
+                        result["score_site"]=y_pred_site[0][numpy.argmax(y_pred_site[0])]
+                if proba:
+                    result["score_EMBL"]=score
+                return result
+            elif "European Bioinformatics Institute" in sub_EU:
+                result["method"]="Substring 'European Bioinformatics Institute'"
+                result["choose"]=True
+                result["substring"]='European Bioinformatics Institute'
+                if site:
+                    result["site"]="EMBL-EBI"
+                return result
+            elif "European Molecular Biology Laboratory" in sub_EU:
+                result["method"]="Substring 'European Molecular Biology Laboratory'"
+                result["choose"]=True
+                result["substring"]='European Molecular Biology Laboratory'
+                if site:
+                    result["site"]=EMBL_sites[numpy.argmax(y_pred_site[0])]
+                return result
+    return result
+
+def words_windows(request): #### Sequences of words starting with a first word of EMBL
+    """This function will return the sequences of words of the fallback of is_EMBL, in the order they are tried
+    Description :
+            Here the request is tokenized once. For each first word of EMBL (European, EMBL, EBI) found in the request, in this order, a sequence is taken
+            at each occurrence of the word : the word and the 5 next words, or the word and the next words but the last one when there are less than 5 words after it.
+    Args :
+            request (string) :
+                    A prepared string
+    Return :
+            windows (list-tuple) :
+                    A list of (first word, sequence of words)
+    """
+    windows=[]
+    sent=None
+    for patt in ["European","EMBL","EBI"]:
+        if patt in request:
+            if sent is None:
                 sent=re.findall(r'[\w]+',request)
-                indices=[i for i,x in enumerate(sent) if x==patt]
-                for indice in indices:
-                    limit=6
-                    if indice+limit>len(sent):
-                        limit=-1
-                    else:
-                        limit+=indice
-                    sub_EU=" ".join(sent[indice:limit])
-                    X_test_tfidf=EMBL_ID_Vecto.transform([sub_EU])
-                    y_pred=EMBL_ID_clf.predict_proba(X_test_tfidf)
-                    if y_pred[0][1]>0.9:
-                        result["method"]="Substring '"+patt+"'"
-                        result["choose"]=True
-                        result["substring"]=sub_EU
-                        if site:
-                            X_test_tfidf=EMBL_Sites_ID_Vecto.transform([request])
-                            y_pred_site=EMBL_Sites_ID_clfLR.predict_proba(X_test_tfidf)
-                            result["site"]=EMBL_sites[numpy.argmax(y_pred_site[0])]
-                            if proba:
-                                result["score_site"]=y_pred_site[0][numpy.argmax(y_pred_site[0])]
-                        if proba:
-                            result["score_EMBL"]=y_pred[0][1]
-                        return result
-                    elif "European Bioinformatics Institute" in sub_EU:
-                        result["method"]="Substring 'European Bioinformatics Institute'"
-                        result["choose"]=True
-                        result["substring"]='European Bioinformatics Institute'
-                        if site:
-                            result["site"]="EMBL-EBI"
-                        return result
-                    elif "European Molecular Biology Laboratory" in sub_EU:
-                        result["method"]="Substring 'European Molecular Biology Laboratory'"
-                        result["choose"]=True
-                        result["substring"]='European Molecular Biology Laboratory'
-                        if site:
-                            X_test_tfidf=EMBL_Sites_ID_Vecto.transform([request])
-                            y_pred_site=EMBL_Sites_ID_clfLR.predict_proba(X_test_tfidf)
-                            result["site"]=EMBL_sites[numpy.argmax(y_pred_site[0])]
-                        return result
+            indices=[i for i,x in enumerate(sent) if x==patt]
+            for indice in indices:
+                limit=6
+                if indice+limit>len(sent):
+                    limit=-1
+                else:
+                    limit+=indice
+                windows.append((patt," ".join(sent[indice:limit])))
+    return windows
+
+def score_windows(windows): #### EMBL probability of each sequence of words, from the window cache when it has already been scored
+    """This function will return the probability of EMBL of each sequence of words
+    Description :
+            The sequences are often the same (e.g. "EMBL Heidelberg Meyerhofstrasse 1 69117"), so their probabilities are kept in window_scores, the least recently used
+            being dropped when it holds more than window_cache_size sequences. The sequences not found in it are scored once each, in one call to the LinearEngine.
+    Args :
+            windows (list-str) :
+                    A list of sequences of words
+    Return :
+            scores (list-float) :
+                    The probability of EMBL of each sequence, in the order of windows
+    """
+    missing=list(collections.OrderedDict.fromkeys(window for window in windows if window not in window_scores))
+    instrumentation.count("windows",len(windows))
+    instrumentation.count("windows scored",len(missing))
+    if missing:
+        for window,y_pred in zip(missing,EMBL_engine.predict_proba(missing,sites=False)[0]):
+            window_scores[window]=y_pred[1]
+    scores=[]
+    for window in windows:
+        window_scores.move_to_end(window)
+        scores.append(window_scores[window])
+    while len(window_scores)>window_cache_size:
+        window_scores.popitem(last=False)
+    return scores
+
+def skipped_result(result,request,site=False,proba=False): #### Result of a request rejected by the pre-filter : the bound of the pre-filter as score, no site
+    if proba:
+        result["score_EMBL"]=EMBL_prefilter.bound(request)
+    if site:
+        result["site"]=""
+        if proba:
+            result["score_site"]=0.0
     return result
 
+def is_EMBL_batch(affiliations,site=False,proba=False): #### Predict if each affiliation of a list is EMBL and the site or not, using the verdict cache
+    """This function will return the result of predict_EMBL_batch() for each affiliation, from the verdict cache when it has already been predicted
+    Description :
+            Here the verdicts are stored under the prepared string and the arguments, so every affiliation giving the same prepared string shares the same verdict.
+            Only the affiliations not found in the cache are predicted (at once) and then stored.
+    Args :
+            affiliations (list-str) :
+                    A list of strings to predict if each string is an EMBL one or not
+            site (boolean) :
+                    A boolean corresponding to the result wanted, if the site is wanted, it returns it
+            proba (boolean) :
+                    A boolean corresponding to the result wanted, if the proba is wanted, it returns it
+    Return :
+            results (list-dict) :
+                    See predict_EMBL_batch()
+    """
+    if verdict_cache is None:
+        return predict_EMBL_batch(affiliations,site=site,proba=proba)
+    with instrumentation.timer("normalization"):
+        keys=[str(int(site))+str(int(proba))+request for request in normalizer.batch(affiliations)]
+    with instrumentation.timer("verdict cache"):
+        found=verdict_cache.get_many("is_EMBL",keys)
+    missing=[i for i,key in enumerate(keys) if key not in found]
+    predicted=predict_EMBL_batch([affiliations[i] for i in missing],site=site,proba=proba)
+    with instrumentation.timer("verdict cache"):
+        verdict_cache.put_many("is_EMBL",[(keys[i],dump_verdict(result,affiliations[i])) for i,result in zip(missing,predicted)])
+    predicted=iter(predicted)
+    return [load_verdict(found[key],request) if key in found else next(predicted) for key,request in zip(keys,affiliations)]
+
+def predict_EMBL_batch(affiliations,site=False,proba=False): #### Predict if each affiliation of a list is EMBL and the site or not
+    """This function will predict if affiliations are EMBL or not and return, for each of them, the same information as is_EMBL()
+    Description :
+            This function follows the same steps as predict_EMBL() but on a whole list of affiliations at once. All requests are prepared, the ones rejected by the pre-filter
+            are left out (see skipped_result()), then the others are predicted by both models (EMBL and EMBL-sites) in one call to the LinearEngine. Only the requests that are not predicted as EMBL on the complete sentence and that contain a ";" or
+            one of the first words of EMBL (European EMBL EBI) are sent to the next steps. Substrings split on ";" are predicted with one recursive call on all of them
+            and the sequences of words taken after the first words of EMBL (see words_windows()) are scored at once by score_windows().
+            For each affiliation the first substring or sequence reaching the prediction is kept, as in predict_EMBL().
+    Args :
+            affiliations (list-str) :
+                    A list of strings to predict if each string is an EMBL one or not
+            site (boolean) :
+                    A boolean corresponding to the result wanted, if the site is wanted, it returns it
+            proba (boolean) :
+                    A boolean corresponding to the result wanted, if the proba is wanted, it returns it
+    Return :
+            results (list-dict) :
+                    A list of result dictionaries (see predict_EMBL()) in the same order as affiliations
+    """
+    results=[{"choose":False,"method":"","string":request} for request in affiliations]
+    if not results:
+        return results
+    if EMBL_ID_clf is None:
+        load_models()
+    with instrumentation.timer("normalization"):
+        requests_prep=normalizer.batch(affiliations) # String preparation
+    with instrumentation.timer("pre-filter"):
+        kept=[i for i,request in enumerate(requests_prep) if EMBL_prefilter is None or EMBL_prefilter.keep(request)]
+    instrumentation.count("pre-filter skipped",len(results)-len(kept))
+    if len(kept)<len(results):
+        for i in set(range(len(results))).difference(kept):
+            skipped_result(results[i],requests_prep[i],site=site,proba=proba)
+        if not kept:
+            return results
+    with instrumentation.timer("inference"):
+        y_pred,y_pred_site=EMBL_engine.predict_proba([requests_prep[i] for i in kept],sites=site) # Both models in one pass (see engine.LinearEngine)
+    pending=[] # Requests going through substrings predictions
+    for row,i in enumerate(kept):
+        result=results[i]
+        ## Default value score & site
+        if proba:
+            result["score_EMBL"]=y_pred[row][1]
+        if site:
+            result["site"]=EMBL_sites[numpy.argmax(y_pred_site[row])]
+            if proba:
+                result["score_site"]=y_pred_site[row][numpy.argmax(y_pred_site[row])]
+        ## Proba > 0.9
+        if y_pred[row][1]>0.9:
+            result["method"]="Complete sentence"
+            result["choose"]=True
+        elif ";" in requests_prep[i] or any(patt in requests_prep[i] for patt in ["European","EMBL","EBI"]):
+            pending.append(i)
+    ## Split in sub strings
+    substrings=[(i,aff) for i in pending if ";" in requests_prep[i] for aff in requests_prep[i].split(";")]
+    if substrings:
+        with instrumentation.timer("split ';'"),instrumentation.recursion("split ';'"): # Includes the stages of the recursive call
+            sub_results=is_EMBL_batch([aff for i,aff in substrings],site=True,proba=True)
+        for (i,aff),is_embl in zip(substrings,sub_results):
+            if is_embl["choose"] and not results[i]["choose"]:
+                is_embl["method"]="Substring ';'"
+                is_embl["substring"]=aff
+                is_embl["string"]=requests_prep[i]
+                if not site:
+                    del is_embl["site"]
+                    del is_embl["score_site"]
+                if not proba:
+                    del is_embl["score_EMBL"]
+                results[i]=is_embl
+        pending=[i for i in pending if not results[i]["choose"]]
+    ## Sequences of words after the first words of EMBL
+    with instrumentation.timer("word windows"): # Includes the inference of the windows
+        windows=[(i,patt,sub_EU) for i in pending for patt,sub_EU in words_windows(requests_prep[i])]
+        if windows:
+            for (i,patt,sub_EU),score in zip(windows,score_windows([sub_EU for i,patt,sub_EU in windows])):
+                result=results[i]
+                if result["choose"]:
+                    continue
+                if score>0.9:
+                    result["method"]="Substring '"+patt+"'"
+                    result["choose"]=True
+                    result["substring"]=sub_EU
+                    if proba:
+                        result["score_EMBL"]=score
+                elif "European Bioinformatics Institute" in sub_EU:
+                    result["method"]="Substring 'European Bioinformatics Institute'"
+                    result["choose"]=True
+                    result["substring"]='European Bioinformatics Institute'
+                    if site:
+                        result["site"]="EMBL-EBI"
+                elif "European Molecular Biology Laboratory" in sub_EU:
+                    result["method"]="Substring 'European Molecular Biology Laboratory'"
+                    result["choose"]=True
+                    result["substring"]='European Molecular Biology Laboratory'
+    return results
+
 def save(file,obj): #### Save object in a txt file
     """This function will save an object into a a text file
     Description :
@@ -356,8 +1193,64 @@ def save(file,obj): #### Save object in a txt file
         f.write("\n")
         f.close()
 
+def get_geoloc_from(request,cities=False,other=False,all_mention=False): #### Extraction of geolocation information from a sentence, using the verdict cache
+    """This function will return the result of extract_geoloc_from() for the request, from the verdict cache when it has already been extracted
+    Args :
+            request (string) :
+                    A string to search geolocation inside
+            cities (boolean) :
+                    See extract_geoloc_from()
+            other (boolean) :
+                    See extract_geoloc_from()
+            all_mention (boolean) :
+                    See extract_geoloc_from()
+    Return :
+            geoloc_dict (dictionary) :
+                    See extract_geoloc_from()
+    """
+    return get_geoloc_batch([request],cities=cities,other=other,all_mention=all_mention)[0]
+
+def get_geoloc_batch(requests,cities=False,other=False,all_mention=False): #### Extraction of geolocation information from a list of sentences, using the verdict cache
+    """This function will return the result of get_geoloc_from() for each request of a list
+    Description :
+            Here the requests not found in the verdict cache are extracted once each. Their entities are computed at once with nlp.pipe() (the tagger and the parser
+            are not loaded, see nlp_disable), except for the requests in which the gazetteer finds no country name (see Gazetteer.may_mention_country()) : the entities
+            cannot change their result so they are extracted without the NER.
+    Args :
+            requests (list-string) :
+                    A list of strings to search geolocation inside
+            cities (boolean) :
+                    See extract_geoloc_from()
+            other (boolean) :
+                    See extract_geoloc_from()
+            all_mention (boolean) :
+                    See extract_geoloc_from()
+    Return :
+            geoloc_dicts (list-dictionary) :
+                    The result of extract_geoloc_from() for each request, in the order of requests
+    """
+    if nlp is None or gazetteer is None:
+        load_geoloc()
+    prefix=str(int(cities))+str(int(other))+str(int(all_mention))
+    keys=[prefix+request for request in requests] # spaCy works on the raw request, so it is not prepared
+    with instrumentation.timer("verdict cache"):
+        found=verdict_cache.get_many("geoloc",keys) if verdict_cache is not None else {}
+    missing=list(collections.OrderedDict.fromkeys(request for key,request in zip(keys,requests) if key not in found))
+    ner=[request for request in missing if cities or other or gazetteer.may_mention_country(request)]
+    instrumentation.count("NER skipped",len(missing)-len(ner))
+    with instrumentation.timer("spaCy"):
+        docs=dict(zip(ner,nlp.pipe(ner,batch_size=nlp_batch_size,n_process=nlp_processes)))
+    extracted={}
+    with instrumentation.timer("geoloc extraction"):
+        for request in missing:
+            extracted[request]=extract_geoloc_from(request,cities=cities,other=other,all_mention=all_mention,ents=docs[request].ents if request in docs else ())
+    if verdict_cache is not None:
+        with instrumentation.timer("verdict cache"):
+            verdict_cache.put_many("geoloc",[(prefix+request,json.dumps(geoloc_dict)) for request,geoloc_dict in extracted.items()])
+    return [json.loads(found[key]) if key in found else dict(extracted[request]) for key,request in zip(keys,requests)]
+
 ### !!! Not the best way to check countries NEED IMPROVEMENTS
-def get_geoloc_from(request,cities=False,other=False,all_mention=False): #### Extraction of geolocation information from a sentence
+def extract_geoloc_from(request,cities=False,other=False,all_mention=False,ents=None): #### Extraction of geolocation information from a sentence
     """This function will extract countries/cities or others geolocation information
     Description :
             Here the function will use spacy as Named Entity Recognition (NER) to catch potential countries or cities or even other geolocation information in the request (string).
@@ -372,6 +1265,8 @@ def get_geoloc_from(request,cities=False,other=False,all_mention=False): #### Ex
                     This argument is used to know if other geolocation information are wanted in the output instead of countries or cities
             all_mention (boolean) : 
                     The dictionnary returned will have the number of mention for each geolocation information found
+            ents (list) :
+                    The spaCy entities of the request if they are already computed (see get_geoloc_batch()), None to run nlp on the request
     Return :
             geoloc_dict (dictionary) :
                     This dictionnary will be in the following format (here for a request mentionning 1 time Australia and Botswana and 4 time USA, with cities=False, other=False, all_mention=True) :
@@ -399,7 +1294,7 @@ def get_geoloc_from(request,cities=False,other=False,all_mention=False): #### Ex
                 No return
         """
         if all_mention:
-            nb_of_mention=len(re.findall(r'^'+exact_mention+'[^a-zA-Z0-9]|[^a-zA-Z0-9]'+exact_mention+'[^a-zA-Z0-9]|[^a-zA-Z0-9]'+exact_mention+'$',request))
+            nb_of_mention=gazetteer.count(request,exact_mention)
         else:
             nb_of_mention=1
         if real_name not in geoloc_dict:
@@ -407,29 +1302,31 @@ def get_geoloc_from(request,cities=False,other=False,all_mention=False): #### Ex
         else:
             geoloc_dict[real_name]+=nb_of_mention
 
-    def check_in_dict(dico): #### Use to look for key in a dict and then save it if key in it
-        """This function will go through a dictionary (dico) to find if there is any ey in the request
+    def check_in_dict(kind): #### Use to look for the keys of a dict of the gazetteer and then save them if they are in the request
+        """This function will find if there is any key of a dictionary of the gazetteer in the request
         Description :
-                Here the function will go through the dictionary pass as an argument to check if any (abreviation/iso2/iso3) are in the request (string).
-                If it is, it calls check_dict() function to save the real name (value) based on the exact mention (key)
+                Here the function will ask the gazetteer which (abreviation/iso2/iso3) are in the request (string), found in one pass over the request.
+                For each of them, in the order of the dictionary, it calls check_dict() function to save the real name (value) based on the exact mention (key)
         Args : 
-                dico (dictionary) :
-                        A dictionary with a pattern as a key and real name as value
+                kind (string) :
+                        The dictionary of the gazetteer ("abbreviation", "iso2" or "iso3")
         Return :
                 No return
         """
-        for abrev in dico:
-            if abrev not in geoloc_met and re.search(r'^'+abrev+'[^a-zA-Z0-9]|[^a-zA-Z0-9]'+abrev+'[^a-zA-Z0-9]|[^a-zA-Z0-9]'+abrev+'$',request):
-                check_dict(request,abrev,dico[abrev],geoloc_dict)
+        for abrev,name in gazetteer.codes(request,kind):
+            if abrev not in geoloc_met:
+                check_dict(request,abrev,name,geoloc_dict)
                 geoloc_met.append(abrev)
                 if not all_mention:
                     return
 
-    geoloc={
-        "Countries":countries_list,
-        "Cities":cities_list,
-        "iso2":countries_iso2,
-        "iso3":countries_iso3}
+    if nlp is None or gazetteer is None:
+        load_geoloc()
+    geoloc={ # Sets and dictionaries, each lookup is O(1)
+        "Countries":gazetteer.countries,
+        "Cities":gazetteer.cities,
+        "iso2":gazetteer.iso2,
+        "iso3":gazetteer.iso3}
     geoloc_dict={}
     if cities:
         geoloc_geoname=geoloc["Cities"]
@@ -437,9 +1334,10 @@ def get_geoloc_from(request,cities=False,other=False,all_mention=False): #### Ex
         geoloc_geoname=geoloc["Countries"]
     geoloc_met=[]
     geoloc_info=[]
-    spacy_aff=nlp(request)
+    if ents is None:
+        ents=nlp(request).ents
     
-    for entities in spacy_aff.ents:          
+    for entities in ents:          
         if entities.label_ =='GPE' and entities.text not in geoloc_met and not re.search(r'[^0-9a-zA-Z\s]',entities.text):
             geoloc_info.append(entities.text)
             if other and entities.text not in geoloc["Countries"] and entities.text not in geoloc["Cities"] and entities.text not in geoloc["iso2"] and entities.text not in geoloc["iso3"]:
@@ -460,9 +1358,9 @@ def get_geoloc_from(request,cities=False,other=False,all_mention=False): #### Ex
                             geoloc_met.append(w)
     
     if not cities and not other:
-        check_in_dict(abrevs)
-        # check_in_dict(countries_iso3)
-        # check_in_dict(countries_iso2)
+        check_in_dict("abbreviation")
+        # check_in_dict("iso3")
+        # check_in_dict("iso2")
 
     if cities and len(geoloc_met)<1:
         for w in re.findall(r'[\w]+',request):
@@ -474,7 +1372,7 @@ def get_geoloc_from(request,cities=False,other=False,all_mention=False): #### Ex
         if len(geoloc_met)>0 and not all_mention:
             return geoloc_dict
         for info in geoloc_info:
-            if info.lower().title() in countries_list:
+            if info.lower().title() in geoloc["Countries"]:
                 check_dict(request,info,info.lower().title(),geoloc_dict)
                 geoloc_met.append(info)
                 return geoloc_dict
@@ -489,113 +1387,100 @@ def get_geoloc_from(request,cities=False,other=False,all_mention=False): #### Ex
 #############################                   MAIN                   #############################
 
 if __name__=='__main__':
-    abrevs={ ### Dictionary of countries abreviations often met 
-        'UK':'United Kingdom',
-        'USA':'United States',
-        "US":'United States',
-        'Czech':"Czech Republic"}
-    gc=geonamescache.GeonamesCache() # load data from geonamescache
-    countries_list = [*gen_list_extract(gc.get_countries(), 'name')] # Creation of Countries list
-    countries_iso2 = {}
-    countries_iso3 = {}
-    countries_to_iso2 = {}
-    for country in pycountry.countries:
-        countries_to_iso2[country.name] = country.alpha_2
-        countries_iso2[country.alpha_2] = country.name
-        countries_iso3[country.alpha_3] = country.name
-    cities_list = [*gen_list_extract(gc.get_cities(), 'name')] # Creation of Cities list
-    nlp = spacy.load("en_core_web_sm") # Model from spacy for NER (Name Entity Recognition)
-    Sites={
-        "EMBL Australia":[],
-        "EMBL Barcelona":[],
-        "EMBL-EBI":[],
-        "EMBL Grenoble":[],
-        "EMBL Hamburg":[],
-        "EMBL Heidelberg":[],
-        "EMBL Nordic":[],
-        "EMBL Rome":[]}
+    parser=argparse.ArgumentParser(description="Detect EMBL papers within a list of PMIDs")
+    parser.add_argument("inputs",nargs="*",help="files of PMIDs (every number is read as a PMID), - for the standard input (default: search_file in the directory of the search)")
+    parser.add_argument("-o","--output",default=directory,help="directory of the results (default: %(default)s)")
+    parser.add_argument("-w","--workers",type=int,default=workers,help="number of processes scoring the chunks (default: %(default)s)")
+    parser.add_argument("--fetchers",type=int,default=fetchers,help="number of threads fetching the chunks (default: %(default)s)")
+    parser.add_argument("--queue-size",type=int,default=queue_size,help="maximum number of fetched chunks waiting for a worker (default: %(default)s)")
+    parser.add_argument("-b","--batch-size",type=int,default=batch_size,help="number of PMIDs per chunk handed to a worker and recorded in the journal, the requests to EuropePMC are sized from their responses (default: %(default)s)")
+    parser.add_argument("--concurrency",type=int,default=concurrency,help="maximum number of requests sent at the same time by each process (default: %(default)s)")
+    parser.add_argument("--requests-per-second",type=float,default=requests_per_second,help="maximum number of requests per second (default: %(default)s)")
+    parser.add_argument("--europepmc-url",default=europepmc_url,help="URL of the EuropePMC REST API (default: %(default)s)")
+    parser.add_argument("--offline",action="store_true",help="only use the results of the response store, nothing is fetched")
+    parser.add_argument("--no-store",action="store_true",help="do not use the response store, every PMID is fetched")
+    parser.add_argument("--no-cache",action="store_true",help="do not use the verdict cache")
+    parser.add_argument("--spacy-model",default=spacy_model,help="spacy model (name or path) of get_geoloc_from (default: %(default)s)")
+    parser.add_argument("--start-method",choices=multiprocessing.get_all_start_methods(),default=start_method,help="start method of the processes (default: the default of the platform)")
+    parser.add_argument("--restart",action="store_true",help="delete the journal of the search instead of resuming it")
+    parser.add_argument("--incremental",action="store_true",help="only process the PMIDs not classified by a previous search of "+searches_dir+" with the current models, the results of the others are reused")
+    parser.add_argument("--preload-geoloc",action="store_true",help="load the spaCy model and the gazetteer at start instead of on first use (shared by the workers with fork)")
+    parser.add_argument("--instrument",action="store_true",help="record the time of each stage and the counters of the run, written in "+instrumentation_file+" in the directory of the results")
+    args=parser.parse_args()
+    offline=args.offline or offline
+    instrument=args.instrument or instrument
+    preload_geoloc=args.preload_geoloc or preload_geoloc
+    spacy_model=args.spacy_model
+    if args.no_cache:
+        cache_file=None
+    if args.no_store:
+        store_file=None
+    incremental=args.incremental or incremental
+    fetchers=args.fetchers
+    queue_size=args.queue_size
+    instrumentation.enable(instrument)
+    directory=os.path.join(args.output,"")
+    os.makedirs(directory,exist_ok=True)
+    europepmc=EuropePMC(args.europepmc_url,concurrency=args.concurrency,requests_per_second=args.requests_per_second)
+    start=time.time()
+    method=args.start_method or multiprocessing.get_start_method()
+    if method=="fork": # Loaded once here and inherited by every worker
+        load_models()
+        if preload_geoloc:
+            load_geoloc()
+    else:
+        if mmap_dir is not None:
+            for path in model_files: # Copies written once here, then memory mapped by every worker
+                models.mmap_copy(path,mmap_dir)
+    print("Models loaded in "+str(round(time.time()-start,2))+" s ("+", ".join(name+" "+str(round(seconds,2))+" s" for name,seconds in registry.timings.items())+")")
+    if cache_file is not None:
+        verdict_cache=open_verdict_cache()
+        verdict_cache.reset_stats()
+    if store_file is not None:
+        response_store=ResponseStore(store_file,ttl=store_ttl,offline=offline)
+    elif offline:
+        raise SystemExit("--offline needs a response store (store_file)")
     # File reading
-    if ".txt" in search_file or ".csv" in search_file:
-        with open(directory+search_file,"r",encoding="utf-8") as file:
-            PMID_list=re.findall(r'([0-9]+)',file.read())
-            file.close()
+    if args.inputs:
+        PMID_stream=read_pmids(args.inputs)
+    elif ".txt" in search_file or ".csv" in search_file:
+        PMID_stream=read_pmids([directory+search_file])
     else:
-        PMID_list=re.findall(r'([0-9]+)',search_file)
-    PMIDs=chunkIt(PMID_list,len(PMID_list)/1000)
-    EMBL_pmids=[]
+        PMID_stream=iter(re.findall(r'([0-9]+)',search_file))
+    journal=Journal(directory+journal_file,vc.hash_files(model_files))
+    if args.restart:
+        journal.clear()
     start=time.time()
-    main()
-    print("Number of PMIDs to process :"+str(len(PMID_list)))
+    index=None
+    reused={"reused":[],"stale":0,"new":0}
+    if incremental:
+        index=results.Index(searches_dir,vc.hash_files(model_files))
+        print(str(len(index.known))+" PMIDs already classified by "+str(len(index.searches))+" searches of "+searches_dir+" ("+str(round(time.time()-start,2))+" s)")
+        PMID_stream=known_pmids(PMID_stream,index,reused)
+    count=main(chunk_stream(PMID_stream,args.batch_size),args.workers,method)
+    print("Number of PMIDs to process :"+str(count["PMIDs"]))
+    if incremental:
+        print(str(len(reused["reused"]))+" PMIDs reused, "+str(reused["stale"])+" stale and "+str(reused["new"])+" new PMIDs processed")
     end=time.time()
     print("Computing time: "+str(end-start))
+    EMBL_pmids=write_results(journal,{
+        "date":time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "models":vc.hash_files(model_files),
+        "spacy_model":spacy_version(),
+        "PMIDs":count["PMIDs"],
+        "chunks":count["chunks"],
+        "skipped_chunks":count["skipped"],
+        "workers":args.workers,
+        "fetchers":fetchers,
+        "queue_size":queue_size,
+        "batch_size":args.batch_size,
+        "start_method":method,
+        "seconds":end-start,
+        "models_seconds":registry.timings,
+        "incremental":{"reused":len(reused["reused"]),"stale":reused["stale"],"new":reused["new"]} if incremental else None},index,reused["reused"],count["ids"])
+    journal.rotate() # The outputs are written, the next search of the directory does not resume from this one
     print("Number of EMBL publications found: "+str(len(EMBL_pmids)))
-    for si in Sites:
-        file=si.replace(" ","_").replace("-","_")
-        x=0
-        NA=[]
-        PMID_EMBL_only=[]
-        PMID_member_states=[]
-        PMID_others=[]
-        PMID_deleted=[]
-        RESULTS_PMIDS={}
-        for PMID in Sites[si]:
-            RESULTS_PMIDS[PMID]={
-                "EMBL":True,
-                "Member states":False,
-                "Worldwide":False,
-                "Partnership":False}
-            x+=1
-            req=requests.get("https://www.ebi.ac.uk/europepmc/webservices/rest/search/query=ext_id:"+PMID+"&resultType=core&format=json")
-            try:
-                req_PMID=json.loads(req.text)["resultList"]["result"][0]["authorList"]["author"]
-            except IndexError:
-                PMID_deleted.append(PMID)
-                continue
-            for result in req_PMID:
-                if PMID==result:
-                    req_PMID=result["authorList"]["author"]
-                    break
-            affiliations=[]
-            for author in req_PMID:
-                try:
-                    if "affiliation" in author:
-                        affiliations.append(author["affiliation"])
-                    elif "authorAffiliationDetailsList" in author:
-                        for aff in author["authorAffiliationDetailsList"]["authorAffiliation"]:
-                            affiliations.append(aff["affiliation"])
-                except KeyError:
-                    continue
-            nb_EMBL=0
-            EMBL_aff=[]
-            for affiliation in affiliations:
-                is_embl=is_EMBL(affiliation,site=True,proba=True)
-                if is_embl["choose"]:
-                    if is_embl["site"] == "EMBL Nordic" or is_embl["site"] == "EMBL Australia":
-                        RESULTS_PMIDS[PMID]["Partnership"]=True
-                else:
-                    C=get_geoloc_from(affiliation)
-                    if any(country in C for country in member_states+associate_member_states):
-                        RESULTS_PMIDS[PMID]["Member states"]=True
-                    else:
-                        RESULTS_PMIDS[PMID]["Worldwide"]=True
-            if RESULTS_PMIDS[PMID]["Member states"]:
-                PMID_member_states.append(PMID)
-            elif RESULTS_PMIDS[PMID]["Worldwide"]:
-                PMID_others.append(PMID)
-            elif RESULTS_PMIDS[PMID]["Partnership"]:
-                NA.append(PMID)
-
-        with open("./searches/"+search_name+"/"+file+"_categories.csv","w",encoding="utf-8") as f:
-            f.write("PMID\tEMBL\tMember states\tWorldwide\tPartnership\n")
-            for pmid in RESULTS_PMIDS:
-                f.write(str(pmid))
-                f.write("\t")
-                f.write(str(RESULTS_PMIDS[pmid]["EMBL"]))
-                f.write("\t")
-                f.write(str(RESULTS_PMIDS[pmid]["Member states"]))
-                f.write("\t")
-                f.write(str(RESULTS_PMIDS[pmid]["Worldwide"]))
-                f.write("\t")
-                f.write(str(RESULTS_PMIDS[pmid]["Partnership"]))
-                f.write("\n")
-    save("EMBL_PMIDs",EMBL_pmids)
\ No newline at end of file
+    if instrument:
+        instrumentation.report(directory+instrumentation_file)
+    if verdict_cache is not None:
+        print("Verdict cache: "+str(verdict_cache.stats()))
\ No newline at end of file
@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+# Fused inference of the EMBL and EMBL-sites models of detect_EMBL.py
+########################
+import math
+import os
+import re
+import time
+import unicodedata
+
+import numpy
+
+#############################                   VARIABLES                   #############################
+
+format=1 # Version of the arrays of an exported engine, the files of another format are exported again
+tolerance=1e-9 # Largest difference allowed between the probabilities of an exported engine and the ones of predict_proba()
+probes=["","European Molecular Biology Laboratory, Heidelberg, Germany","EMBL-EBI, Wellcome Genome Campus, Hinxton, UK","Department of Biology, University of Oxford, UK"] # Strings checked by export(), with strings of words of the vocabularies
+
+#############################                   DEFINITIONS                   #############################
+
+def strip_accents_ascii(request): #### Same as sklearn.feature_extraction.text.strip_accents_ascii
+    return unicodedata.normalize("NFKD",request).encode("ASCII","ignore").decode("ASCII")
+
+def strip_accents_unicode(request): #### Same as sklearn.feature_extraction.text.strip_accents_unicode
+    normalized=unicodedata.normalize("NFKD",request)
+    if normalized==request:
+        return request
+    return "".join(char for char in normalized if not unicodedata.combining(char))
+
+def is_ovr(clf): #### True if the probabilities of a LogisticRegression are one-vs-rest (as in LogisticRegression.predict_proba)
+    return clf.multi_class in ("ovr","warn") or (clf.multi_class=="auto" and (len(clf.classes_)<=2 or clf.solver=="liblinear"))
+
+def probabilities(decision,ovr): #### Probabilities of a LogisticRegression from its decision function
+    """This function will compute the probabilities of a LogisticRegression as its predict_proba() does
+    Args :
+            decision (numpy.array) :
+                    The decision function, shape (n,) for a binary model or (n, classes)
+            ovr (boolean) :
+                    True for a one-vs-rest model (logistic function of each class, normalized), False for a multinomial one (softmax)
+    Return :
+            probabilities (numpy.array) :
+                    The probabilities, shape (n, classes)
+    """
+    if decision.ndim==1:
+        if ovr:
+            proba=1.0/(1.0+numpy.exp(-decision))
+            return numpy.column_stack([1.0-proba,proba])
+        decision=numpy.column_stack([-decision,decision])
+    elif ovr:
+        proba=1.0/(1.0+numpy.exp(-decision))
+        return proba/proba.sum(axis=1).reshape((-1,1))
+    proba=numpy.exp(decision-decision.max(axis=1).reshape((-1,1)))
+    return proba/proba.sum(axis=1).reshape((-1,1))
+
+def probabilities_list(decision,ovr): #### Same as probabilities() for the decision function of one string (a float for a binary model or a list), in pure Python
+    if not isinstance(decision,list):
+        if ovr:
+            proba=1.0/(1.0+math.exp(-decision))
+            return [1.0-proba,proba]
+        decision=[-decision,decision]
+    elif ovr:
+        proba=[1.0/(1.0+math.exp(-value)) for value in decision]
+        total=sum(proba)
+        return [value/total for value in proba]
+    top=max(decision)
+    proba=[math.exp(value-top) for value in decision]
+    total=sum(proba)
+    return [value/total for value in proba]
+
+class LinearEngine(object): #### Scores of the EMBL and EMBL-sites models without sklearn
+    """This class computes the probabilities of the EMBL model and of the EMBL-sites model from arrays exported from the fitted models
+    Description :
+            Both models are a LogisticRegression on the l2 normalized TF-IDF of the words of a TfidfVectorizer, with the same preprocessing and tokenization.
+            The vocabularies of both vectorizers are merged in one dictionary giving the row of each word in the arrays : its idf in each vectorizer (0 if it is not
+            in the vocabulary of a vectorizer) and its coefficients in the EMBL model (first column) and in each class of the EMBL-sites model (next columns).
+            A string is tokenized once, its words are counted and the TF-IDF of each model, its norm and the decision functions are computed on the rows of these words only,
+            so nothing is done for the words outside of the vocabularies and no sparse matrix is built. The probabilities are the ones of predict_proba()
+            (see the parity check in MAIN).
+            The arrays are saved in a numpy .npz file by save() and load() exports them again when the models change.
+    Args :
+            arrays (dict) :
+                    The arrays of the engine (see export())
+    """
+    def __init__(self,arrays):
+        self.version=str(arrays["version"])
+        self.words=arrays["words"]
+        self.idf=arrays["idf"]
+        self.coef=arrays["coef"]
+        self.intercept_EMBL=float(arrays["intercept_EMBL"])
+        self.intercept_sites=arrays["intercept_sites"]
+        self.ovr_EMBL=bool(arrays["ovr_EMBL"])
+        self.ovr_sites=bool(arrays["ovr_sites"])
+        self.lowercase=bool(arrays["lowercase"])
+        self.strip_accents={"":None,"ascii":strip_accents_ascii,"unicode":strip_accents_unicode}[str(arrays["strip_accents"])]
+        self.token_regex=re.compile(str(arrays["token_pattern"]))
+        self.vocabulary={word:row for row,word in enumerate(self.words.tolist())}
+        self.table=[(idf[0],idf[1],coef[0],coef[1:]) for idf,coef in zip(self.idf.tolist(),self.coef.tolist())] # Rows as Python floats for decision()
+        self.intercept_sites_list=self.intercept_sites.tolist()
+
+    @staticmethod
+    def export(vectorizer_EMBL,clf_EMBL,vectorizer_sites,clf_sites,version=None): #### Arrays of the engine of fitted models
+        """This function will export the vocabularies, idf and coefficients of the fitted models in arrays
+        Args :
+                vectorizer_EMBL (TfidfVectorizer) :
+                        The vectorizer of the EMBL model
+                clf_EMBL (LogisticRegression) :
+                        The EMBL model (binary)
+                vectorizer_sites (TfidfVectorizer) :
+                        The vectorizer of the EMBL-sites model
+                clf_sites (LogisticRegression) :
+                        The EMBL-sites model
+                version (str) :
+                        The version of the models (e.g. the hash of their files)
+        Return :
+                arrays (dict) :
+                        The arrays of LinearEngine()
+        Raises :
+                ValueError :
+                        The models can not be exported, or the probabilities of the exported engine differ from predict_proba() on the probes (see check())
+        """
+        for vectorizer in (vectorizer_EMBL,vectorizer_sites):
+            if vectorizer.analyzer!="word" or vectorizer.tokenizer is not None or vectorizer.preprocessor is not None or vectorizer.stop_words is not None \
+                    or tuple(vectorizer.ngram_range)!=(1,1) or vectorizer.norm!="l2" or vectorizer.binary or vectorizer.sublinear_tf or not vectorizer.use_idf \
+                    or vectorizer.strip_accents not in (None,"ascii","unicode"):
+                raise ValueError("Only the TF-IDF of the words with the l2 norm can be exported: "+str(vectorizer))
+        for name in ("lowercase","strip_accents","token_pattern"):
+            if getattr(vectorizer_EMBL,name)!=getattr(vectorizer_sites,name):
+                raise ValueError("The vectorizers do not tokenize the same way ("+name+")")
+        if clf_EMBL.coef_.shape[0]!=1:
+            raise ValueError("The EMBL model is not binary")
+        words=sorted(set(vectorizer_EMBL.vocabulary_)|set(vectorizer_sites.vocabulary_))
+        rows={word:row for row,word in enumerate(words)}
+        idf=numpy.zeros((len(words),2))
+        coef=numpy.zeros((len(words),1+clf_sites.coef_.shape[0]))
+        for column,vectorizer,clf,columns in ((0,vectorizer_EMBL,clf_EMBL,slice(0,1)),(1,vectorizer_sites,clf_sites,slice(1,None))):
+            indices=numpy.array([rows[word] for word,index in sorted(vectorizer.vocabulary_.items(),key=lambda item: item[1])])
+            idf[indices,column]=vectorizer.idf_
+            coef[indices,columns]=numpy.asarray(clf.coef_).T
+        arrays={
+            "format":format,
+            "version":"" if version is None else version,
+            "words":numpy.array(words),
+            "idf":idf,
+            "coef":coef,
+            "intercept_EMBL":numpy.asarray(clf_EMBL.intercept_)[0],
+            "intercept_sites":numpy.array(clf_sites.intercept_),
+            "ovr_EMBL":is_ovr(clf_EMBL),
+            "ovr_sites":is_ovr(clf_sites),
+            "lowercase":vectorizer_EMBL.lowercase,
+            "strip_accents":vectorizer_EMBL.strip_accents or "",
+            "token_pattern":vectorizer_EMBL.token_pattern}
+        LinearEngine(arrays).check(vectorizer_EMBL,clf_EMBL,vectorizer_sites,clf_sites)
+        return arrays
+
+    def check(self,vectorizer_EMBL,clf_EMBL,vectorizer_sites,clf_sites): #### Raise a ValueError if the probabilities differ from predict_proba() on the probes
+        """This function will compare the probabilities of the engine with the ones of the sklearn models
+        Description :
+                The formula of the probabilities (one-vs-rest or softmax, see is_ovr()) is chosen from the attributes of the models, which another version of sklearn
+                may read differently : the probes (and strings of words taken across both vocabularies) are computed by the engine, in batch and one by one,
+                and by predict_proba(), so an engine which does not give the probabilities of the models is never used.
+        """
+        words=self.words.tolist()
+        requests=probes+[" ".join(words[start::max(1,len(words)//20)]) for start in range(0,len(words),max(1,len(words)//5))]
+        expected_EMBL=clf_EMBL.predict_proba(vectorizer_EMBL.transform(requests))
+        expected_sites=clf_sites.predict_proba(vectorizer_sites.transform(requests))
+        y_pred,y_pred_site=self.predict_proba(requests)
+        single=[self.predict_proba([request]) for request in requests[:2]]
+        errors=[
+            numpy.abs(y_pred-expected_EMBL).max(),
+            numpy.abs(y_pred_site-expected_sites).max(),
+            max(numpy.abs(proba[0][0]-expected_EMBL[row]).max() for row,proba in enumerate(single)),
+            max(numpy.abs(proba[1][0]-expected_sites[row]).max() for row,proba in enumerate(single))]
+        if max(errors)>tolerance:
+            raise ValueError("The probabilities of the engine differ from predict_proba() by "+str(max(errors))+", the formula of the models is not the one of is_ovr()")
+
+    def counts(self,request): #### Row of each word of the vocabularies in a string and its number of occurrences
+        if self.lowercase:
+            request=request.lower()
+        if self.strip_accents is not None:
+            request=self.strip_accents(request)
+        counts={}
+        for word in self.token_regex.findall(request):
+            row=self.vocabulary.get(word)
+            if row is not None:
+                counts[row]=counts.get(row,0)+1
+        return counts
+
+    def decision(self,request,sites=True): #### Decision functions of the EMBL model and of the EMBL-sites model (None if sites is False) for one string, in pure Python
+        rows=[(count*self.table[row][0],count*self.table[row][1],self.table[row]) for row,count in self.counts(request).items()]
+        norm_EMBL=math.sqrt(sum(tfidf_EMBL*tfidf_EMBL for tfidf_EMBL,tfidf_sites,row in rows)) or 1.0
+        decision_EMBL=sum(tfidf_EMBL/norm_EMBL*row[2] for tfidf_EMBL,tfidf_sites,row in rows)+self.intercept_EMBL
+        if not sites:
+            return decision_EMBL,None
+        norm_sites=math.sqrt(sum(tfidf_sites*tfidf_sites for tfidf_EMBL,tfidf_sites,row in rows)) or 1.0
+        decision_sites=list(self.intercept_sites_list)
+        for tfidf_EMBL,tfidf_sites,row in rows:
+            if tfidf_sites:
+                tfidf_sites/=norm_sites
+                for column,coef in enumerate(row[3]):
+                    decision_sites[column]+=tfidf_sites*coef
+        return decision_EMBL,decision_sites
+
+    def predict_proba(self,requests,sites=True): #### Probabilities of the EMBL model and of the EMBL-sites model for a list of strings
+        """This function will compute the probabilities of both models for a list of strings
+        Description :
+                The words of every string are put end to end (rows and counts) and the TF-IDF, the norms and the decision functions of all the strings are computed
+                at once, the sums over the words of each string being done by numpy.bincount(). One string is computed by decision(), without the overhead of numpy.
+        Args :
+                requests (list-str) :
+                        A list of prepared strings
+                sites (boolean) :
+                        If False the EMBL-sites model is not computed
+        Return :
+                y_pred (numpy.array) :
+                        The probabilities of the EMBL model, as EMBL_ID_clf.predict_proba(EMBL_ID_Vecto.transform(requests)), shape (n, 2)
+                y_pred_site (numpy.array) :
+                        The probabilities of the EMBL-sites model, as EMBL_Sites_ID_clfLR.predict_proba(EMBL_Sites_ID_Vecto.transform(requests)), shape (n, sites) (None if sites is False)
+        """
+        if len(requests)==1:
+            decision_EMBL,decision_sites=self.decision(requests[0],sites)
+            y_pred=numpy.array([probabilities_list(decision_EMBL,self.ovr_EMBL)])
+            return y_pred,(numpy.array([probabilities_list(decision_sites,self.ovr_sites)]) if sites else None)
+        rows=[]
+        counts=[]
+        lengths=[]
+        for request in requests:
+            words=self.counts(request)
+            rows+=words.keys()
+            counts+=words.values()
+            lengths.append(len(words))
+        n=len(lengths)
+        rows=numpy.array(rows,dtype=numpy.intp)
+        documents=numpy.repeat(numpy.arange(n),lengths)
+        tfidf=numpy.array(counts,dtype=numpy.float64).reshape((-1,1))*self.idf[rows]
+        norms=numpy.sqrt(numpy.column_stack([numpy.bincount(documents,weights=tfidf[:,column]*tfidf[:,column],minlength=n) for column in (0,1)]))
+        norms[norms==0]=1.0
+        tfidf/=norms[documents]
+        coef=self.coef[rows]
+        y_pred=probabilities(numpy.bincount(documents,weights=tfidf[:,0]*coef[:,0],minlength=n)+self.intercept_EMBL,self.ovr_EMBL)
+        if not sites:
+            return y_pred,None
+        decision_sites=numpy.column_stack([numpy.bincount(documents,weights=tfidf[:,1]*coef[:,column],minlength=n) for column in range(1,coef.shape[1])])
+        return y_pred,probabilities(decision_sites+self.intercept_sites,self.ovr_sites)
+
+    def save(self,path): #### Save the arrays of the engine in a .npz file
+        directory=os.path.dirname(path)
+        if directory:
+            os.makedirs(directory,exist_ok=True)
+        temporary=path+"."+str(os.getpid())+".tmp.npz"
+        numpy.savez(temporary,**self.arrays())
+        os.replace(temporary,path)
+
+    def arrays(self): #### Arrays of the engine (see export())
+        return {
+            "format":format,
+            "version":self.version,
+            "words":self.words,
+            "idf":self.idf,
+            "coef":self.coef,
+            "intercept_EMBL":self.intercept_EMBL,
+            "intercept_sites":self.intercept_sites,
+            "ovr_EMBL":self.ovr_EMBL,
+            "ovr_sites":self.ovr_sites,
+            "lowercase":self.lowercase,
+            "strip_accents":{None:"",strip_accents_ascii:"ascii",strip_accents_unicode:"unicode"}[self.strip_accents],
+            "token_pattern":self.token_regex.pattern}
+
+    @staticmethod
+    def load(path,version,build): #### Load a saved engine, export and save it if it is missing or of another version
+        """This function will load the engine saved in path or build it
+        Args :
+                path (str) :
+                        The .npz file of the engine (None to always build it)
+                version (str) :
+                        The version expected (e.g. the hash of the model files)
+                build (function) :
+                        A function without argument returning the arrays of a new engine (see export())
+        Return :
+                engine (LinearEngine) :
+                        The engine
+        """
+        if path is not None and os.path.exists(path):
+            try:
+                with numpy.load(path) as saved:
+                    arrays={name:saved[name] for name in saved.files}
+                if int(arrays.get("format",-1))==format and str(arrays["version"])==version:
+                    return LinearEngine(arrays)
+            except (IOError,OSError,ValueError,KeyError):
+                pass
+        engine=LinearEngine(build())
+        if path is not None:
+            engine.save(path)
+        return engine
+
+#############################                   MAIN                   #############################
+
+if __name__=='__main__': # Parity check with the sklearn models and micro-benchmark on the affiliations of the previous searches
+    import corpus
+    import detect_EMBL
+    detect_EMBL.load_models()
+    affiliations=detect_EMBL.normalizer.batch(corpus.searches_affiliations())
+    engine=LinearEngine(LinearEngine.export(detect_EMBL.EMBL_ID_Vecto,detect_EMBL.EMBL_ID_clf,detect_EMBL.EMBL_Sites_ID_Vecto,detect_EMBL.EMBL_Sites_ID_clfLR))
+    y_pred,y_pred_site=engine.predict_proba(affiliations)
+    expected=detect_EMBL.EMBL_ID_clf.predict_proba(detect_EMBL.EMBL_ID_Vecto.transform(affiliations))
+    expected_site=detect_EMBL.EMBL_Sites_ID_clfLR.predict_proba(detect_EMBL.EMBL_Sites_ID_Vecto.transform(affiliations))
+    difference=max(numpy.abs(y_pred-expected).max(),numpy.abs(y_pred_site-expected_site).max())
+    for aff,row,row_site in zip(affiliations,expected,expected_site): # One string per call
+        single,single_site=engine.predict_proba([aff])
+        difference=max(difference,numpy.abs(single[0]-row).max(),numpy.abs(single_site[0]-row_site).max())
+    print("Affiliations checked: "+str(len(affiliations)))
+    print("Maximum difference of the probabilities: "+str(difference))
+    print("Different sites: "+str(int((y_pred_site.argmax(axis=1)!=expected_site.argmax(axis=1)).sum())))
+    sample=affiliations[:2000]
+    for name,function in (
+            ("sklearn, one string per call",lambda: [(detect_EMBL.EMBL_ID_clf.predict_proba(detect_EMBL.EMBL_ID_Vecto.transform([aff])),
+                detect_EMBL.EMBL_Sites_ID_clfLR.predict_proba(detect_EMBL.EMBL_Sites_ID_Vecto.transform([aff]))) for aff in sample]),
+            ("LinearEngine, one string per call",lambda: [engine.predict_proba([aff]) for aff in sample]),
+            ("sklearn, batch",lambda: (detect_EMBL.EMBL_ID_clf.predict_proba(detect_EMBL.EMBL_ID_Vecto.transform(sample)),
+                detect_EMBL.EMBL_Sites_ID_clfLR.predict_proba(detect_EMBL.EMBL_Sites_ID_Vecto.transform(sample)))),
+            ("LinearEngine, batch",lambda: engine.predict_proba(sample))):
+        start=time.perf_counter()
+        function()
+        print(name+": "+str(round((time.perf_counter()-start)*1e6/len(sample),1))+" us per string")
+    if difference>1e-9:
+        raise SystemExit(1)
@@ -0,0 +1,316 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+# Client of the EuropePMC REST API used by detect_EMBL.py
+########################
+import json
+import multiprocessing
+import os
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests # (https://requests.readthedocs.io/)
+from requests.adapters import HTTPAdapter
+
+import instrumentation
+
+#############################                   VARIABLES                   #############################
+
+europepmc_url="https://www.ebi.ac.uk/europepmc/webservices/rest/"
+retry_status=(429,500,502,503,504) # HTTP status worth a retry
+
+#############################                   DEFINITIONS                   #############################
+
+class RateLimiter(object): #### Limit the number of requests per second
+    """This class spaces requests so that no more than rate requests are sent per second
+    Description :
+            The time of the next free slot is kept in a multiprocessing.Value, so the limit is shared with the processes started after the creation of the limiter
+            (the Pool workers of detect_EMBL.py). Each call to wait() takes the next slot and sleeps until it.
+    Args :
+            rate (float) :
+                    Maximum number of requests per second (None or 0 for no limit)
+            context (multiprocessing context) :
+                    The context of the processes sharing the limiter (e.g. multiprocessing.get_context("spawn")), the lock of a Value cannot be sent to processes of another start method
+    """
+    def __init__(self,rate,context=None):
+        self.rate=rate
+        self.next_slot=(context or multiprocessing).Value("d",0.0)
+
+    def wait(self):
+        if not self.rate:
+            return
+        with self.next_slot.get_lock():
+            now=time.time()
+            slot=max(now,self.next_slot.value)
+            self.next_slot.value=slot+1.0/self.rate
+        if slot>now:
+            time.sleep(slot-now)
+
+class EuropePMC(object): #### Pooled, rate limited and retried access to the EuropePMC REST API
+    """This class sends the requests of detect_EMBL.py to the EuropePMC REST API
+    Description :
+            Each thread of each process has its own keep-alive requests.Session. At most concurrency requests are sent at the same time by a process
+            and at most requests_per_second requests are sent per second by all the processes sharing the client. A request failing on a connection error,
+            a timeout or a status of retry_status is sent again up to retries times after a jittered exponential backoff (or the Retry-After header).
+            search() follows the cursorMark of the responses so every result is returned even when there are more than page_size results.
+    Args :
+            url (str) :
+                    Base URL of the REST API (e.g. the URL of stub_europepmc.StubServer for offline runs)
+            concurrency (int) :
+                    Maximum number of requests sent at the same time by a process
+            requests_per_second (float) :
+                    Maximum number of requests per second (None for no limit)
+            timeout (float) :
+                    Timeout in seconds of the connection and of each read
+            retries (int) :
+                    Number of retries of a failing request
+            backoff (float) :
+                    Base of the backoff in seconds, the n-th retry waits a random time between 0 and backoff*2**n (at most max_backoff)
+            max_backoff (float) :
+                    Maximum backoff in seconds
+            page_size (int) :
+                    Number of results per page (1000 at most for EuropePMC)
+    """
+    def __init__(self,url=europepmc_url,concurrency=4,requests_per_second=10,timeout=60,retries=5,backoff=0.5,max_backoff=30,page_size=1000):
+        self.url=url if url.endswith("/") else url+"/"
+        self.concurrency=concurrency
+        self.timeout=timeout
+        self.retries=retries
+        self.backoff=backoff
+        self.max_backoff=max_backoff
+        self.page_size=page_size
+        self.limiter=RateLimiter(requests_per_second)
+        self._local=threading.local()
+        self._slots=None
+        self._pid=None
+        self._lock=threading.Lock()
+
+    def __getstate__(self): # Sent to the spawned workers without the sessions and the locks
+        state=dict(self.__dict__)
+        for name in ("_local","_slots","_pid","_lock"):
+            del state[name]
+        return state
+
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self._local=threading.local()
+        self._slots=None
+        self._pid=None
+        self._lock=threading.Lock()
+
+    def session(self): #### Session of the current thread of the current process
+        if getattr(self._local,"pid",None)!=os.getpid():
+            session=requests.Session()
+            adapter=HTTPAdapter(pool_connections=1,pool_maxsize=self.concurrency,max_retries=0)
+            session.mount("http://",adapter)
+            session.mount("https://",adapter)
+            self._local.session=session
+            self._local.pid=os.getpid()
+        return self._local.session
+
+    def slots(self): #### Semaphore of the concurrent requests of the current process
+        with self._lock:
+            if self._pid!=os.getpid():
+                self._slots=threading.BoundedSemaphore(self.concurrency)
+                self._pid=os.getpid()
+        return self._slots
+
+    def request(self,method,path,stats=None,**kwargs): #### Send a request and return the decoded JSON of the response
+        """This function will send a request to the REST API, retrying it if it fails, and return the decoded JSON
+        Args :
+                method (str) :
+                        "GET" or "POST"
+                path (str) :
+                        Path of the endpoint after the base URL (e.g. "searchPOST")
+                stats (dict) :
+                        If given, the number of responses received ("requests") and their size ("bytes") are added to it
+                kwargs :
+                        Arguments of requests.Session.request (params, data...)
+        Return :
+                response (dict) :
+                        The decoded JSON response
+        """
+        attempt=0
+        while True:
+            wait=None
+            self.limiter.wait()
+            with self.slots():
+                start=time.perf_counter()
+                try:
+                    req=self.session().request(method,self.url+path,timeout=self.timeout,**kwargs)
+                    instrumentation.record_request(method,path,req.status_code,time.perf_counter()-start,len(req.content))
+                    if req.status_code not in retry_status:
+                        req.raise_for_status()
+                        if stats is not None:
+                            stats["requests"]=stats.get("requests",0)+1
+                            stats["bytes"]=stats.get("bytes",0)+len(req.content)
+                        return json.loads(req.text)
+                    error=requests.HTTPError(str(req.status_code)+" "+req.reason+" for url: "+req.url,response=req)
+                    retry_after=req.headers.get("Retry-After","")
+                    if retry_after.isdigit():
+                        wait=min(float(retry_after),self.max_backoff)
+                except (requests.ConnectionError,requests.Timeout) as exception:
+                    instrumentation.record_request(method,path,None,time.perf_counter()-start,0)
+                    error=exception
+                except ValueError as exception:
+                    error=exception
+            if attempt>=self.retries:
+                raise error
+            if wait is None:
+                wait=random.uniform(0,min(self.max_backoff,self.backoff*2**attempt))
+            time.sleep(wait)
+            attempt+=1
+
+    def search(self,query,result_type="core",stats=None): #### Results of a query, following the cursorMark
+        """This function will return every result of a query
+        Description :
+                Here the function sends the query to searchPOST with the cursorMark "*", then with the nextCursorMark of each response
+                until every result of the hitCount has been received or the cursor does not move anymore.
+        Args :
+                query (str) :
+                        A EuropePMC query (e.g. "EXT_ID:24929366 OR EXT_ID:28316114")
+                result_type (str) :
+                        The result type ("core" to get the author lists)
+                stats (dict) :
+                        If given, the number of pages and their size are added to it (see request())
+        Return :
+                results (list-dict) :
+                        Every result of the query
+        """
+        results=[]
+        cursor="*"
+        while True:
+            response=self.request("POST","searchPOST",stats=stats,data={
+                "query":query,
+                "resultType":result_type,
+                "pageSize":self.page_size,
+                "format":"json",
+                "cursorMark":cursor})
+            page=response.get("resultList",{}).get("result",[])
+            results+=page
+            next_cursor=response.get("nextCursorMark")
+            if not page or not next_cursor or next_cursor==cursor or len(results)>=int(response.get("hitCount",0)):
+                return results
+            cursor=next_cursor
+
+    def query(self,query,result_type="core"): #### First page of the response to a query (GET search)
+        return self.request("GET","search",params={
+            "query":query,
+            "resultType":result_type,
+            "format":"json"})
+
+    def search_pmids(self,pmids,result_type="core",stats=None): #### Results of a list of PMIDs
+        return self.search("EXT_ID:"+" OR EXT_ID:".join(str(pmid) for pmid in pmids),result_type=result_type,stats=stats)
+
+    def map(self,function,items): #### Apply function to each item with concurrency threads, results in the order of items
+        with ThreadPoolExecutor(max_workers=self.concurrency) as executor:
+            for result in executor.map(function,items):
+                yield result
+
+class AdaptiveBatcher(object): #### Queries of PMIDs sized from the time and the size of the previous responses
+    """This class splits a list of PMIDs in queries (see EuropePMC.search_pmids()) whose size follows the speed of EuropePMC
+    Description :
+            The size of the next queries is tuned after each response : it is the number of PMIDs of the query times the smallest of target_seconds/seconds
+            and target_bytes/bytes, at most twice and at least half the current size, between min_size and max_size. A query failing after the retries
+            of the client because of its size (see size_failure() : a 413 or 414 status, a 5xx status to a query of at least large_query bytes, or a response
+            which can not be decoded) halves the size and is sent again as two queries of half its PMIDs, down to one PMID : the PMIDs of a query of one PMID
+            still failing are returned as failed, the other queries go on. The other failures (connection errors, timeouts, other statuses) are raised,
+            smaller queries would not help.
+            The size is kept by the process, so the queries of the next chunks start from it.
+    Args :
+            size (int) :
+                    The number of PMIDs of the first queries
+            min_size (int) :
+                    The minimum number of PMIDs per query when tuned
+            max_size (int) :
+                    The maximum number of PMIDs per query
+            target_seconds (float) :
+                    The time of a response aimed at
+            target_bytes (int) :
+                    The size of a response aimed at
+            large_query (int) :
+                    The size in bytes of the body of a query from which a 5xx status is taken as caused by its size
+    """
+    def __init__(self,size=250,min_size=10,max_size=1000,target_seconds=5.0,target_bytes=8*2**20,large_query=4*2**10):
+        self.size=size
+        self.min_size=min_size
+        self.max_size=max_size
+        self.target_seconds=target_seconds
+        self.target_bytes=target_bytes
+        self.large_query=large_query
+        self._lock=threading.Lock()
+
+    def __getstate__(self): # Sent to the spawned workers without the lock
+        state=dict(self.__dict__)
+        del state["_lock"]
+        return state
+
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self._lock=threading.Lock()
+
+    def tune(self,count,seconds,size): #### New size after a response of size bytes to a query of count PMIDs in seconds
+        ratio=min(self.target_seconds/max(seconds,1e-3),self.target_bytes/max(size,1))
+        with self._lock:
+            self.size=int(min(self.max_size,max(self.min_size,self.size/2.0,min(self.size*2.0,count*ratio))))
+
+    def size_failure(self,exception): #### True if a query failed because of its size, so it is worth splitting it
+        if isinstance(exception,(requests.ConnectionError,requests.Timeout)):
+            return False
+        if isinstance(exception,requests.HTTPError):
+            response=exception.response
+            if response is None:
+                return False
+            body=response.request.body if response.request is not None else None
+            return response.status_code in (413,414) or (response.status_code>=500 and len(body or "")>=self.large_query)
+        return isinstance(exception,ValueError) # Response cut or not JSON
+
+    def fetch(self,client,pmids,result_type="core"): #### Results of a list of PMIDs, in queries of the current size sent at the same time
+        """This function will return the EuropePMC results of a list of PMIDs and the PMIDs whose queries failed
+        Args :
+                client (EuropePMC) :
+                        The client sending the queries (at most client.concurrency at the same time)
+                pmids (list-str) :
+                        The PMIDs
+                result_type (str) :
+                        The result type ("core" to get the author lists)
+        Return :
+                results (list-dict) :
+                        The results received, a PMID unknown of EuropePMC has no result
+                failed (list-str) :
+                        The PMIDs whose query failed even alone
+        Raises :
+                requests.RequestException :
+                        A query failed for another reason than its size (see size_failure())
+        """
+        size=self.size
+        batches=[pmids[i:i+size] for i in range(0,len(pmids),size)]
+        results=[]
+        failed=[]
+        for batch_results,batch_failed in client.map(lambda batch: self.fetch_batch(client,batch,result_type),batches):
+            results+=batch_results
+            failed+=batch_failed
+        return results,failed
+
+    def fetch_batch(self,client,pmids,result_type="core"): #### Results of one query, split in halves while it fails because of its size
+        stats={}
+        start=time.perf_counter()
+        try:
+            results=client.search_pmids(pmids,result_type=result_type,stats=stats)
+        except (requests.RequestException,ValueError) as exception:
+            instrumentation.count("EuropePMC failed queries")
+            if not self.size_failure(exception):
+                raise
+            with self._lock:
+                self.size=max(1,min(self.size,len(pmids))//2)
+            if len(pmids)==1:
+                return [],list(pmids)
+            half=len(pmids)//2
+            first_results,first_failed=self.fetch_batch(client,pmids[:half],result_type)
+            second_results,second_failed=self.fetch_batch(client,pmids[half:],result_type)
+            return first_results+second_results,first_failed+second_failed
+        self.tune(len(pmids),time.perf_counter()-start,stats.get("bytes",0))
+        instrumentation.count("EuropePMC queries")
+        instrumentation.count("EuropePMC queried PMIDs",len(pmids))
+        return results,[]
@@ -0,0 +1,203 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+# Indexed gazetteer of countries and cities used by detect_EMBL.py
+########################
+import json
+import os
+import re
+import string
+
+#############################                   VARIABLES                   #############################
+
+token_regex=re.compile(r'[a-zA-Z0-9]+') # Words of the mentions, the boundaries of the regexes of extract_geoloc_from() are [^a-zA-Z0-9]
+alnum=set(string.ascii_letters+string.digits)
+magic=b"GAZETTEER\n" # First line of the saved gazetteers, followed by a line of JSON (format, version, sizes of the tables) and the tables
+
+#############################                   DEFINITIONS                   #############################
+
+class Gazetteer(object): #### Sets of names and a matcher of every name in one pass
+    """This class indexes the names of countries, cities and abbreviations of countries
+    Description :
+            The names are kept in sets and dictionaries for the exact lookups of extract_geoloc_from(). Every name is also added to a trie of words : mentions() reads
+            the words of a string once and, from each word, follows the trie to find every name starting there, so all the names of the gazetteer mentioned in the string
+            are found in one pass whatever their number. As the regexes of extract_geoloc_from(), a mention is only found between two characters that are not [a-zA-Z0-9]
+            (or the start and end of the string). Names without any [a-zA-Z0-9] character are only in the sets. The trie of a kind of names is built the first time
+            this kind is searched (detect_EMBL.py only searches the abbreviations and the ISO codes, never the trie of the cities).
+            The gazetteer is built from the tables of load_geonames() and save() writes its tables in one compact file, load() reads them back with one read of the file
+            (the names end in sets and dictionaries anyway, so a memory mapping would not be shared) and rebuilds the gazetteer when the version of the saved file is not
+            the expected one.
+    Args :
+            countries (list-str) :
+                    Names of the countries
+            cities (list-str) :
+                    Names of the cities
+            iso2 (dict) :
+                    A dictionary with the ISO 3166 alpha-2 code of each country as key and its name as value
+            iso3 (dict) :
+                    A dictionary with the ISO 3166 alpha-3 code of each country as key and its name as value
+            abrevs (dict) :
+                    A dictionary with abbreviations of countries as key and the name of the country as value (e.g. detect_EMBL.abrevs)
+            version (str) :
+                    The version of the tables (e.g. the version of geonamescache)
+    """
+    format=3 # Version of the structure of the saved gazetteers, the saved gazetteers of another format are built again
+
+    def __init__(self,countries,cities,iso2,iso3,abrevs,version=None):
+        self.version=version
+        self.countries=set(countries)
+        self.cities=set(cities)
+        self.iso2=dict(iso2)
+        self.iso3=dict(iso3)
+        self.abrevs=list(abrevs.items())
+        self.tries={} # Trie of each kind and of every kind (None), built by trie() : {first word : {(words...): [(name, kind, characters before the first word, characters after the last word)...]}}
+        self.longest={} # Number of words of the longest name of each trie
+        self.lowered_countries=sorted(set(name.lower() for name in self.countries)) # See may_mention_country()
+        self._counters={} # Compiled regexes of count()
+
+    def names(self,kind): #### Names of a kind (country, city, iso2, iso3, abbreviation)
+        return {"country":self.countries,"city":self.cities,"iso2":self.iso2,"iso3":self.iso3,"abbreviation":[abrev for abrev,name in self.abrevs]}[kind]
+
+    def trie(self,kind=None): #### Trie of a kind of names (None for every kind), built on first use
+        if kind not in self.tries:
+            trie={}
+            for name_kind in ([kind] if kind is not None else ["country","city","iso2","iso3","abbreviation"]):
+                for name in self.names(name_kind):
+                    matches=list(token_regex.finditer(name))
+                    if matches:
+                        words=tuple(match.group() for match in matches)
+                        trie.setdefault(words[0],{}).setdefault(words,[]).append((name,name_kind,matches[0].start(),len(name)-matches[-1].end()))
+            self.longest[kind]=max([len(words) for phrases in trie.values() for words in phrases]+[1])
+            self.tries[kind]=trie
+        return self.tries[kind]
+
+    def mentions(self,request,kind=None): #### Every name of the gazetteer mentioned in a string
+        """This function will find every name of the gazetteer mentioned in a string, in one pass over its words
+        Args :
+                request (str) :
+                        A string
+                kind (str) :
+                        The kind of names wanted (country, city, iso2, iso3, abbreviation), None for every kind
+        Return :
+                mentions (list-tuple) :
+                        A list of (start, end, name, kind) in the order of the string, with request[start:end]==name
+        """
+        trie=self.trie(kind)
+        words=token_regex.findall(request)
+        firsts=[i for i,word in enumerate(words) if word in trie]
+        if not firsts:
+            return []
+        spans=[match.span() for match in token_regex.finditer(request)]
+        mentions=[]
+        for i in firsts:
+            phrases=trie[words[i]]
+            for length in range(1,min(self.longest[kind],len(words)-i)+1):
+                candidates=phrases.get(tuple(words[i:i+length]))
+                if candidates is None:
+                    continue
+                for name,name_kind,lead,trail in candidates:
+                    begin=spans[i][0]-lead
+                    stop=spans[i+length-1][1]+trail
+                    if begin<0 or (begin==0 and stop==len(request)) or request[begin:stop]!=name: # The regexes need at least one character around the mention
+                        continue
+                    if (begin>0 and request[begin-1] in alnum) or (stop<len(request) and request[stop] in alnum):
+                        continue
+                    mentions.append((begin,stop,name,name_kind))
+        return mentions
+
+    def codes(self,request,kind="abbreviation"): #### Abbreviations (or ISO codes) of countries mentioned in a string and their country, in the order of their dictionary
+        found=set(name for start,stop,name,_ in self.mentions(request,kind))
+        codes={"abbreviation":self.abrevs,"iso2":self.iso2.items(),"iso3":self.iso3.items()}[kind]
+        return [(code,name) for code,name in codes if code in found]
+
+    def may_mention_country(self,request): #### False if no country can be found in a string by the NER of extract_geoloc_from()
+        """This function will tell if the spaCy entities of a string can change the countries found by extract_geoloc_from() (default arguments)
+        Description :
+                extract_geoloc_from() only keeps the entities made of [0-9a-zA-Z\\s] and equal to a country name, up to the case (as is, capitalized, title case or one of their words).
+                Such an entity can only exist if the lowered string contains a lowered country name, when it does not the result is the same without the NER.
+        Args :
+                request (str) :
+                        A string
+        Return :
+                may (boolean) :
+                        True if a country name is in the lowered string
+        """
+        lowered=request.lower()
+        return any(name in lowered for name in self.lowered_countries)
+
+    def count(self,request,mention): #### Number of mentions as counted by the regex of extract_geoloc_from()
+        if mention not in self._counters:
+            self._counters[mention]=re.compile(r'^'+mention+'[^a-zA-Z0-9]|[^a-zA-Z0-9]'+mention+'[^a-zA-Z0-9]|[^a-zA-Z0-9]'+mention+'$')
+        return len(self._counters[mention].findall(request))
+
+    def save(self,path): #### Save the tables of the gazetteer in one file
+        """This function will write the tables of the gazetteer in path, in a temporary file renamed at the end
+        Description :
+                The file starts with magic, then a line of JSON with the format, the version and the number of names of each table, then the names of the tables
+                in UTF-8, one per line (a code and its country separated by a tab for the dictionaries). The tries are not saved, they are built on first use.
+        Args :
+                path (str) :
+                        The file of the gazetteer
+        """
+        tables=[
+            ("countries",sorted(self.countries)),
+            ("cities",sorted(self.cities)),
+            ("iso2",[code+"\t"+name for code,name in self.iso2.items()]),
+            ("iso3",[code+"\t"+name for code,name in self.iso3.items()]),
+            ("abrevs",[abrev+"\t"+name for abrev,name in self.abrevs])]
+        for table,lines in tables:
+            if any("\n" in line or line.count("\t")>int(table in ("iso2","iso3","abrevs")) for line in lines):
+                raise ValueError("A name of the table "+table+" contains a new line or a tab")
+        header={"format":Gazetteer.format,"version":self.version,"sizes":[[table,len(lines)] for table,lines in tables]}
+        directory=os.path.dirname(path)
+        if directory:
+            os.makedirs(directory,exist_ok=True)
+        temporary=path+"."+str(os.getpid())+".tmp"
+        with open(temporary,"wb") as f:
+            f.write(magic+json.dumps(header).encode("utf-8")+b"\n")
+            f.write("\n".join("\n".join(lines) for table,lines in tables if lines).encode("utf-8"))
+        os.replace(temporary,path)
+
+    @staticmethod
+    def read(path): #### Header and gazetteer of a file written by save(), the gazetteer is None if the file has another format
+        with open(path,"rb") as f:
+            data=f.read()
+        if not data.startswith(magic):
+            return None,None
+        end=data.index(b"\n",len(magic))
+        header=json.loads(data[len(magic):end].decode("utf-8"))
+        if header.get("format")!=Gazetteer.format:
+            return header,None
+        lines=data[end+1:].decode("utf-8").split("\n")
+        tables={}
+        start=0
+        for table,size in header["sizes"]:
+            tables[table]=lines[start:start+size]
+            start+=size
+        pairs={table:dict(line.split("\t") for line in tables[table]) for table in ("iso2","iso3","abrevs")}
+        return header,Gazetteer(tables["countries"],tables["cities"],pairs["iso2"],pairs["iso3"],pairs["abrevs"],version=header["version"])
+
+    @staticmethod
+    def load(path,version,build): #### Load a saved gazetteer, build and save it if it is missing or of another version
+        """This function will load the gazetteer saved in path or build it
+        Args :
+                path (str) :
+                        The file of the gazetteer (None to always build it)
+                version (str) :
+                        The version expected
+                build (function) :
+                        A function without argument returning a new Gazetteer
+        Return :
+                gazetteer (Gazetteer) :
+                        The gazetteer
+        """
+        if path is not None and os.path.exists(path):
+            try:
+                header,gazetteer=Gazetteer.read(path)
+                if gazetteer is not None and gazetteer.version==version:
+                    return gazetteer
+            except (ValueError,KeyError,TypeError,UnicodeDecodeError):
+                pass
+        gazetteer=build()
+        if path is not None:
+            gazetteer.save(path)
+        return gazetteer
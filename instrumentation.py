@@ -0,0 +1,149 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+# Per-stage timers and counters of detect_EMBL.py
+########################
+import json
+import threading
+import time
+
+import numpy
+
+#############################                   VARIABLES                   #############################
+
+enabled=False # Nothing is recorded when False (default), see enable()
+stats=None # Stats of the current process
+lock=threading.Lock() # The HTTP requests are sent by threads
+depths=threading.local() # Current depth of each recursion of the current thread
+
+#############################                   DEFINITIONS                   #############################
+
+def new_stats(): #### Empty stats
+    return {"processes":1,"stages":{},"counters":{},"requests":[]}
+
+def enable(on=True): #### Start (or stop) recording in the current process, from empty stats (a forked worker does not keep the stats of its parent)
+    global enabled,stats
+    enabled=on
+    stats=new_stats()
+
+class NullContext(object): #### Context doing nothing, returned when the instrumentation is off
+    def __enter__(self):
+        return self
+
+    def __exit__(self,*exc):
+        return False
+
+null=NullContext()
+
+class Timer(object): #### Context adding its wall and CPU time to a stage
+    def __init__(self,stage):
+        self.stage=stage
+
+    def __enter__(self):
+        self.wall=time.perf_counter()
+        self.cpu=time.process_time()
+        return self
+
+    def __exit__(self,*exc):
+        wall=time.perf_counter()-self.wall
+        cpu=time.process_time()-self.cpu
+        with lock:
+            stage=stats["stages"].setdefault(self.stage,{"calls":0,"wall":0.0,"cpu":0.0})
+            stage["calls"]+=1
+            stage["wall"]+=wall
+            stage["cpu"]+=cpu
+        return False
+
+class Recursion(object): #### Context counting the depth of a recursion
+    def __init__(self,name):
+        self.name=name
+
+    def __enter__(self):
+        depth=getattr(depths,self.name,0)+1
+        setattr(depths,self.name,depth)
+        count(self.name+" depth "+str(depth))
+        return self
+
+    def __exit__(self,*exc):
+        setattr(depths,self.name,getattr(depths,self.name)-1)
+        return False
+
+def timer(stage): #### with timer("stage"): adds the time of the block to the stage
+    return Timer(stage) if enabled else null
+
+def recursion(name): #### with recursion("name"): counts the calls of a recursive block by depth
+    return Recursion(name) if enabled else null
+
+def count(name,n=1): #### Add n to a counter
+    if enabled:
+        with lock:
+            stats["counters"][name]=stats["counters"].get(name,0)+n
+
+def record_request(method,url,status,seconds,size): #### Record an HTTP request (status None for a connection error or a timeout)
+    if enabled:
+        with lock:
+            stats["requests"].append({"method":method,"url":url,"status":status,"seconds":seconds,"bytes":size})
+
+def snapshot(): #### Stats of the current process (e.g. sent by a worker when it exits)
+    return stats if stats is not None else new_stats()
+
+def add(other): #### Add the stats of another process (a Pool worker) to the stats of the current process
+    global stats
+    if stats is None:
+        stats=new_stats()
+        stats["processes"]=0
+    with lock:
+        stats["processes"]+=other["processes"]
+        for name,stage in other["stages"].items():
+            total=stats["stages"].setdefault(name,{"calls":0,"wall":0.0,"cpu":0.0})
+            for key in total:
+                total[key]+=stage[key]
+        for name,value in other["counters"].items():
+            stats["counters"][name]=stats["counters"].get(name,0)+value
+        stats["requests"]+=other["requests"]
+
+def summary(stats): #### Aggregates of the stats : time per stage, counters and HTTP latency, bytes and status
+    """This function will summarize the stats of a run
+    Args :
+            stats (dict) :
+                    The stats of the run (see snapshot() and add())
+    Return :
+            summary (dict) :
+                    {
+                        "processes":...,
+                        "stages":{stage:{"calls":..., "wall":..., "cpu":...}},  (seconds, summed over the processes)
+                        "counters":{name:...},
+                        "http":{"requests":..., "bytes":..., "status":{status:...}, "p50_ms":..., "p99_ms":..., "max_ms":...}
+                    }
+    """
+    requests=stats["requests"]
+    latencies=[request["seconds"]*1000 for request in requests]
+    status={}
+    for request in requests:
+        status[str(request["status"])]=status.get(str(request["status"]),0)+1
+    return {
+        "processes":stats["processes"],
+        "stages":stats["stages"],
+        "counters":stats["counters"],
+        "http":{
+            "requests":len(requests),
+            "bytes":sum(request["bytes"] for request in requests),
+            "status":status,
+            "p50_ms":float(numpy.percentile(latencies,50)) if latencies else None,
+            "p99_ms":float(numpy.percentile(latencies,99)) if latencies else None,
+            "max_ms":max(latencies) if latencies else None}}
+
+def report(path=None): #### Print the summary of the stats of the current process and write them (summary and every request) in a JSON file
+    result=summary(snapshot())
+    print("Instrumentation ("+str(result["processes"])+" processes, times summed over the processes):")
+    for name,stage in sorted(result["stages"].items(),key=lambda item: -item[1]["wall"]):
+        print("    "+name+": "+str(stage["calls"])+" calls, "+str(round(stage["wall"],3))+" s wall, "+str(round(stage["cpu"],3))+" s CPU")
+    for name,value in sorted(result["counters"].items()):
+        print("    "+name+": "+str(value))
+    http=result["http"]
+    if http["requests"]:
+        print("    HTTP: "+str(http["requests"])+" requests "+str(http["status"])+", "+str(http["bytes"])+" bytes, latency p50 "+str(round(http["p50_ms"],1))
+            +" ms, p99 "+str(round(http["p99_ms"],1))+" ms, max "+str(round(http["max_ms"],1))+" ms")
+    if path is not None:
+        with open(path,"w",encoding="utf-8") as f:
+            json.dump({"summary":result,"requests":snapshot()["requests"]},f,indent=4)
+    return result
@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+# Journal of the chunks processed by detect_EMBL.py
+########################
+import hashlib
+import json
+import os
+
+#############################                   DEFINITIONS                   #############################
+
+def chunk_id(chunk): #### Identifier of a chunk of PMIDs
+    return hashlib.sha1(",".join(str(pmid) for pmid in chunk).encode("utf-8")).hexdigest()[:20]
+
+class Journal(object): #### JSONL file of the results of each chunk
+    """This class appends the results of each processed chunk to a JSONL file as soon as the chunk is done
+    Description :
+            Each line is the JSON of the results of one chunk with its identifier (see chunk_id()) and the version of the run (e.g. the hash of the models).
+            Lines are flushed to the disk when written, so after a crash a new run can skip the chunks already in the journal (done()) and
+            build the outputs from the journal (entries()). A last line cut by a crash is ignored, as well as lines of other versions. The outputs are only built
+            from the chunks of the current input (a journal left by a run on another list of PMIDs in the same directory holds other chunks), and once they are
+            written the journal is rotated (rotate()), so the next search in the directory starts from an empty journal.
+    Args :
+            path (str) :
+                    The JSONL file
+            version (str) :
+                    The version of the run, lines of other versions are ignored
+    """
+    def __init__(self,path,version):
+        self.path=path
+        self.version=version
+
+    def entries(self,chunks=None): #### Results of each chunk of the journal (first line of each chunk), only the chunks of the identifiers of chunks if given
+        if not os.path.exists(self.path):
+            return
+        met=set()
+        with open(self.path,"r",encoding="utf-8") as f:
+            for line in f:
+                try:
+                    entry=json.loads(line)
+                except ValueError:
+                    continue
+                if entry.get("version")==self.version and entry["chunk"] not in met and (chunks is None or entry["chunk"] in chunks):
+                    met.add(entry["chunk"])
+                    yield entry
+
+    def done(self): #### Identifiers of the chunks already in the journal
+        return set(entry["chunk"] for entry in self.entries())
+
+    def append(self,entry): #### Write the results of a chunk
+        entry=dict(entry,version=self.version)
+        line=json.dumps(entry,separators=(",",":"))+"\n"
+        if os.path.exists(self.path) and os.path.getsize(self.path)>0: # A line cut by a crash must not be continued
+            with open(self.path,"rb") as f:
+                f.seek(-1,os.SEEK_END)
+                if f.read(1)!=b"\n":
+                    line="\n"+line
+        with open(self.path,"a",encoding="utf-8") as f:
+            f.write(line)
+            f.flush()
+            os.fsync(f.fileno())
+
+    def rotate(self): #### Keep the journal of a finished search in path.previous (replacing the previous one), the next run starts from an empty journal
+        if os.path.exists(self.path):
+            os.replace(self.path,self.path+".previous")
+
+    def clear(self): #### Delete the journal
+        if os.path.exists(self.path):
+            os.remove(self.path)
@@ -0,0 +1,159 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+# Load test of service.py : concurrent clients asking a local service about the affiliations of the previous searches
+########################
+import argparse
+import http.client
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import numpy
+
+import benchmark
+
+#############################                   DEFINITIONS                   #############################
+
+class UnixHTTPConnection(http.client.HTTPConnection): #### HTTP connection over a Unix socket
+    def __init__(self,path,timeout=60):
+        http.client.HTTPConnection.__init__(self,"localhost",timeout=timeout)
+        self.path=path
+
+    def connect(self):
+        self.sock=socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+        self.sock.settimeout(self.timeout)
+        self.sock.connect(self.path)
+
+def connect(address): #### Connection to a service, address being its URL (http://host:port/) or the path of its Unix socket
+    if address.startswith("http://"):
+        host,port=address[len("http://"):].strip("/").split(":")
+        return http.client.HTTPConnection(host,int(port),timeout=60)
+    return UnixHTTPConnection(address)
+
+def call(connection,method,path,content=None): #### Status and JSON content of the answer of the service
+    body=json.dumps(content).encode("utf-8") if content is not None else None
+    connection.request(method,path,body=body,headers={"Content-Type":"application/json"} if body is not None else {})
+    response=connection.getresponse()
+    return response.status,json.loads(response.read().decode("utf-8"))
+
+def start_service(arguments,timeout=600): #### Start service.py in a new process, return the process and its address once it answers /health
+    script=os.path.join(os.path.dirname(os.path.abspath(__file__)),"service.py")
+    process=subprocess.Popen([sys.executable,script,"--port","0"]+list(arguments),stdout=subprocess.PIPE,universal_newlines=True)
+    line=process.stdout.readline()
+    if "serving on " not in line:
+        process.kill()
+        raise RuntimeError("The service did not start: "+line)
+    address=line.strip().split("serving on ",1)[1]
+    deadline=time.time()+timeout
+    while True:
+        try:
+            if call(connect(address),"GET","/health")[0]==200:
+                return process,address
+        except (OSError,http.client.HTTPException):
+            if time.time()>deadline:
+                process.kill()
+                raise
+        time.sleep(0.1)
+
+def load(address,affiliations,clients=16,requests=200,batch=1,kind="is_EMBL",seed=0): #### Send requests from concurrent clients and time them
+    """This function will send requests to a service from clients threads, each one with its own connection, and return the throughput and the latency seen by the clients
+    Args :
+            address (str) :
+                    The URL or the Unix socket of the service
+            affiliations (list-str) :
+                    The affiliations asked, taken at random
+            clients (int) :
+                    The number of clients sending their requests at the same time
+            requests (int) :
+                    The number of requests of each client, each one waiting for the answer of the previous one
+            batch (int) :
+                    The number of affiliations per request
+            kind (str) :
+                    is_EMBL or geoloc
+            seed (int) :
+                    Seed of the affiliations of each client
+    Return :
+            stats (dict) :
+                    {"requests":..., "items":..., "errors":..., "seconds":..., "items_per_second":..., "p50_ms":..., "p99_ms":...}
+    """
+    latencies=[[] for _ in range(clients)]
+    errors=[0]*clients
+    def client(number):
+        draw=random.Random(seed+number)
+        connection=connect(address)
+        for _ in range(requests):
+            sample=[draw.choice(affiliations) for _ in range(batch)]
+            start=time.perf_counter()
+            try:
+                status,content=call(connection,"POST","/"+kind,{"affiliations":sample})
+                if status!=200 or len(content["results"])!=batch:
+                    errors[number]+=1
+            except (OSError,http.client.HTTPException,ValueError):
+                errors[number]+=1
+                connection=connect(address)
+            latencies[number].append(time.perf_counter()-start)
+        connection.close()
+    threads=[threading.Thread(target=client,args=(number,)) for number in range(clients)]
+    start=time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    total=time.perf_counter()-start
+    every=[latency for latencies_client in latencies for latency in latencies_client]
+    return {
+        "requests":len(every),
+        "items":len(every)*batch,
+        "errors":sum(errors),
+        "seconds":total,
+        "items_per_second":len(every)*batch/total,
+        "p50_ms":float(numpy.percentile(every,50))*1000,
+        "p99_ms":float(numpy.percentile(every,99))*1000}
+
+def print_stats(name,stats,metrics): #### Print the stats of the clients and the metrics of the service
+    print(name+": "+str(stats["requests"])+" requests ("+str(stats["errors"])+" errors) in "+str(round(stats["seconds"],2))+" s, "+str(round(stats["items_per_second"],1))
+        +" affiliations/s, p50 "+str(round(stats["p50_ms"],2))+" ms, p99 "+str(round(stats["p99_ms"],2))+" ms")
+    for kind in ("is_EMBL","geoloc"):
+        if metrics[kind]["batches"]:
+            print("    service "+kind+": "+str(metrics[kind]["batches"])+" batches, mean size "+str(round(metrics[kind]["batch_size"]["mean"],1))+", max "
+                +str(int(metrics[kind]["batch_size"]["max"]))+", latency p50 "+str(round(metrics[kind]["latency_ms"]["p50"],2))+" ms, p99 "
+                +str(round(metrics[kind]["latency_ms"]["p99"],2))+" ms, inference p50 "+str(round(metrics[kind]["inference_ms"]["p50"],2))+" ms")
+
+#############################                   MAIN                   #############################
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser(description="Load test of service.py with the affiliations of the previous searches")
+    parser.add_argument("--address",help="URL (http://host:port/) or Unix socket of a running service (default: a new service is started for each --window-ms)")
+    parser.add_argument("--fixture",help="gzipped JSON file of the fixture of benchmark.py (default: built from the searches)")
+    parser.add_argument("--searches",default="./searches/",help="directory of the searches (default: %(default)s)")
+    parser.add_argument("--clients",type=int,default=16,help="number of concurrent clients (default: %(default)s)")
+    parser.add_argument("--requests",type=int,default=200,help="number of requests of each client (default: %(default)s)")
+    parser.add_argument("--batch",type=int,default=1,help="number of affiliations per request (default: %(default)s)")
+    parser.add_argument("--kind",choices=["is_EMBL","geoloc"],default="is_EMBL",help="endpoint of the requests (default: %(default)s)")
+    parser.add_argument("--window-ms",type=float,nargs="+",default=[0.0,2.0],help="windows of the micro-batches of the services started, one run per window (default: %(default)s)")
+    parser.add_argument("--max-batch",type=int,help="number of affiliations after which the batches of the started services are run without waiting (default: the one of service.py, 1 to run each request alone)")
+    parser.add_argument("--socket",help="serve the started services on this Unix socket instead of a free port")
+    parser.add_argument("--spacy-model",help="spacy model (name or path) of the started services")
+    parser.add_argument("--cache",action="store_true",help="let the started services use the verdict cache (default: every affiliation is predicted)")
+    args=parser.parse_args()
+    affiliations=benchmark.load_fixture(args.fixture,args.searches)["affiliations"]
+    print(str(len(affiliations))+" affiliations, "+str(args.clients)+" clients x "+str(args.requests)+" requests of "+str(args.batch)+" affiliations ("+args.kind+")")
+    runs=[(args.address,None)] if args.address else [(None,window) for window in args.window_ms]
+    for address,window in runs:
+        process=None
+        if address is None:
+            arguments=["--window-ms",str(window)]+(["--socket",args.socket] if args.socket else [])+(["--spacy-model",args.spacy_model] if args.spacy_model else [])+(["--max-batch",str(args.max_batch)] if args.max_batch else [])
+            process,address=start_service(arguments+([] if args.cache else ["--no-cache"]))
+        try:
+            stats=load(address,affiliations,args.clients,args.requests,args.batch,args.kind)
+            metrics=call(connect(address),"GET","/metrics")[1]
+        finally:
+            if process is not None:
+                process.terminate()
+                process.wait()
+        print_stats(address if window is None else "window "+str(window)+" ms",stats,metrics)
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+# Registry of the models and tables loaded by each process of detect_EMBL.py
+########################
+import hashlib
+import os
+import resource # Used to read the peak memory of a process (https://docs.python.org/3/library/resource.html)
+import time
+
+import joblib # (https://joblib.readthedocs.io/en/latest/)
+
+#############################                   DEFINITIONS                   #############################
+
+def mmap_copy(path,mmap_dir): #### Uncompressed copy of a joblib file that can be memory mapped
+    """This function will write (once) an uncompressed copy of a joblib file in mmap_dir and return its path
+    Description :
+            joblib can only memory map the numpy arrays of uncompressed files. The copy is named after the sha1 of the original file, so a new model gives a new copy,
+            and it is written in a temporary file renamed at the end so processes loading the same model at the same time never read a partial copy.
+    Args :
+            path (str) :
+                    The joblib file
+            mmap_dir (str) :
+                    The directory of the copies
+    Return :
+            copy (str) :
+                    The path of the copy
+    """
+    with open(path,"rb") as f:
+        digest=hashlib.sha1(f.read()).hexdigest()[:16]
+    name=os.path.splitext(os.path.basename(path))[0]
+    copy=os.path.join(mmap_dir,name+"."+digest+".joblib")
+    if not os.path.exists(copy):
+        os.makedirs(mmap_dir,exist_ok=True)
+        temporary=copy+"."+str(os.getpid())+".tmp"
+        joblib.dump(joblib.load(path),temporary)
+        os.replace(temporary,copy)
+    return copy
+
+def load_model(path,mmap_dir=None): #### Load a joblib model, its numpy arrays memory mapped if mmap_dir is given
+    if mmap_dir is None:
+        return joblib.load(path)
+    return joblib.load(mmap_copy(path,mmap_dir),mmap_mode="r")
+
+def memory_usage(): #### Memory of the current process in MB
+    """This function will return the memory used by the current process
+    Description :
+            Here the function reads /proc/self/status (resident and peak resident memory) and /proc/self/smaps_rollup (memory shared with other processes,
+            e.g. the pages of the memory mapped models or the pages inherited from the parent process). Where /proc is not available only the peak is returned.
+    Return :
+            usage (dict) :
+                    {"RSS":..., "peak":..., "shared":...} in MB, the missing values are None
+    """
+    values={}
+    for file in ("/proc/self/status","/proc/self/smaps_rollup"):
+        try:
+            with open(file,"r") as f:
+                for line in f:
+                    parts=line.split()
+                    if len(parts)>=2 and parts[1].isdigit():
+                        values[parts[0]]=int(parts[1])/1024.0 # kB
+        except (IOError,OSError):
+            continue
+    usage={
+        "RSS":values.get("VmRSS:"),
+        "peak":values.get("VmHWM:",resource.getrusage(resource.RUSAGE_SELF).ru_maxrss/1024.0),
+        "shared":None}
+    if "Shared_Clean:" in values:
+        usage["shared"]=values["Shared_Clean:"]+values.get("Shared_Dirty:",0.0)
+    return usage
+
+class Registry(object): #### Artifacts loaded once per process
+    """This class loads the models and tables of detect_EMBL.py on first use and keeps them for the life of the process
+    Description :
+            Each artifact has a name and a function loading it. get() calls the function only the first time and keeps the time it took, load() loads a list of
+            artifacts at once (e.g. in the initializer of the Pool workers, so every worker is warm before its first chunk). The artifacts loaded before a fork
+            are inherited by the child processes, with spawn or forkserver each worker loads its own, the numpy arrays of the models being memory mapped
+            (see load_model()) so their pages are shared by every worker.
+    Args :
+            loaders (dict) :
+                    A dictionary with the name of each artifact as key and a function without argument loading it as value
+    """
+    def __init__(self,loaders):
+        self.loaders=loaders
+        self.artifacts={}
+        self.timings={}
+
+    def get(self,name): #### An artifact, loaded on first use
+        if name not in self.artifacts:
+            start=time.time()
+            self.artifacts[name]=self.loaders[name]()
+            self.timings[name]=time.time()-start
+        return self.artifacts[name]
+
+    def load(self,names=None): #### Load a list of artifacts (every artifact by default)
+        for name in (self.loaders if names is None else names):
+            self.get(name)
+
+    def loaded(self,name):
+        return name in self.artifacts
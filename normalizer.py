@@ -0,0 +1,183 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+# Compiled string preparation for detect_EMBL.py
+########################
+import re
+import time
+
+#############################                   VARIABLES                   #############################
+
+escapes={ ### Escaped letters of a pattern matching one character
+    "n":"\n",
+    "t":"\t",
+    "r":"\r",
+    "f":"\f",
+    "v":"\v"}
+counted_repeat=re.compile(r'\{(?:[0-9]+(?:,[0-9]*)?|,[0-9]*)\}') # {m}, {m,}, {m,n} and {,n} quantifiers, any other "{" is a literal character for re
+
+#############################                   DEFINITIONS                   #############################
+
+def literal_char(pattern): #### Character matched by a pattern if the pattern is one literal character
+    if len(pattern)==1 and pattern not in ".^$*+?{}[]|()\\":
+        return pattern
+    if len(pattern)==2 and pattern[0]=="\\":
+        if pattern[1] in escapes:
+            return escapes[pattern[1]]
+        if not pattern[1].isalnum():
+            return pattern[1]
+    return None
+
+def required_literal(pattern): #### Longest string that must be in a string for the pattern to match
+    """This function will find a literal string that is part of every match of a pattern
+    Description :
+            Here the function reads the pattern and keeps the runs of literal characters. A quantifier (including a counted repeat as {3} or {2,5}) removes the character
+            before it from the run, classes, escapes of classes and any other special character end the current run. Patterns with an alternation or a group are not read.
+    Args :
+            pattern (str) :
+                    A regex pattern
+    Return :
+            literal (str) :
+                    The longest literal run of the pattern (None if there is not any)
+    """
+    if "|" in pattern or "(" in pattern:
+        return None
+    runs=[""]
+    i=0
+    while i<len(pattern):
+        char=pattern[i]
+        if char=="\\" and i+1<len(pattern):
+            if literal_char(pattern[i:i+2]) is not None:
+                runs[-1]+=literal_char(pattern[i:i+2])
+            else:
+                runs.append("")
+            i+=2
+            continue
+        if char=="[":
+            end=pattern.index("]",i+2 if pattern[i+1:i+2] in ("]","^") else i+1)
+            runs.append("")
+            i=end+1
+            continue
+        if char=="{":
+            repeat=counted_repeat.match(pattern,i)
+            if repeat is not None: # The repeated character may not be in the match ({0}) or is not followed by the rest of the run ({3})
+                runs[-1]=runs[-1][:-1]
+                i=repeat.end()
+            else:
+                i+=1
+            runs.append("")
+            continue
+        if char in "*+?":
+            if char!="+":
+                runs[-1]=runs[-1][:-1]
+            runs.append("")
+        elif char in ".^$}":
+            runs.append("")
+        else:
+            runs[-1]+=char
+        i+=1
+    literal=max(runs,key=len)
+    return literal if literal else None
+
+def sequential(replacements,request): #### Reference preparation, one re.sub per replacement
+    for old, new in replacements:
+        request=re.sub(old,new,request)
+    return request
+
+class Normalizer(object): #### Compiled version of a list of replacements
+    """This class applies a list of (regex pattern, replacement) to strings with the same output as one re.sub per replacement, in order
+    Description :
+            The replacements are compiled once in a list of steps :
+                - consecutive replacements of one literal character are merged in one step of str.replace() calls
+                - "^\\s*" and "^\\s+" are done with str.lstrip() and ",\\s*$" like patterns with str.rstrip() (\\s and str.isspace() match the same characters)
+                - other patterns are precompiled and only applied if the longest literal they require is in the string
+            The batch() function prepares a whole list of strings, each different string only once.
+    Args :
+            replacements (list-tuple) :
+                    A list of (regex pattern, replacement) as detect_EMBL.replacements
+    """
+    def __init__(self,replacements):
+        self.replacements=list(replacements)
+        self.steps=[]
+        chars=[]
+        for old, new in self.replacements:
+            char=literal_char(old)
+            if char is not None and "\\" not in new:
+                chars.append((char,new))
+                continue
+            if chars:
+                self.steps.append(self.replace_step(chars))
+                chars=[]
+            self.steps.append(self.compile_step(old,new))
+        if chars:
+            self.steps.append(self.replace_step(chars))
+
+    @staticmethod
+    def replace_step(chars):
+        def step(request):
+            for char,new in chars:
+                request=request.replace(char,new)
+            return request
+        return step
+
+    @staticmethod
+    def compile_step(old,new):
+        if "\\" in new: # Group references are left to re.sub
+            regex=re.compile(old)
+            return lambda request: regex.sub(new,request)
+        if old==r'^\s*':
+            return lambda request: new+request.lstrip()
+        if old==r'^\s+':
+            return lambda request: new+request.lstrip() if request[:1].isspace() else request
+        if old.endswith(r'\s*$') and literal_char(old[:-4]) is not None:
+            char=literal_char(old[:-4])
+            def rstrip_step(request):
+                stripped=request.rstrip()
+                return stripped[:-1]+new if stripped.endswith(char) else request
+            return rstrip_step
+        regex=re.compile(old)
+        literal=required_literal(old)
+        if literal is None:
+            return lambda request: regex.sub(new,request)
+        return lambda request: regex.sub(new,request) if literal in request else request
+
+    def __call__(self,request): #### Prepare a string
+        for step in self.steps:
+            request=step(request)
+        return request
+
+    def batch(self,requests): #### Prepare a list of strings, each different string is prepared once
+        prepared={}
+        for request in requests:
+            if request not in prepared:
+                prepared[request]=self(request)
+        return [prepared[request] for request in requests]
+
+#############################                   MAIN                   #############################
+
+if __name__=='__main__': # Golden output check and micro-benchmark on the affiliations of the previous searches
+    import corpus
+    from detect_EMBL import replacements
+    affiliations=corpus.searches_affiliations(unique=False)
+    normalizer=Normalizer(replacements)
+    golden=[sequential(replacements,aff) for aff in affiliations]
+    different=[aff for aff,prepared in zip(affiliations,golden) if normalizer(aff)!=prepared]
+    different+=[aff for aff,prepared,batched in zip(affiliations,golden,normalizer.batch(affiliations)) if batched!=prepared]
+    print("Affiliations checked: "+str(len(affiliations)))
+    print("Different outputs: "+str(len(different)))
+    for aff in different[:10]:
+        print(repr(aff))
+    timings={}
+    for name,function in (
+            ("re.sub",lambda: [sequential(replacements,aff) for aff in affiliations]),
+            ("Normalizer",lambda: [normalizer(aff) for aff in affiliations]),
+            ("Normalizer.batch",lambda: normalizer.batch(affiliations))):
+        best=None
+        for repeat in range(5):
+            start=time.perf_counter()
+            function()
+            elapsed=time.perf_counter()-start
+            best=elapsed if best is None else min(best,elapsed)
+        timings[name]=best
+        print(name+": "+str(round(best*1000,2))+" ms ("+str(round(timings["re.sub"]/best,2))+"x)")
+    if different:
+        raise SystemExit(1)
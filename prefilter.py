@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+# Lexical pre-filter of the affiliations that cannot be EMBL for detect_EMBL.py
+########################
+import math
+
+import scipy.sparse # (https://docs.scipy.org/doc/scipy/reference/sparse.html)
+
+#############################                   VARIABLES                   #############################
+
+keywords=[";","European","EMBL","EBI"] # An affiliation containing one of them goes through the substrings predictions of is_EMBL whatever its score
+
+#############################                   DEFINITIONS                   #############################
+
+class Prefilter(object): #### Screen of the affiliations that cannot reach the threshold of the EMBL model
+    """This class tells, without the TF-IDF transform and the logistic regression, which prepared affiliations can not be predicted as EMBL
+    Description :
+            The EMBL model is a logistic regression on the l2 normalized TF-IDF of the words, so its decision function is intercept+sum(weight*tfidf) over the words
+            of the affiliation, every tfidf being positive and their squares summing to 1. Only the words of positive weight can raise the score and, by Cauchy-Schwarz,
+            they raise the decision function by at most sqrt(sum(weight**2)) over these words. An affiliation is rejected when this upper bound of the decision function
+            gives a probability below the threshold and when it contains none of the keywords : its prediction can not be chosen by any step of is_EMBL.
+            Only the words of the affiliation are needed (same preprocessing and tokenization as the vectorizer), looked up in the words of positive weight.
+            The probability given by the upper bound of a rejected affiliation (bound()) is its score, always below the threshold.
+            When the vectorizer is not a word unigram TF-IDF with l2 norm, or the probability of the classifier is not the expected function of its decision function,
+            the screen keeps every affiliation.
+    Args :
+            vectorizer (TfidfVectorizer) :
+                    The vectorizer of the EMBL model
+            clf (LogisticRegression) :
+                    The EMBL model, binary (the probability of EMBL is the second column of predict_proba)
+            threshold (float) :
+                    The affiliations whose probability can reach this threshold are kept
+    """
+    def __init__(self,vectorizer,clf,threshold=0.6):
+        self.threshold=threshold
+        self.preprocess=vectorizer.build_preprocessor()
+        self.tokenize=vectorizer.build_tokenizer()
+        self.budget=None # Sum of the squared weights from which an affiliation is kept, None to keep every affiliation
+        self.intercept=0.0
+        self.scale=1.0
+        if vectorizer.analyzer!="word" or tuple(vectorizer.ngram_range)!=(1,1) or vectorizer.norm!="l2" or clf.coef_.shape[0]!=1:
+            return
+        coef=clf.coef_[0]
+        intercept=clf.intercept_[0]
+        ovr=clf.multi_class in ("ovr","warn") or (clf.multi_class=="auto" and (len(clf.classes_)<=2 or clf.solver=="liblinear"))
+        scale=1.0 if ovr else 2.0 # The binary multinomial probability is the sigmoid of twice the decision function
+        self.intercept=intercept
+        self.scale=scale
+        probability=clf.predict_proba(scipy.sparse.csr_matrix((1,coef.shape[0])))[0][1]
+        if abs(probability-1.0/(1.0+math.exp(-scale*intercept)))>1e-9:
+            return
+        self.weights={word:coef[index]**2 for word,index in vectorizer.vocabulary_.items() if coef[index]>0}
+        limit=math.log(threshold/(1.0-threshold))/scale # Decision function of the threshold
+        if limit>intercept:
+            self.budget=(limit-intercept)**2*(1-1e-9)
+
+    def words(self,request): #### Sum of the squared positive weights of the words of the prepared request
+        return sum(self.weights.get(word,0.0) for word in set(self.tokenize(self.preprocess(request))))
+
+    def bound(self,request): #### Upper bound of the EMBL probability of a prepared request (1.0 when the screen keeps every affiliation)
+        if self.budget is None:
+            return 1.0
+        return 1.0/(1.0+math.exp(-self.scale*(self.intercept+math.sqrt(self.words(request)))))
+
+    def keep(self,request): #### False if the prepared request can not be predicted as EMBL
+        if self.budget is None or any(keyword in request for keyword in keywords):
+            return True
+        total=0.0
+        for word in set(self.tokenize(self.preprocess(request))):
+            total+=self.weights.get(word,0.0)
+            if total>=self.budget:
+                return True
+        return False
@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+# Deterministic resolution of the EMBL site of an affiliation for detect_EMBL.py
+########################
+import re
+import unicodedata
+
+#############################                   VARIABLES                   #############################
+
+ror_pattern=re.compile(r'(?:ror\.org/)?\b(0[a-z0-9]{6}[0-9]{2})\b') # ROR ID, alone or in its URL
+words=re.compile(r'[a-z0-9]+')
+
+#############################                   DEFINITIONS                   #############################
+
+def normalize(name): #### Lowercase ASCII words of a name separated by one space
+    if not name.isascii():
+        name=unicodedata.normalize("NFKD",name).encode("ascii","ignore").decode("ascii")
+    return " ".join(words.findall(name.lower()))
+
+def ror_id(ror): #### ROR ID of a ROR URL (e.g. https://ror.org/02catss52 gives 02catss52)
+    found=ror_pattern.search(ror.lower())
+    return found.group(1) if found else None
+
+class Resolver(object): #### Site of the affiliations identified by a ROR ID or a canonical name of an EMBL site
+    """This class finds the EMBL site of an affiliation without the models, when the site is certain
+    Description :
+            An affiliation is resolved when one of its ROR IDs (e.g. the organisation identifier of the affiliation in EuropePMC) is the ROR ID of an EMBL site,
+            or when the whole affiliation, normalized (see normalize()), is a canonical name of an EMBL site : one of its names followed by nothing or by one of its places
+            (e.g. "European Molecular Biology Laboratory (EMBL), Heidelberg, Germany"). A name shared by several sites is not canonical. Every other affiliation is left
+            to the models : the resolver only says which affiliations are EMBL, never which are not. A resolved affiliation is certain, so its scores are 1.0, and its method
+            tells the path ("Resolved by ROR" or "Resolved by Name").
+    Args :
+            rors (dict) :
+                    A dictionary with the ROR IDs (or their URL) as key and the site as value
+            names (dict) :
+                    A dictionary with the sites as key and the list of their names as value
+            places (dict) :
+                    A dictionary with the sites as key and the list of the places which can follow their names as value
+    """
+    def __init__(self,rors,names,places):
+        self.rors={ror_id(ror):site for ror,site in rors.items()}
+        self.names={}
+        ambiguous=set() # Names of several sites (e.g. "European Molecular Biology Laboratory" alone)
+        for site in names:
+            for name in names[site]:
+                for place in [""]+places.get(site,[]):
+                    key=normalize(name+" "+place)
+                    if self.names.setdefault(key,site)!=site:
+                        ambiguous.add(key)
+        for key in ambiguous:
+            del self.names[key]
+
+    def resolve(self,affiliation,rors=()): #### Site and method ("ROR" or "Name") of an affiliation, (None, None) when it is not resolved
+        for ror in rors:
+            site=self.rors.get(ror_id(ror))
+            if site is not None:
+                return site,"ROR"
+        site=self.names.get(normalize(affiliation))
+        if site is not None:
+            return site,"Name"
+        return None,None
+
+    def result(self,affiliation,site,method): #### Result of a resolved affiliation, in the format of detect_EMBL.is_EMBL(), the site being certain
+        return {
+            "choose":True,
+            "method":"Resolved by "+method,
+            "string":affiliation,
+            "score_EMBL":1.0,
+            "site":site,
+            "score_site":1.0,
+            "substring":""}
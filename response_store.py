@@ -0,0 +1,93 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+# Local store of the EuropePMC results used by detect_EMBL.py
+########################
+import json
+import os
+import sqlite3 # (https://docs.python.org/3/library/sqlite3.html)
+import threading
+import time
+import zlib # Used to compress the results (https://docs.python.org/3/library/zlib.html)
+
+#############################                   DEFINITIONS                   #############################
+
+class ResponseStore(object): #### Compressed EuropePMC results stored by PMID in a SQLite file
+    """This class stores the EuropePMC results (core format) of each PMID with the time they were fetched
+    Description :
+            Each result is stored as zlib compressed JSON under its PMID. A result older than ttl seconds is not returned by get_many() so it is fetched again,
+            except in offline mode where every stored result is returned. As for the verdict cache, the file uses the WAL journal and each process
+            opens its own connection on first use, one per thread as the chunks are fetched by threads (see detect_EMBL.main()).
+    Args :
+            path (str) :
+                    The SQLite file
+            ttl (float) :
+                    Seconds a result stays valid (None to keep results forever)
+            offline (boolean) :
+                    If True results are returned whatever their age
+    """
+    def __init__(self,path,ttl=None,offline=False):
+        self.path=path
+        self.ttl=ttl
+        self.offline=offline
+        self._local=threading.local()
+        with self.connection() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS results (pmid TEXT PRIMARY KEY, fetched REAL, data BLOB)")
+
+    def connection(self): #### Connection of the current thread of the current process
+        if getattr(self._local,"pid",None)!=os.getpid():
+            self._local.connection=sqlite3.connect(self.path,timeout=60)
+            self._local.connection.execute("PRAGMA journal_mode=WAL")
+            self._local.connection.execute("PRAGMA synchronous=NORMAL")
+            self._local.pid=os.getpid()
+        return self._local.connection
+
+    def __getstate__(self): # Sent to the spawned workers without the connections
+        state=dict(self.__dict__)
+        del state["_local"]
+        return state
+
+    def __setstate__(self,state):
+        self.__dict__.update(state)
+        self._local=threading.local()
+
+    def close(self): #### Close the connection of the current thread (e.g. before creating a Pool)
+        if getattr(self._local,"pid",None)==os.getpid():
+            self._local.connection.close()
+        self._local=threading.local()
+
+    def get_many(self,pmids): #### Stored results of a list of PMIDs
+        """This function will return the stored results of a list of PMIDs
+        Args :
+                pmids (list-str) :
+                        A list of PMIDs
+        Return :
+                found (dict) :
+                        A dictionary with the PMIDs found (and not expired) as key and their result as value
+        """
+        pmids=list(set(str(pmid) for pmid in pmids))
+        oldest=0 if self.offline or self.ttl is None else time.time()-self.ttl
+        found={}
+        connection=self.connection()
+        for start in range(0,len(pmids),500): # SQLite limits the number of variables of a query
+            sub_pmids=pmids[start:start+500]
+            rows=connection.execute(
+                "SELECT pmid,data FROM results WHERE fetched>=? AND pmid IN ("+",".join("?"*len(sub_pmids))+")",
+                [oldest]+sub_pmids)
+            for pmid,data in rows:
+                found[pmid]=json.loads(zlib.decompress(data).decode("utf-8"))
+        return found
+
+    def put_many(self,results): #### Store a list of results
+        now=time.time()
+        connection=self.connection()
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO results (pmid,fetched,data) VALUES (?,?,?)",
+                [(str(result["pmid"]),now,zlib.compress(json.dumps(result,separators=(",",":")).encode("utf-8"))) for result in results if "pmid" in result])
+
+    def items(self): #### Every stored PMID and its result
+        for pmid,data in self.connection().execute("SELECT pmid,data FROM results"):
+            yield pmid,json.loads(zlib.decompress(data).decode("utf-8"))
+
+    def __len__(self):
+        return self.connection().execute("SELECT COUNT(*) FROM results").fetchone()[0]
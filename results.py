@@ -0,0 +1,261 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+# Columnar store of the results of the searches of detect_EMBL.py
+########################
+import argparse
+import ast
+import collections
+import glob
+import json
+import os
+
+import numpy
+
+#############################                   VARIABLES                   #############################
+
+results_file="EMBL_results.npz" # Store of a search, in its directory
+columns=["EMBL","Member states","Worldwide","Partnership"] # Categories of the PMIDs of each site (see detect_EMBL.categorize())
+sites=["EMBL Australia","EMBL Barcelona","EMBL-EBI","EMBL Grenoble","EMBL Hamburg","EMBL Heidelberg","EMBL Nordic","EMBL Rome"] # Same order as detect_EMBL.EMBL_sites
+
+#############################                   DEFINITIONS                   #############################
+
+def column_name(column): #### Name of the array of a category
+    return "flags_"+column.replace(" ","_")
+
+def categories_file(site): #### Name of the categories file of a site (e.g. EMBL_EBI_categories.csv)
+    return site.replace(" ","_").replace("-","_")+"_categories.csv"
+
+def write(path,pmids,rows,metadata=None,classified=None): #### Write the results of a search in a store
+    """This function will write the results of a search in a numpy .npz file
+    Description :
+            The store holds :
+                - pmids : the EMBL PMIDs as int64, in the order of EMBL_PMIDs.txt
+                - rows_pmid and rows_site : the PMID (int64) and the index of the site in site_names (uint8) of each row of the categories files, site by site
+                - flags_EMBL, flags_Member_states, flags_Worldwide and flags_Partnership : the category of each row, packed 8 rows per byte (numpy.packbits())
+                - classified : every PMID classified by the search as int64, EMBL or not (the PMIDs found on EuropePMC), used by Index
+                - metadata : the JSON of metadata (e.g. the hash of the models, the number of PMIDs and the timings of the run)
+            The file is written in a temporary file renamed at the end, so a reader never finds a partial store.
+    Args :
+            path (str) :
+                    The .npz file
+            pmids (list-str) :
+                    The EMBL PMIDs
+            rows (list-tuple) :
+                    The rows of the categories files as (site, pmid, categories) with categories a dictionary with a boolean for each of columns
+            metadata (dict) :
+                    Metadata of the run, must be JSON serializable
+            classified (list-str) :
+                    Every PMID classified, None if they are not known (e.g. an imported search)
+    """
+    rows=sorted(rows,key=lambda row: sites.index(row[0])) # Stable, the rows of a site stay in their order
+    arrays={
+        "pmids":numpy.fromiter((int(pmid) for pmid in pmids),dtype=numpy.int64,count=len(pmids)),
+        "rows_pmid":numpy.fromiter((int(pmid) for site,pmid,categories in rows),dtype=numpy.int64,count=len(rows)),
+        "rows_site":numpy.fromiter((sites.index(site) for site,pmid,categories in rows),dtype=numpy.uint8,count=len(rows)),
+        "site_names":numpy.array(sites),
+        "metadata":numpy.array(json.dumps(metadata or {}))}
+    if classified is not None:
+        arrays["classified"]=numpy.fromiter((int(pmid) for pmid in classified),dtype=numpy.int64,count=len(classified))
+    for column in columns:
+        arrays[column_name(column)]=numpy.packbits(numpy.fromiter((bool(categories[column]) for site,pmid,categories in rows),dtype=bool,count=len(rows)))
+    directory=os.path.dirname(path)
+    if directory:
+        os.makedirs(directory,exist_ok=True)
+    temporary=path+"."+str(os.getpid())+".tmp.npz"
+    numpy.savez_compressed(temporary,**arrays)
+    os.replace(temporary,path)
+
+def read(path): #### Read a store
+    """This function will read a store written by write()
+    Args :
+            path (str) :
+                    The .npz file
+    Return :
+            store (dict) :
+                    {
+                        "pmids":...,         (int64 array of the EMBL PMIDs)
+                        "rows_pmid":...,     (int64 array)
+                        "rows_site":...,     (array of the site of each row, as in sites)
+                        "EMBL":..., "Member states":..., "Worldwide":..., "Partnership":...,    (boolean arrays, one value per row)
+                        "classified":...,    (int64 array of every PMID classified, None if the store does not have it)
+                        "metadata":{...}
+                    }
+    """
+    with numpy.load(path) as saved:
+        names=saved["site_names"]
+        store={
+            "pmids":saved["pmids"],
+            "rows_pmid":saved["rows_pmid"],
+            "rows_site":names[saved["rows_site"]],
+            "classified":saved["classified"] if "classified" in saved.files else None,
+            "metadata":json.loads(str(saved["metadata"]))}
+        for column in columns:
+            store[column]=numpy.unpackbits(saved[column_name(column)])[:len(store["rows_pmid"])].astype(bool)
+    return store
+
+def read_searches(directory="./searches/",names=None,site=None,**flags): #### Rows of the stores of every search, filtered
+    """This function will load the store of every search of a directory (e.g. every year) and return their rows at once
+    Args :
+            directory (str) :
+                    The searches directory, each search is a directory with a store (results_file)
+            names (list-str) :
+                    The names of the searches to load (None for every search with a store)
+            site (str) :
+                    Only the rows of this site (None for every site)
+            flags :
+                    Only the rows with these values of the categories, the spaces of the names replaced by "_" (e.g. Worldwide=True, Member_states=False)
+    Return :
+            rows (dict) :
+                    The arrays "search" (name of the search of each row), "pmid", "site" and one boolean array per category, only for the filtered rows
+    """
+    paths=sorted(glob.glob(os.path.join(directory,"*",results_file)))
+    parts=[]
+    for path in paths:
+        name=os.path.basename(os.path.dirname(path))
+        if names is not None and name not in names:
+            continue
+        store=read(path)
+        part={
+            "search":numpy.array([name]*len(store["rows_pmid"])),
+            "pmid":store["rows_pmid"],
+            "site":store["rows_site"]}
+        for column in columns:
+            part[column]=store[column]
+        parts.append(part)
+    rows={key:numpy.concatenate([part[key] for part in parts]) if parts else numpy.array([]) for key in ["search","pmid","site"]+columns}
+    keep=numpy.ones(len(rows["pmid"]),dtype=bool)
+    if site is not None:
+        keep&=rows["site"]==site
+    for name,value in flags.items():
+        column=name.replace("_"," ")
+        if column not in columns:
+            raise ValueError("Unknown category: "+name)
+        keep&=rows[column]==bool(value)
+    return {key:values[keep] for key,values in rows.items()}
+
+class Index(object): #### PMIDs already classified by the searches of a directory, with the version of the models
+    """This class tells which PMIDs have already been classified by a previous search with the current models, and returns their results
+    Description :
+            Every store of the directory is read once : a PMID of the "classified" array of a store written with the current version of the models is known,
+            and is EMBL if it is in the "pmids" array of this store, with the rows of the store for its sites and categories. When several stores know a PMID,
+            the first one (by name of the search) is used. The other PMIDs of the stores (older models, or imported searches which only have their EMBL PMIDs
+            and no version) are stale and must be classified again, as the PMIDs never met.
+    Args :
+            directory (str) :
+                    The searches directory, each search is a directory with a store (results_file)
+            version (str) :
+                    The current version of the models (the "models" of the metadata, see detect_EMBL.write_results())
+    """
+    def __init__(self,directory,version):
+        self.version=version
+        self.known=set() # PMIDs (int) classified with the current version
+        self.stale=set() # PMIDs (int) only classified with another version
+        self.records={} # Rows (site, categories) of each known EMBL PMID (int)
+        self.searches=[]
+        for path in sorted(glob.glob(os.path.join(directory,"*",results_file))):
+            store=read(path)
+            if store["metadata"].get("models")!=version or store["classified"] is None:
+                self.stale.update(store["pmids"].tolist())
+                if store["classified"] is not None:
+                    self.stale.update(store["classified"].tolist())
+                continue
+            self.searches.append(os.path.basename(os.path.dirname(path)))
+            new=set(store["classified"].tolist())-self.known
+            self.known|=new
+            for pmid in store["pmids"].tolist():
+                if pmid in new:
+                    self.records[pmid]=[]
+            flags=[store[column].tolist() for column in columns]
+            for i,(pmid,site) in enumerate(zip(store["rows_pmid"].tolist(),store["rows_site"].tolist())):
+                if pmid in new:
+                    self.records[pmid].append((site,{column:values[i] for column,values in zip(columns,flags)}))
+        self.stale-=self.known
+
+    def __contains__(self,pmid): #### True if the PMID (str or int) has been classified with the current version
+        return int(pmid) in self.known
+
+    def results(self,pmids): #### Results of known PMIDs, as the arguments of write()
+        """This function will return the results of known PMIDs from the stores
+        Args :
+                pmids (list-str) :
+                        Known PMIDs (see __contains__())
+        Return :
+                affiliated (list-str) :
+                        The EMBL PMIDs among them, in the same order
+                rows (list-tuple) :
+                        The rows of the categories files of these EMBL PMIDs as (site, pmid, categories)
+        """
+        affiliated=[]
+        rows=[]
+        for pmid in pmids:
+            if int(pmid) in self.records:
+                affiliated.append(pmid)
+                rows+=[(site,pmid,categories) for site,categories in self.records[int(pmid)]]
+        return affiliated,rows
+
+def export_pmids(store,path): #### Write EMBL_PMIDs.txt from a store, same format as detect_EMBL.save()
+    with open(path,"w",encoding="utf-8") as f:
+        f.write(str([str(pmid) for pmid in store["pmids"].tolist()]))
+        f.write("\n")
+
+def export_categories(store,directory): #### Write the categories file of each site from a store, same format as before the store
+    for site in sites:
+        keep=store["rows_site"]==site
+        lines=["PMID\tEMBL\tMember states\tWorldwide\tPartnership\n"]
+        values=[store["rows_pmid"][keep].tolist()]+[store[column][keep].tolist() for column in columns]
+        lines+=["\t".join(str(value) for value in row)+"\n" for row in zip(*values)]
+        with open(os.path.join(directory,categories_file(site)),"w",encoding="utf-8") as f:
+            f.write("".join(lines))
+
+def import_search(directory): #### Results of a search from its EMBL_PMIDs.txt and categories files
+    """This function will read the text outputs of a search (e.g. the searches made before the store) and return them as the arguments of write()
+    Description :
+            The categories files have a header and one row per PMID with a boolean per category, or, for the oldest searches, no header and one row per PMID
+            and category (PMID, category) : the categories of a PMID are then the ones of its rows, and EMBL which is true for every PMID as in the newer files.
+    Args :
+            directory (str) :
+                    The directory of the search
+    Return :
+            pmids (list-str) :
+                    The EMBL PMIDs of EMBL_PMIDs.txt
+            rows (list-tuple) :
+                    The rows of the categories files as (site, pmid, categories)
+    """
+    with open(os.path.join(directory,"EMBL_PMIDs.txt"),"r",encoding="utf-8") as f:
+        pmids=ast.literal_eval(f.read().strip())
+    rows=[]
+    for site in sites:
+        path=os.path.join(directory,categories_file(site))
+        if not os.path.exists(path):
+            continue
+        with open(path,"r",encoding="utf-8") as f:
+            lines=[line.rstrip("\n").split("\t") for line in f if line.strip()]
+        if lines and lines[0][0]=="PMID":
+            rows+=[(site,line[0],{column:value=="True" for column,value in zip(columns,line[1:])}) for line in lines[1:]]
+            continue
+        found=collections.OrderedDict()
+        for pmid,column in lines:
+            found.setdefault(pmid,{column:column=="EMBL" for column in columns})[column]=True
+        rows+=[(site,pmid,categories) for pmid,categories in found.items()]
+    return pmids,rows
+
+#############################                   MAIN                   #############################
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser(description="Summary of the results of every search")
+    parser.add_argument("directory",nargs="?",default="./searches/",help="the searches directory (default: %(default)s)")
+    parser.add_argument("--import",dest="import_searches",action="store_true",help="write the store of the searches which only have EMBL_PMIDs.txt and categories files")
+    parser.add_argument("--site",choices=sites,help="only the rows of this site")
+    args=parser.parse_args()
+    if args.import_searches:
+        for path in sorted(glob.glob(os.path.join(args.directory,"*","EMBL_PMIDs.txt"))):
+            search=os.path.dirname(path)
+            if not os.path.exists(os.path.join(search,results_file)):
+                pmids,rows=import_search(search)
+                write(os.path.join(search,results_file),pmids,rows,{"imported":True})
+                print("Imported "+search)
+    rows=read_searches(args.directory,site=args.site)
+    print("search\trows\t"+"\t".join(columns))
+    for name in sorted(set(rows["search"].tolist())):
+        keep=rows["search"]==name
+        print(name+"\t"+str(int(keep.sum()))+"\t"+"\t".join(str(int(rows[column][keep].sum())) for column in columns))
@@ -0,0 +1,335 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+# Resident scoring service of detect_EMBL.py : is_EMBL and get_geoloc_from over a local HTTP or Unix socket API, the requests gathered in micro-batches
+########################
+import argparse
+import collections
+import json
+import os
+import queue
+import signal
+import socketserver
+import sys
+import threading
+import time
+import traceback
+from http.server import BaseHTTPRequestHandler,HTTPServer
+
+import numpy
+
+import detect_EMBL
+
+#############################                   VARIABLES                   #############################
+
+host="127.0.0.1" # Address of the HTTP server (--host)
+port=8765 # Port of the HTTP server (--port)
+socket_path=None # Unix socket served instead of host and port (--socket)
+window=0.002 # Seconds a batch waits for other requests after its first one (--window-ms)
+max_batch=512 # Number of affiliations after which a batch is run without waiting for the end of the window (--max-batch)
+max_body=10*1024*1024 # Maximum size in bytes of the body of a request
+samples=10000 # Number of the last batches and requests kept for the percentiles of /metrics
+
+#############################                   DEFINITIONS                   #############################
+
+def percentiles(values,scale=1.0): #### p50, p99 and max of a list of values (None if empty)
+    if not values:
+        return {"p50":None,"p99":None,"max":None}
+    return {
+        "p50":float(numpy.percentile(values,50))*scale,
+        "p99":float(numpy.percentile(values,99))*scale,
+        "max":float(max(values))*scale}
+
+class Request(object): #### Affiliations of one request waiting for their results
+    def __init__(self,kind,items,options):
+        self.kind=kind
+        self.items=items
+        self.options=options
+        self.received=time.perf_counter()
+        self.done=threading.Event()
+        self.results=None
+        self.error=None
+
+class MicroBatcher(object): #### One thread running the requests of every client in batches
+    """This class gathers the concurrent requests in micro-batches and runs each batch with one call of the batch function of its kind
+    Description :
+            The HTTP threads submit their requests and wait. The thread of the batcher takes the first waiting request, then every request received until window seconds
+            after it, or until max_batch affiliations are gathered. The requests of a batch are grouped by kind and options, each group is run by one call of its function
+            (e.g. detect_EMBL.is_EMBL_batch()) and the results are given back to each request. Only this thread runs the models, so detect_EMBL.py (its globals, the
+            verdict cache) is never used by two threads at the same time. The size of the last batches and the latency of the last requests are kept for metrics().
+    Args :
+            functions (dict) :
+                    A dictionary with each kind of request as key and a function taking a list of affiliations and the options of the request and returning their results as value
+            window (float) :
+                    Seconds a batch waits for other requests after its first one
+            max_batch (int) :
+                    Number of affiliations after which a batch is run without waiting for the end of the window
+    """
+    def __init__(self,functions,window=0.002,max_batch=512):
+        self.functions=functions
+        self.window=window
+        self.max_batch=max_batch
+        self.queue=queue.Queue()
+        self.waiting=0 # Affiliations in the queue
+        self.started=time.time()
+        self._lock=threading.Lock()
+        self.stats={kind:{"requests":0,"items":0,"batches":0,"errors":0,"batch_sizes":collections.deque(maxlen=samples),
+            "latencies":collections.deque(maxlen=samples),"inference":collections.deque(maxlen=samples)} for kind in functions}
+        self.thread=threading.Thread(target=self.run,daemon=True)
+        self.thread.start()
+
+    def submit(self,kind,items,options=None): #### Results of a list of affiliations, once their batch is run (raises RuntimeError if it failed)
+        request=Request(kind,list(items),dict(options or {}))
+        with self._lock:
+            self.waiting+=len(request.items)
+        self.queue.put(request)
+        request.done.wait()
+        with self._lock:
+            stats=self.stats[kind]
+            stats["requests"]+=1
+            stats["items"]+=len(request.items)
+            stats["latencies"].append(time.perf_counter()-request.received)
+            if request.error is not None:
+                stats["errors"]+=1
+        if request.error is not None:
+            raise RuntimeError(request.error)
+        return request.results
+
+    def run(self): #### Loop of the thread of the batcher
+        while True:
+            first=self.queue.get()
+            if first is None:
+                return
+            batch=[first]
+            items=len(first.items)
+            deadline=first.received+self.window # A request which waited longer than the window only takes the requests already in the queue
+            while items<self.max_batch:
+                try:
+                    timeout=deadline-time.perf_counter()
+                    request=self.queue.get(timeout=timeout) if timeout>0 else self.queue.get_nowait()
+                except queue.Empty:
+                    break
+                if request is None:
+                    self.queue.put(None) # Stop after this batch
+                    break
+                batch.append(request)
+                items+=len(request.items)
+            with self._lock:
+                self.waiting-=items
+            self.execute(batch)
+
+    def execute(self,batch): #### Run the requests of a batch, one call per kind and options
+        groups=collections.OrderedDict()
+        for request in batch:
+            groups.setdefault((request.kind,tuple(sorted(request.options.items()))),[]).append(request)
+        for (kind,options),requests in groups.items():
+            items=[item for request in requests for item in request.items]
+            start=time.perf_counter()
+            try:
+                results=self.functions[kind](items,**dict(options))
+                error=None
+            except Exception as exception:
+                traceback.print_exc()
+                error=type(exception).__name__+": "+str(exception)
+            with self._lock:
+                stats=self.stats[kind]
+                stats["batches"]+=1
+                stats["batch_sizes"].append(len(items))
+                stats["inference"].append(time.perf_counter()-start)
+            position=0
+            for request in requests:
+                if error is None:
+                    request.results=results[position:position+len(request.items)]
+                    position+=len(request.items)
+                else:
+                    request.error=error
+                request.done.set()
+
+    def stop(self): #### Stop the thread once the requests already submitted are run
+        self.queue.put(None)
+        self.thread.join()
+
+    def metrics(self): #### Queue depth, number and size of the batches and latency of the requests of each kind
+        with self._lock:
+            metrics={
+                "uptime_seconds":time.time()-self.started,
+                "queue":{"requests":self.queue.qsize(),"items":self.waiting},
+                "window_ms":self.window*1000,
+                "max_batch":self.max_batch}
+            for kind,stats in self.stats.items():
+                sizes=list(stats["batch_sizes"])
+                metrics[kind]={
+                    "requests":stats["requests"],
+                    "items":stats["items"],
+                    "batches":stats["batches"],
+                    "errors":stats["errors"],
+                    "batch_size":dict(percentiles(sizes),mean=float(numpy.mean(sizes)) if sizes else None),
+                    "latency_ms":percentiles(list(stats["latencies"]),1000),
+                    "inference_ms":percentiles(list(stats["inference"]),1000)}
+        return metrics
+
+class ServiceHandler(BaseHTTPRequestHandler): #### Answer the requests of the API
+    """This class answers the requests of the service
+    Description :
+            POST /is_EMBL      {"affiliations":[...]} gives {"results":[...]}, the results of detect_EMBL.is_EMBL() (site and probabilities)
+                               {"affiliation":"..."} gives {"result":{...}}
+            POST /geoloc       the same for detect_EMBL.get_geoloc_from(), with the options "cities", "other" and "all_mention" (false by default)
+            GET  /health       {"status":"ok", ...} once the models are loaded
+            GET  /metrics      see MicroBatcher.metrics()
+            The connections are kept alive (HTTP/1.1), a client can send all its requests on one connection.
+    """
+    protocol_version="HTTP/1.1"
+    wbufsize=-1 # The headers and the body are sent together when the request is answered (written apart, Nagle's algorithm delays the body for 40 ms)
+
+    def log_message(self,format,*args):
+        return
+
+    def do_GET(self):
+        path=self.path.split("?")[0].rstrip("/")
+        if path=="/health":
+            self.answer(200,self.server.service.health())
+        elif path=="/metrics":
+            self.answer(200,self.server.service.metrics())
+        else:
+            self.answer(404,{"error":"Unknown path "+path})
+
+    def do_POST(self):
+        path=self.path.split("?")[0].rstrip("/")
+        kind={"/is_EMBL":"is_EMBL","/geoloc":"geoloc"}.get(path)
+        length=int(self.headers.get("Content-Length",0))
+        if length>max_body:
+            self.close_connection=True
+            return self.answer(413,{"error":"Body larger than "+str(max_body)+" bytes"})
+        body=self.rfile.read(length)
+        if kind is None:
+            return self.answer(404,{"error":"Unknown path "+path})
+        try:
+            content=json.loads(body.decode("utf-8"))
+            single="affiliation" in content
+            affiliations=[content["affiliation"]] if single else content["affiliations"]
+            if not isinstance(affiliations,list) or not all(isinstance(affiliation,str) for affiliation in affiliations):
+                raise ValueError("affiliations must be a list of strings")
+            options={name:bool(content.get(name,False)) for name in ("cities","other","all_mention")} if kind=="geoloc" else {}
+        except (ValueError,KeyError,TypeError,AttributeError) as exception:
+            return self.answer(400,{"error":"Bad request: "+str(exception)})
+        try:
+            results=self.server.service.batcher.submit(kind,affiliations,options)
+        except RuntimeError as exception:
+            return self.answer(500,{"error":str(exception)})
+        self.answer(200,{"result":results[0]} if single else {"results":results})
+
+    def answer(self,status,content):
+        body=json.dumps(content,default=float).encode("utf-8") # default : numpy scalars of the scores
+        self.send_response(status)
+        self.send_header("Content-Type","application/json")
+        self.send_header("Content-Length",str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn,HTTPServer):
+    daemon_threads=True
+    request_queue_size=128 # Connections waiting to be accepted (5 by default, the other clients connecting at the same time are reset)
+
+class ThreadingUnixServer(socketserver.ThreadingMixIn,socketserver.UnixStreamServer):
+    daemon_threads=True
+    request_queue_size=128 # Connections waiting to be accepted (5 by default, the other clients connecting at the same time are reset)
+
+    def get_request(self): # The handlers read client_address[0]
+        request,_=self.socket.accept()
+        return request,("unix",0)
+
+class Service(object): #### Models of detect_EMBL.py kept loaded behind a local HTTP server
+    """This class loads the models, the spaCy model and the gazetteer of detect_EMBL.py once, then serves is_EMBL_batch() and get_geoloc_batch() through a MicroBatcher
+    Description :
+            The verdict cache of detect_EMBL.py (cache_file) is used as by the searches, unless cache is False. The server listens on host and port, or on a Unix socket
+            when socket_path is given (only readable by the user).
+    Args :
+            host (str) :
+                    Address of the HTTP server
+            port (int) :
+                    Port of the HTTP server (0 for any free port)
+            socket_path (str) :
+                    Unix socket served instead of host and port, None for HTTP over TCP
+            window (float) :
+                    See MicroBatcher
+            max_batch (int) :
+                    See MicroBatcher
+            cache (boolean) :
+                    If True the verdict cache of detect_EMBL.py is used
+    """
+    def __init__(self,host=host,port=port,socket_path=socket_path,window=window,max_batch=max_batch,cache=True):
+        start=time.time()
+        detect_EMBL.load_models()
+        detect_EMBL.load_geoloc()
+        detect_EMBL.verdict_cache=detect_EMBL.open_verdict_cache() if cache and detect_EMBL.cache_file is not None else None
+        self.load_seconds=time.time()-start
+        self.batcher=MicroBatcher({
+            "is_EMBL":lambda affiliations: detect_EMBL.is_EMBL_batch(affiliations,site=True,proba=True),
+            "geoloc":lambda affiliations,cities=False,other=False,all_mention=False: detect_EMBL.get_geoloc_batch(affiliations,cities,other,all_mention)},window,max_batch)
+        if socket_path is not None:
+            if os.path.exists(socket_path):
+                os.remove(socket_path)
+            self.server=ThreadingUnixServer(socket_path,ServiceHandler)
+            os.chmod(socket_path,0o600)
+            self.address=socket_path
+        else:
+            self.server=ThreadingHTTPServer((host,port),ServiceHandler)
+            self.address="http://"+host+":"+str(self.server.server_address[1])+"/"
+        self.server.service=self
+        self.socket_path=socket_path
+        self.thread=None
+
+    def health(self): #### Status of the service
+        return {
+            "status":"ok",
+            "pid":os.getpid(),
+            "uptime_seconds":time.time()-self.batcher.started,
+            "load_seconds":self.load_seconds,
+            "models_seconds":detect_EMBL.registry.timings,
+            "verdict_cache":detect_EMBL.verdict_cache is not None}
+
+    def metrics(self): #### Metrics of the batcher and hits of the verdict cache
+        metrics=self.batcher.metrics()
+        cache=detect_EMBL.verdict_cache
+        metrics["verdict_cache"]={"hits":cache.hits,"misses":cache.misses} if cache is not None else None
+        return metrics
+
+    def start(self): #### Serve in a thread and return the address
+        self.thread=threading.Thread(target=self.server.serve_forever,daemon=True)
+        self.thread.start()
+        return self.address
+
+    def serve(self): #### Serve until interrupted
+        try:
+            self.server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            self.stop()
+
+    def stop(self): #### Close the server, then stop the batcher once the requests already received are run
+        if self.thread is not None:
+            self.server.shutdown()
+            self.thread=None
+        self.server.server_close()
+        self.batcher.stop()
+        if self.socket_path is not None and os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+
+#############################                   MAIN                   #############################
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser(description="Resident scoring service: is_EMBL and get_geoloc_from of detect_EMBL.py over a local HTTP API")
+    parser.add_argument("--host",default=host,help="address of the HTTP server (default: %(default)s)")
+    parser.add_argument("--port",type=int,default=port,help="port of the HTTP server (default: %(default)s)")
+    parser.add_argument("--socket",default=socket_path,help="Unix socket served instead of the host and port")
+    parser.add_argument("--window-ms",type=float,default=window*1000,help="milliseconds a batch waits for other requests after its first one (default: %(default)s)")
+    parser.add_argument("--max-batch",type=int,default=max_batch,help="number of affiliations after which a batch is run without waiting (default: %(default)s)")
+    parser.add_argument("--spacy-model",default=detect_EMBL.spacy_model,help="spacy model (name or path) of get_geoloc_from (default: %(default)s)")
+    parser.add_argument("--no-cache",action="store_true",help="do not use the verdict cache of detect_EMBL.py")
+    args=parser.parse_args()
+    signal.signal(signal.SIGTERM,lambda signum,frame: sys.exit(0)) # Stopped as with Ctrl+C, the Unix socket is removed
+    detect_EMBL.spacy_model=args.spacy_model
+    service=Service(args.host,args.port,args.socket,args.window_ms/1000.0,args.max_batch,not args.no_cache)
+    print("Models loaded in "+str(round(service.load_seconds,2))+" s, serving on "+service.address)
+    sys.stdout.flush()
+    service.serve()
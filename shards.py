@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+# Sharded runs of detect_EMBL.py : split a list of PMIDs in shards, run them and merge their results
+########################
+import argparse
+import json
+import os
+import subprocess
+import sys
+import time
+import zlib
+
+import results
+
+#############################                   VARIABLES                   #############################
+
+manifest_file="manifest.json" # Description of the shards, in the directory of the shards
+shard_pmids="PMIDs.txt" # PMIDs of a shard, one per line, in the directory of the shard
+missing_file="EMBL_missing.csv" # Same as detect_EMBL.missing_file
+workers=os.cpu_count() or 1 # Number of processes scoring the chunks of all the shards run at the same time, divided between them (--workers of run)
+requests_per_second=10 # Maximum number of requests per second to EuropePMC of all the shards run at the same time, divided between them (--requests-per-second of run)
+
+#############################                   DEFINITIONS                   #############################
+
+def shard_of(pmid,shards): #### Shard of a PMID, the same on every node (the hash() of Python changes between processes)
+    return zlib.crc32(str(pmid).encode("utf-8"))%shards
+
+def shard_dir(directory,shard): #### Directory of a shard (e.g. shard_003), its search directory
+    return os.path.join(directory,"shard_"+str(shard).zfill(3),"")
+
+def read_manifest(directory): #### Manifest of a directory of shards (see split())
+    with open(os.path.join(directory,manifest_file),"r",encoding="utf-8") as f:
+        return json.load(f)
+
+def split(pmids,directory,shards): #### Write the PMIDs of each shard and the manifest
+    """This function will split a stream of PMIDs in shards, each shard being a directory with its list of PMIDs
+    Description :
+            The shard of a PMID is the CRC32 of the PMID modulo the number of shards (see shard_of()), so a PMID is in the same shard whatever the input
+            and the node. The PMIDs are written as they are read, only the open files of the shards are kept. Each shard directory is then run as a search
+            of detect_EMBL.py, on any node : python detect_EMBL.py shard_000/PMIDs.txt -o shard_000/
+    Args :
+            pmids (iterable-str) :
+                    The PMIDs (e.g. detect_EMBL.read_pmids())
+            directory (str) :
+                    The directory of the shards
+            shards (int) :
+                    The number of shards
+    Return :
+            manifest (dict) :
+                    {"shards":..., "PMIDs":..., "counts":[...], "hash":"crc32", "date":...}, also written in manifest_file
+    """
+    counts=[0]*shards
+    files=[]
+    try:
+        for shard in range(shards):
+            os.makedirs(shard_dir(directory,shard),exist_ok=True)
+            files.append(open(os.path.join(shard_dir(directory,shard),shard_pmids),"w",encoding="utf-8"))
+        for pmid in pmids:
+            shard=shard_of(pmid,shards)
+            files[shard].write(pmid+"\n")
+            counts[shard]+=1
+    finally:
+        for f in files:
+            f.close()
+    manifest={
+        "shards":shards,
+        "PMIDs":sum(counts),
+        "counts":counts,
+        "hash":"crc32",
+        "date":time.strftime("%Y-%m-%dT%H:%M:%S")}
+    with open(os.path.join(directory,manifest_file),"w",encoding="utf-8") as f:
+        json.dump(manifest,f,indent=4)
+    return manifest
+
+def run(directory,processes=1,arguments=(),script=None,workers=None,requests_per_second=None): #### Run the shards as local processes of detect_EMBL.py
+    """This function will run detect_EMBL.py on every shard of a directory, at most processes shards at the same time
+    Description :
+            Each shard is an independent search (its own journal, so a shard stopped before the end resumes when run again), the other nodes can run
+            the same command on other shards. The output of each shard is written in run.log in its directory.
+            The workers and the requests per second are the ones of the node : each shard run at the same time gets its part (at least one worker),
+            so the shards do not send processes times the requests per second of one run to EuropePMC or start more workers than the CPUs.
+    Args :
+            directory (str) :
+                    The directory of the shards (see split())
+            processes (int) :
+                    The number of shards run at the same time
+            arguments (list-str) :
+                    Other arguments of detect_EMBL.py (e.g. ["--batch-size","500","--europepmc-url","http://127.0.0.1:8000/"])
+            script (str) :
+                    The path of detect_EMBL.py (None for the one next to this file)
+            workers (int) :
+                    The number of workers of all the shards run at the same time (None to leave --workers to arguments)
+            requests_per_second (float) :
+                    The maximum number of requests per second of all the shards run at the same time (None to leave --requests-per-second to arguments)
+    Return :
+            status (list-int) :
+                    The exit status of each shard
+    """
+    script=script or os.path.join(os.path.dirname(os.path.abspath(__file__)),"detect_EMBL.py")
+    waiting=list(range(read_manifest(directory)["shards"]))
+    concurrent=max(1,min(processes,len(waiting)))
+    arguments=list(arguments)
+    if workers is not None:
+        arguments+=["--workers",str(max(1,workers//concurrent))]
+    if requests_per_second is not None:
+        arguments+=["--requests-per-second",str(requests_per_second/concurrent)]
+    running={}
+    status={}
+    while waiting or running:
+        while waiting and len(running)<processes:
+            shard=waiting.pop(0)
+            path=shard_dir(directory,shard)
+            log=open(os.path.join(path,"run.log"),"w",encoding="utf-8")
+            command=[sys.executable,script,os.path.join(path,shard_pmids),"-o",path]+arguments
+            running[shard]=(subprocess.Popen(command,stdout=log,stderr=subprocess.STDOUT),log)
+        time.sleep(0.1)
+        for shard,(process,log) in list(running.items()):
+            if process.poll() is not None:
+                log.close()
+                status[shard]=process.returncode
+                del running[shard]
+                print("shard "+str(shard)+" done, exit status "+str(process.returncode))
+    return [status[shard] for shard in sorted(status)]
+
+def merge(directory,output): #### Merge the results of the shards in one search
+    """This function will merge the results stores of the shards (see results.write()) in one store, then export EMBL_PMIDs.txt and the categories files
+    Description :
+            Every shard of the manifest must have its store. The stores are merged in the order of the shards. A PMID found in several shards, or in a shard
+            which is not its shard (e.g. the shards of two manifests mixed), is reported and only its first results are kept. The missing PMIDs of the shards
+            are merged in missing_file, and the metadata of the merged store holds the metadata of each shard. The time and throughput of each shard are printed.
+    Args :
+            directory (str) :
+                    The directory of the shards
+            output (str) :
+                    The directory of the merged search
+    Return :
+            report (dict) :
+                    {
+                        "shards":[{"shard":..., "input":..., "PMIDs":..., "EMBL":..., "seconds":..., "PMIDs_per_second":...}],    (PMIDs of the manifest, PMIDs classified, EMBL PMIDs)
+                        "duplicates":...,   (number of PMIDs found in several shards)
+                        "misplaced":...,    (number of PMIDs found in another shard than theirs)
+                        "PMIDs":..., "EMBL":...
+                    }
+    """
+    manifest=read_manifest(directory)
+    shards=manifest["shards"]
+    paths=[os.path.join(shard_dir(directory,shard),results.results_file) for shard in range(shards)]
+    absent=[shard for shard,path in enumerate(paths) if not os.path.exists(path)]
+    if absent:
+        raise ValueError("Shards without results: "+", ".join(str(shard) for shard in absent))
+    seen={} # Shard of each classified PMID
+    duplicates=set()
+    misplaced=set()
+    pmids=[]
+    rows=[]
+    classified=[]
+    report={"shards":[]}
+    metadata={"shards":[],"manifest":manifest}
+    for shard,path in enumerate(paths):
+        store=results.read(path)
+        shard_classified=store["classified"] if store["classified"] is not None else store["pmids"]
+        kept=set()
+        for pmid in shard_classified.tolist():
+            if shard_of(pmid,shards)!=shard:
+                misplaced.add(pmid)
+            if pmid in seen:
+                duplicates.add(pmid)
+                continue
+            seen[pmid]=shard
+            kept.add(pmid)
+            classified.append(pmid)
+        pmids+=[pmid for pmid in store["pmids"].tolist() if pmid in kept]
+        for i,(pmid,site) in enumerate(zip(store["rows_pmid"].tolist(),store["rows_site"].tolist())):
+            if pmid in kept:
+                rows.append((site,pmid,{column:bool(store[column][i]) for column in results.columns}))
+        seconds=store["metadata"].get("seconds")
+        report["shards"].append({
+            "shard":shard,
+            "input":manifest["counts"][shard],
+            "PMIDs":len(shard_classified),
+            "EMBL":len(store["pmids"]),
+            "seconds":seconds,
+            "PMIDs_per_second":len(shard_classified)/seconds if seconds else None})
+        metadata["shards"].append(store["metadata"])
+    report["duplicates"]=len(duplicates)
+    report["misplaced"]=len(misplaced)
+    report["PMIDs"]=len(classified)
+    report["EMBL"]=len(pmids)
+    metadata["merge"]={"duplicates":report["duplicates"],"misplaced":report["misplaced"],"date":time.strftime("%Y-%m-%dT%H:%M:%S")}
+    os.makedirs(output,exist_ok=True)
+    path=os.path.join(output,results.results_file)
+    results.write(path,pmids,rows,metadata,classified)
+    store=results.read(path)
+    results.export_pmids(store,os.path.join(output,"EMBL_PMIDs.txt"))
+    results.export_categories(store,output)
+    lines=["PMID\tReason\n"]
+    for shard in range(shards):
+        path=os.path.join(shard_dir(directory,shard),missing_file)
+        if os.path.exists(path):
+            with open(path,"r",encoding="utf-8") as f:
+                lines+=f.readlines()[1:]
+    with open(os.path.join(output,missing_file),"w",encoding="utf-8") as f:
+        f.write("".join(lines))
+    return report
+
+def print_report(report): #### Print the timings of the shards and the checks of the merge
+    print("shard\tinput\tPMIDs\tEMBL\tseconds\tPMIDs/s")
+    for shard in report["shards"]:
+        seconds="?" if shard["seconds"] is None else str(round(shard["seconds"],2))
+        speed="?" if shard["PMIDs_per_second"] is None else str(round(shard["PMIDs_per_second"],1))
+        print(str(shard["shard"])+"\t"+str(shard["input"])+"\t"+str(shard["PMIDs"])+"\t"+str(shard["EMBL"])+"\t"+seconds+"\t"+speed)
+    times=[shard["seconds"] for shard in report["shards"] if shard["seconds"] is not None]
+    if times:
+        print("Slowest shard "+str(round(max(times),2))+" s, fastest "+str(round(min(times),2))+" s, total "+str(round(sum(times),2))+" s")
+    print(str(report["PMIDs"])+" PMIDs, "+str(report["EMBL"])+" EMBL PMIDs, "+str(report["duplicates"])+" duplicates, "+str(report["misplaced"])+" PMIDs in another shard")
+
+#############################                   MAIN                   #############################
+
+if __name__=='__main__':
+    parser=argparse.ArgumentParser(description="Sharded runs of detect_EMBL.py")
+    commands=parser.add_subparsers(dest="command")
+    split_parser=commands.add_parser("split",help="split the PMIDs of files (every number is read as a PMID, - for the standard input) in shards")
+    split_parser.add_argument("inputs",nargs="+",help="files of PMIDs")
+    split_parser.add_argument("-o","--output",required=True,help="directory of the shards")
+    split_parser.add_argument("-n","--shards",type=int,required=True,help="number of shards")
+    run_parser=commands.add_parser("run",help="run detect_EMBL.py on every shard of a directory as local processes, the other arguments are given to detect_EMBL.py (e.g. -- --workers 4)")
+    run_parser.add_argument("directory",help="directory of the shards")
+    run_parser.add_argument("-p","--processes",type=int,default=1,help="number of shards run at the same time (default: %(default)s)")
+    run_parser.add_argument("-w","--workers",type=int,default=workers,help="number of workers of the node, divided between the shards run at the same time (default: %(default)s)")
+    run_parser.add_argument("--requests-per-second",type=float,default=requests_per_second,help="maximum number of requests per second of the node, divided between the shards run at the same time (default: %(default)s)")
+    merge_parser=commands.add_parser("merge",help="merge the results of the shards of a directory")
+    merge_parser.add_argument("directory",help="directory of the shards")
+    merge_parser.add_argument("-o","--output",required=True,help="directory of the merged search")
+    args,arguments=parser.parse_known_args()
+    if arguments and args.command!="run":
+        parser.error("unrecognized arguments: "+" ".join(arguments))
+    if any(argument.split("=")[0] in ("-w","--workers","--requests-per-second") for argument in arguments):
+        parser.error("--workers and --requests-per-second are options of shards.py run, divided between the shards")
+    if args.command=="split":
+        from detect_EMBL import read_pmids
+        manifest=split(read_pmids(args.inputs),args.output,args.shards)
+        print(str(manifest["PMIDs"])+" PMIDs in "+str(manifest["shards"])+" shards: "+", ".join(str(count) for count in manifest["counts"]))
+    elif args.command=="run":
+        status=run(args.directory,args.processes,[argument for argument in arguments if argument!="--"],workers=args.workers,requests_per_second=args.requests_per_second)
+        if any(status):
+            raise SystemExit(1)
+    elif args.command=="merge":
+        report=merge(args.directory,args.output)
+        print_report(report)
+        if report["duplicates"] or report["misplaced"]:
+            raise SystemExit(1)
+    else:
+        parser.print_help()
@@ -0,0 +1,240 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+# Local stub of the EuropePMC REST API replaying recorded results
+########################
+import argparse
+import collections
+import glob
+import json
+import os
+import random
+import re
+import socketserver
+import threading
+import time
+from http.server import BaseHTTPRequestHandler,HTTPServer
+from urllib.parse import parse_qs,urlparse
+
+#############################                   DEFINITIONS                   #############################
+
+def load_records(path): #### Load recorded results from a JSON file or a directory of JSON files
+    """This function will load recorded EuropePMC results
+    Description :
+            Each JSON file can be a EuropePMC response (with a resultList), a list of results or one result.
+    Args :
+            path (str) :
+                    A JSON file or a directory of JSON files
+    Return :
+            records (dict) :
+                    A dictionary with the PMIDs as key and their result as value
+    """
+    files=sorted(glob.glob(os.path.join(path,"*.json"))) if os.path.isdir(path) else [path]
+    records={}
+    for file in files:
+        with open(file,"r",encoding="utf-8") as f:
+            content=json.load(f)
+        if isinstance(content,dict) and "resultList" in content:
+            content=content["resultList"]["result"]
+        elif isinstance(content,dict):
+            content=[content]
+        for record in content:
+            if "pmid" in record:
+                records[str(record["pmid"])]=record
+    return records
+
+class ThreadingHTTPServer(socketserver.ThreadingMixIn,HTTPServer):
+    daemon_threads=True
+
+class StubHandler(BaseHTTPRequestHandler): #### Answer search and searchPOST requests from the records of the server
+    def log_message(self,format,*args):
+        return
+
+    def do_GET(self):
+        self.answer(parse_qs(urlparse(self.path).query))
+
+    def do_POST(self):
+        length=int(self.headers.get("Content-Length",0))
+        self.answer(parse_qs(self.rfile.read(length).decode("utf-8")))
+
+    def answer(self,params):
+        stub=self.server.stub
+        path=urlparse(self.path).path
+        status,body=stub.respond(path,{key:values[0] for key,values in params.items()})
+        self.send_response(status)
+        self.send_header("Content-Type","application/json")
+        self.send_header("Content-Length",str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+class StubServer(object): #### Local server replaying recorded EuropePMC results
+    """This class serves recorded EuropePMC results on localhost with the same search and searchPOST endpoints as the REST API
+    Description :
+            Queries are read as a list of EXT_ID (or ext_id) PMIDs, the known PMIDs are returned in the order of the query, page by page, with a cursorMark
+            as the real API. To test the clients, a delay can be added to each response (fixed and per PMID of the query), a part of the responses can fail
+            with a 503 status and the queries of too many PMIDs can be refused with a 413 status. The server counts the requests and the bytes sent.
+    Args :
+            records (dict) :
+                    A dictionary with the PMIDs as key and their result as value (see load_records())
+            delay (float) :
+                    Seconds to wait before each response
+            error_rate (float) :
+                    Probability of a 503 response
+            max_page_size (int) :
+                    Maximum number of results per page
+            delay_per_pmid (float) :
+                    Seconds to wait before each response per PMID of the query
+            max_query (int) :
+                    Maximum number of PMIDs of a query, None for no limit
+    """
+    def __init__(self,records,delay=0.0,error_rate=0.0,max_page_size=1000,delay_per_pmid=0.0,max_query=None):
+        self.records=records
+        self.delay=delay
+        self.error_rate=error_rate
+        self.max_page_size=max_page_size
+        self.delay_per_pmid=delay_per_pmid
+        self.max_query=max_query
+        self.requests=0
+        self.errors=0
+        self.bytes=0
+        self._lock=threading.Lock()
+        self._random=random.Random(0)
+        self.server=None
+
+    def respond(self,path,params): #### Status and body of the response to a request
+        with self._lock:
+            self.requests+=1
+            failing=self._random.random()<self.error_rate
+            if failing:
+                self.errors+=1
+        query=params.get("query","")
+        if not query and "query=" in path: # Old style search/query=ext_id:...&resultType=core&format=json
+            query=path.split("query=",1)[1].split("&")[0]
+        requested=re.findall(r'(?i)ext_id:([0-9]+)',query)
+        if self.delay or self.delay_per_pmid:
+            time.sleep(self.delay+self.delay_per_pmid*len(requested))
+        if failing:
+            return 503,b'{"error":"Service unavailable"}'
+        if self.max_query is not None and len(requested)>self.max_query:
+            return 413,b'{"error":"Query too long"}'
+        pmids=[pmid for pmid in requested if pmid in self.records]
+        pmids=list(collections.OrderedDict.fromkeys(pmids))
+        page_size=min(int(params.get("pageSize",25)),self.max_page_size)
+        cursor=params.get("cursorMark","*")
+        start=0 if cursor=="*" else int(cursor)
+        page=pmids[start:start+page_size]
+        response={
+            "version":"stub",
+            "hitCount":len(pmids),
+            "nextCursorMark":str(start+page_size) if start+page_size<len(pmids) else cursor,
+            "request":{"queryString":query,"resultType":params.get("resultType","lite"),"cursorMark":cursor,"pageSize":page_size},
+            "resultList":{"result":[self.records[pmid] for pmid in page]}}
+        body=json.dumps(response).encode("utf-8")
+        with self._lock:
+            self.bytes+=len(body)
+        return 200,body
+
+    def start(self,port=0): #### Start the server in a thread and return its URL (on a free port if port is 0)
+        self.server=ThreadingHTTPServer(("127.0.0.1",port),StubHandler)
+        self.server.stub=self
+        threading.Thread(target=self.server.serve_forever,daemon=True).start()
+        return "http://127.0.0.1:"+str(self.server.server_address[1])+"/europepmc/webservices/rest/"
+
+    def stop(self):
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+            self.server=None
+
+#############################                   MAIN                   #############################
+
+def measure_batching(records,unknown=50,queries=1000,**options): #### Throughput and completeness of fixed and adaptive queries against a stub
+    """This function will fetch every recorded PMID, and unknown PMIDs, from a stub with fixed queries of queries PMIDs then with europepmc.AdaptiveBatcher
+    Args :
+            records (dict) :
+                    The results served by the stub (see load_records())
+            unknown (int) :
+                    Number of PMIDs requested that the stub does not know
+            queries (int) :
+                    Number of PMIDs of the fixed queries (and of the lists given to AdaptiveBatcher.fetch(), as the chunks of detect_EMBL.py)
+            options :
+                    Arguments of StubServer (delay, delay_per_pmid, max_query...)
+    Return :
+            measures (dict) :
+                    For "fixed" and "adaptive" : the seconds, the PMIDs per second, the numbers of PMIDs received, failed and not found, and the requests
+    """
+    import europepmc
+    pmids=list(records)+[str(999900000+i) for i in range(unknown)]
+    chunks=[pmids[i:i+queries] for i in range(0,len(pmids),queries)]
+    measures={}
+    for name in ("fixed","adaptive"):
+        stub=StubServer(records,**options)
+        client=europepmc.EuropePMC(stub.start(),concurrency=4,requests_per_second=None,retries=2,backoff=0.01)
+        batcher=europepmc.AdaptiveBatcher(target_seconds=1.0)
+        received=[]
+        failed=[]
+        start=time.time()
+        for chunk in chunks:
+            if name=="adaptive":
+                results,lost=batcher.fetch(client,chunk)
+            else:
+                try:
+                    results,lost=client.search_pmids(chunk),[]
+                except Exception:
+                    results,lost=[],chunk
+            received+=[str(result["pmid"]) for result in results]
+            failed+=lost
+        elapsed=time.time()-start
+        stub.stop()
+        measures[name]={
+            "seconds":elapsed,
+            "PMIDs_per_second":len(pmids)/elapsed,
+            "received":len(set(received)),
+            "failed":len(failed),
+            "not_found":len(set(pmids)-set(received)-set(failed)),
+            "requests":stub.requests,
+            "final_size":batcher.size if name=="adaptive" else queries}
+    return measures
+
+if __name__=='__main__': # Offline check of europepmc.EuropePMC (pagination, retries) and of the adaptive batcher against the stub, or --serve
+    import corpus
+    import europepmc
+    parser=argparse.ArgumentParser(description="Local stub of the EuropePMC REST API : offline check of the client, or --serve to use it as --europepmc-url of detect_EMBL.py")
+    parser.add_argument("--serve",action="store_true",help="serve the records until interrupted instead of checking the client")
+    parser.add_argument("--records",help="JSON file or directory of JSON files of recorded results (default: the results rebuilt from the searches)")
+    parser.add_argument("--port",type=int,default=0,help="port of the server with --serve (default: a free port)")
+    parser.add_argument("--delay",type=float,default=0.0,help="seconds to wait before each response with --serve (default: %(default)s)")
+    parser.add_argument("--error-rate",type=float,default=0.0,help="probability of a 503 response with --serve (default: %(default)s)")
+    parser.add_argument("--max-query",type=int,help="maximum number of PMIDs of a query with --serve, the longer ones get a 413 (default: no limit)")
+    args=parser.parse_args()
+    records=load_records(args.records) if args.records else {record["pmid"]:record for record in corpus.searches_records()}
+    if args.serve:
+        stub=StubServer(records,delay=args.delay,error_rate=args.error_rate,max_query=args.max_query)
+        print("serving "+str(len(records))+" records on "+stub.start(args.port),flush=True)
+        try:
+            threading.Event().wait()
+        except KeyboardInterrupt:
+            pass
+        stub.stop()
+        raise SystemExit(0)
+    stub=StubServer(records,error_rate=0.3,max_page_size=100)
+    url=stub.start()
+    client=europepmc.EuropePMC(url,concurrency=8,requests_per_second=200,retries=10,backoff=0.01,page_size=100)
+    pmids=list(records)
+    start=time.time()
+    chunks=[pmids[i:i+250] for i in range(0,len(pmids),250)]
+    results=[result for page in client.map(client.search_pmids,chunks) for result in page]
+    elapsed=time.time()-start
+    stub.stop()
+    received=[result["pmid"] for result in results]
+    print("PMIDs requested: "+str(len(pmids)))
+    print("PMIDs received: "+str(len(received))+" ("+str(len(set(received)))+" different)")
+    print("Requests: "+str(stub.requests)+" ("+str(stub.errors)+" failed and retried), "+str(stub.bytes)+" bytes in "+str(round(elapsed,2))+" s")
+    if received!=pmids:
+        raise SystemExit(1)
+    measures=measure_batching(records,delay=0.05,delay_per_pmid=0.001,max_query=400)
+    print("Queries of 1000 PMIDs against adaptive queries (stub: 50 ms + 1 ms per PMID, at most 400 PMIDs per query, 50 unknown PMIDs):")
+    for name,measure in measures.items():
+        print("    "+name+": "+str(round(measure["PMIDs_per_second"]))+" PMIDs/s, "+str(measure["received"])+" received, "+str(measure["failed"])+" failed, "
+            +str(measure["not_found"])+" not found, "+str(measure["requests"])+" requests, last size "+str(measure["final_size"]))
+    if measures["adaptive"]["failed"] or measures["adaptive"]["received"]!=len(records):
+        raise SystemExit(1)
@@ -0,0 +1,41 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+# Shared setup of the tests : the modules of the repository are at its root
+########################
+import json
+import os
+import sys
+
+import pytest
+
+#############################                   VARIABLES                   #############################
+
+root=os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+data_dir=os.path.join(os.path.dirname(os.path.abspath(__file__)),"data")
+if root not in sys.path:
+    sys.path.insert(0,root)
+
+#############################                   DEFINITIONS                   #############################
+
+def load_data(name): #### JSON fixture of tests/data
+    with open(os.path.join(data_dir,name),"r",encoding="utf-8") as f:
+        return json.load(f)
+
+#############################                   FIXTURES                   #############################
+
+@pytest.fixture
+def records(): #### Recorded EuropePMC results of tests/data/europepmc_records.json, by PMID
+    import stub_europepmc
+    return stub_europepmc.load_records(os.path.join(data_dir,"europepmc_records.json"))
+
+@pytest.fixture
+def stub_server(): #### Factory of started stub_europepmc.StubServer, stopped at the end of the test
+    import stub_europepmc
+    servers=[]
+    def start(records,**options):
+        server=stub_europepmc.StubServer(records,**options)
+        servers.append(server)
+        return server,server.start()
+    yield start
+    for server in servers:
+        server.stop()
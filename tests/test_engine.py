@@ -0,0 +1,72 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+# Tests of engine.py : same probabilities as the sklearn models of detect_EMBL.py
+########################
+import os
+
+import numpy
+import pytest
+
+import engine
+import models
+from conftest import load_data,root
+from detect_EMBL import model_files
+from engine import LinearEngine
+
+#############################                   VARIABLES                   #############################
+
+tolerance=1e-9 # Largest difference allowed with the probabilities of sklearn
+edge_cases=["","EMBL","EMBL;EMBL","   ","Université de Genève, Genève, Suisse","ÉCOLE NORMALE SUPÉRIEURE","Heidelberg 69117 Germany","zzzzqqqq xxyy"]
+
+#############################                   DEFINITIONS                   #############################
+
+def expected(fitted,requests): #### Probabilities of the sklearn models
+    vectorizer_EMBL,clf_EMBL,vectorizer_sites,clf_sites=fitted
+    return clf_EMBL.predict_proba(vectorizer_EMBL.transform(requests)),clf_sites.predict_proba(vectorizer_sites.transform(requests))
+
+#############################                   FIXTURES                   #############################
+
+@pytest.fixture(scope="module")
+def fitted(): #### The four models of detect_EMBL.py (EMBL vectorizer and classifier, EMBL-sites vectorizer and classifier)
+    return [models.load_model(os.path.join(root,path)) for path in model_files]
+
+@pytest.fixture(scope="module")
+def requests(): #### Prepared affiliations of the golden output of the normalizer and edge cases
+    return [prepared for affiliation,prepared in load_data("normalizer_golden.json")]+edge_cases
+
+#############################                   TESTS                   #############################
+
+def test_batch(fitted,requests): #### Every string at once
+    engine=LinearEngine(LinearEngine.export(*fitted))
+    y_pred,y_pred_site=engine.predict_proba(requests)
+    sklearn_EMBL,sklearn_sites=expected(fitted,requests)
+    assert numpy.abs(y_pred-sklearn_EMBL).max()<=tolerance
+    assert numpy.abs(y_pred_site-sklearn_sites).max()<=tolerance
+    assert engine.predict_proba(requests,sites=False)[1] is None
+
+def test_single(fitted,requests): #### One string per call (pure Python path)
+    engine=LinearEngine(LinearEngine.export(*fitted))
+    sklearn_EMBL,sklearn_sites=expected(fitted,requests)
+    for row,request in enumerate(requests):
+        y_pred,y_pred_site=engine.predict_proba([request])
+        assert numpy.abs(y_pred[0]-sklearn_EMBL[row]).max()<=tolerance
+        assert numpy.abs(y_pred_site[0]-sklearn_sites[row]).max()<=tolerance
+
+def test_saved(fitted,requests,tmp_path): #### A saved engine gives the same probabilities, an engine of another version is built again
+    path=str(tmp_path/"engine.npz")
+    built=[]
+    def build():
+        built.append(True)
+        return LinearEngine.export(*fitted,version="v1")
+    engine=LinearEngine.load(path,"v1",build)
+    assert os.path.exists(path)
+    loaded=LinearEngine.load(path,"v1",build)
+    assert len(built)==1
+    numpy.testing.assert_array_equal(loaded.predict_proba(requests)[0],engine.predict_proba(requests)[0])
+    LinearEngine.load(path,"v2",build)
+    assert len(built)==2
+
+def test_wrong_formula(fitted,monkeypatch): #### An engine computing the probabilities with another formula than the models is not exported
+    monkeypatch.setattr(engine,"is_ovr",lambda clf: not (clf.multi_class in ("ovr","warn") or (clf.multi_class=="auto" and (len(clf.classes_)<=2 or clf.solver=="liblinear"))))
+    with pytest.raises(ValueError):
+        LinearEngine.export(*fitted)
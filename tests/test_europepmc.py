@@ -0,0 +1,101 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+# Tests of europepmc.py against the local stub of stub_europepmc.py : pagination, retries, rate limit, timeouts and adaptive queries
+########################
+import time
+
+import pytest
+import requests
+
+from europepmc import AdaptiveBatcher,EuropePMC
+
+#############################                   TESTS                   #############################
+
+def test_search_follows_the_cursor(records,stub_server): #### Every result, in the order of the query, when there are more results than a page
+    stub,url=stub_server(records,max_page_size=7)
+    client=EuropePMC(url,requests_per_second=None,page_size=7)
+    pmids=list(records)
+    results=client.search_pmids(pmids)
+    assert [result["pmid"] for result in results]==pmids
+    assert stub.requests==-(-len(pmids)//7)
+
+def test_unknown_pmids_have_no_result(records,stub_server):
+    stub,url=stub_server(records)
+    client=EuropePMC(url,requests_per_second=None)
+    pmids=list(records)[:5]
+    results=client.search_pmids(pmids+["999900001","999900002"])
+    assert [result["pmid"] for result in results]==pmids
+
+def test_failing_requests_are_retried(records,stub_server):
+    stub,url=stub_server(records,error_rate=0.3,max_page_size=10)
+    client=EuropePMC(url,requests_per_second=None,retries=20,backoff=0.001,page_size=10)
+    pmids=list(records)
+    results=[result for page in client.map(client.search_pmids,[pmids[i:i+10] for i in range(0,len(pmids),10)]) for result in page]
+    assert [result["pmid"] for result in results]==pmids
+    assert stub.errors>0
+
+def test_retries_are_limited(records,stub_server):
+    stub,url=stub_server(records,error_rate=1.0)
+    client=EuropePMC(url,requests_per_second=None,retries=2,backoff=0.001)
+    with pytest.raises(requests.HTTPError):
+        client.search_pmids(list(records)[:3])
+    assert stub.requests==3
+
+def test_timeout(records,stub_server):
+    stub,url=stub_server(records,delay=0.5)
+    client=EuropePMC(url,requests_per_second=None,timeout=0.1,retries=1,backoff=0.001)
+    with pytest.raises(requests.Timeout):
+        client.search_pmids(list(records)[:3])
+
+def test_rate_limit(records,stub_server):
+    stub,url=stub_server(records)
+    client=EuropePMC(url,concurrency=4,requests_per_second=20)
+    pmids=list(records)
+    start=time.time()
+    list(client.map(client.search_pmids,[[pmid] for pmid in pmids[:6]]))
+    assert time.time()-start>=5/20.0*0.9
+    assert stub.requests==6
+
+def test_query_get(records,stub_server):
+    stub,url=stub_server(records)
+    client=EuropePMC(url,requests_per_second=None)
+    pmid=list(records)[0]
+    response=client.query("EXT_ID:"+pmid)
+    assert [result["pmid"] for result in response["resultList"]["result"]]==[pmid]
+
+def test_too_long_queries_are_split(records,stub_server): #### Queries refused for their size (413) are sent again in halves
+    stub,url=stub_server(records,max_query=8)
+    client=EuropePMC(url,requests_per_second=None)
+    batcher=AdaptiveBatcher(size=40,min_size=1)
+    pmids=list(records)[:40]
+    results,failed=batcher.fetch(client,pmids)
+    assert sorted(result["pmid"] for result in results)==sorted(pmids)
+    assert failed==[]
+    assert stub.requests==1+2+4+8 # 40, 20 and 10 PMIDs refused, 5 PMIDs accepted
+
+def test_large_queries_failing_are_split(records,stub_server): #### A 5xx status to a large query is split down to one PMID, then the PMIDs are failed
+    stub,url=stub_server(records,error_rate=1.0)
+    client=EuropePMC(url,requests_per_second=None,retries=0)
+    batcher=AdaptiveBatcher(size=4,min_size=1,large_query=0)
+    pmids=list(records)[:4]
+    results,failed=batcher.fetch(client,pmids)
+    assert results==[]
+    assert sorted(failed)==sorted(pmids)
+    assert stub.requests==7
+
+def test_small_queries_failing_are_raised(records,stub_server): #### A 5xx status to a small query is not split
+    stub,url=stub_server(records,error_rate=1.0)
+    client=EuropePMC(url,requests_per_second=None,retries=1,backoff=0.001)
+    batcher=AdaptiveBatcher(size=4,min_size=1)
+    with pytest.raises(requests.HTTPError):
+        batcher.fetch(client,list(records)[:4])
+    assert stub.requests==2
+    assert batcher.size==4
+
+def test_timeouts_are_raised(records,stub_server): #### A timeout is not split
+    stub,url=stub_server(records,delay=0.5)
+    client=EuropePMC(url,requests_per_second=None,timeout=0.1,retries=0)
+    batcher=AdaptiveBatcher(size=4,min_size=1)
+    with pytest.raises(requests.Timeout):
+        batcher.fetch(client,list(records)[:4])
+    assert stub.requests==1
@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+# Tests of journal.py : resuming a search and not mixing the chunks of two searches of the same directory
+########################
+import os
+
+from journal import Journal,chunk_id
+
+#############################                   TESTS                   #############################
+
+def entry(chunk): #### Journal line of a chunk
+    return {"chunk":chunk_id(chunk),"affiliated":list(chunk)}
+
+def test_resume(tmp_path): #### Chunks of the journal are done, a line cut by a crash and lines of other versions are ignored
+    journal=Journal(str(tmp_path/"journal.jsonl"),"v1")
+    journal.append(entry(["1","2"]))
+    Journal(journal.path,"v0").append(entry(["3"]))
+    with open(journal.path,"a") as f:
+        f.write('{"chunk": "cut')
+    assert journal.done()=={chunk_id(["1","2"])}
+    assert [e["affiliated"] for e in journal.entries()]==[["1","2"]]
+
+def test_other_input(tmp_path): #### Only the chunks of the current input are used, the journal is rotated once the outputs are written
+    journal=Journal(str(tmp_path/"journal.jsonl"),"v1")
+    journal.append(entry(["1","2"]))
+    journal.append(entry(["3","4"]))
+    current={chunk_id(["3","4"]),chunk_id(["5"])}
+    assert [e["affiliated"] for e in journal.entries(current)]==[["3","4"]]
+    journal.rotate()
+    assert not os.path.exists(journal.path)
+    assert os.path.exists(journal.path+".previous")
+    assert journal.done()==set()
+    assert list(journal.entries())==[]
@@ -0,0 +1,43 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+# Tests of normalizer.py : golden output of the compiled replacements and literals required by the patterns
+########################
+import re
+
+import pytest
+
+from conftest import load_data
+from detect_EMBL import replacements
+from normalizer import Normalizer,required_literal,sequential
+
+#############################                   TESTS                   #############################
+
+def test_golden_output(): #### Same output as the stored re.sub outputs, one by one and in batch
+    golden=load_data("normalizer_golden.json")
+    normalizer=Normalizer(replacements)
+    affiliations=[affiliation for affiliation,prepared in golden]
+    expected=[prepared for affiliation,prepared in golden]
+    assert [sequential(replacements,affiliation) for affiliation in affiliations]==expected
+    assert [normalizer(affiliation) for affiliation in affiliations]==expected
+    assert normalizer.batch(affiliations+affiliations)==expected+expected
+
+@pytest.mark.parametrize("pattern,literal",[
+    ("EMBL","EMBL"),
+    ("ab*cd","cd"),
+    ("foo+bar","foo"),
+    ("x{3}",None),
+    ("abc{3}def","def"),
+    ("ab{,2}cd","cd"),
+    ("ab{2,5}cdef","cdef"),
+    ("a{}bcd","bcd"),
+    (r"\.EMBL\s*$",".EMBL"),
+    ("[;,]\\s*EMBL","EMBL"),
+    ("a|b",None)])
+def test_required_literal(pattern,literal):
+    assert required_literal(pattern)==literal
+
+@pytest.mark.parametrize("pattern",["x{3}","ab{2}c","b{0}ac","ab{1,}c","[ab]{2}c{2,3}"])
+def test_counted_repeat(pattern): #### The literal of a counted repeat is in every match
+    normalizer=Normalizer([(pattern,"_")])
+    for request in ("xxx","abbc","ac","abc","aacc","abccc","zz"):
+        assert normalizer(request)==re.sub(pattern,"_",request)
@@ -0,0 +1,22 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+# Tests of resolver.py : resolution by ROR ID and by canonical name of the EMBL sites of detect_EMBL.py
+########################
+from detect_EMBL import EMBL_RORs,EMBL_names,EMBL_places
+from resolver import Resolver
+
+#############################                   TESTS                   #############################
+
+def test_resolve(): #### ROR ID first, then the whole affiliation, a name of several sites alone is left to the models
+    resolver=Resolver(EMBL_RORs,EMBL_names,EMBL_places)
+    assert resolver.resolve("Some lab",["https://ror.org/02catss52"])==("EMBL-EBI","ROR")
+    assert resolver.resolve("European Molecular Biology Laboratory (EMBL), Heidelberg, Germany")==("EMBL Heidelberg","Name")
+    assert resolver.resolve("European Molecular Biology Laboratory")==(None,None)
+    assert resolver.resolve("University of Cambridge, UK")==(None,None)
+
+def test_result(): #### A resolved affiliation is certain, its method tells the path
+    resolver=Resolver(EMBL_RORs,EMBL_names,EMBL_places)
+    result=resolver.result("EMBL Rome","EMBL Rome","Name")
+    assert result["choose"] and result["site"]=="EMBL Rome"
+    assert result["method"]=="Resolved by Name"
+    assert result["score_EMBL"]==1.0 and result["score_site"]==1.0
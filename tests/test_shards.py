@@ -0,0 +1,59 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+# Tests of shards.py : split of the PMIDs, run of the shards against the stub of stub_europepmc.py and merge of their results
+########################
+import ast
+import os
+
+import pytest
+
+import results
+import shards
+from conftest import root
+
+#############################                   DEFINITIONS                   #############################
+
+def search(directory,pmids,count,url,model,processes=1): #### Split, run and merge a search of pmids in count shards, return the merge report and the EMBL PMIDs
+    shards.split(iter(pmids),directory,count)
+    arguments=["--europepmc-url",url,"--spacy-model",model,"--no-cache","--no-store"]
+    assert shards.run(directory,processes,arguments,workers=2,requests_per_second=100)==[0]*count
+    output=os.path.join(directory,"merged")
+    report=shards.merge(directory,output)
+    with open(os.path.join(output,"EMBL_PMIDs.txt"),"r",encoding="utf-8") as f:
+        return report,set(ast.literal_eval(f.read()))
+
+#############################                   FIXTURES                   #############################
+
+@pytest.fixture(scope="module")
+def model(tmp_path_factory): #### Blank English spaCy model, the runs do not need a trained NER to be compared
+    spacy=pytest.importorskip("spacy")
+    path=str(tmp_path_factory.mktemp("spacy")/"blank_en")
+    spacy.blank("en").to_disk(path)
+    return path
+
+#############################                   TESTS                   #############################
+
+def test_split(tmp_path,records): #### Every PMID in its shard, the same whatever the order of the input
+    pmids=list(records)
+    manifest=shards.split(iter(pmids),str(tmp_path/"a"),3)
+    assert manifest["PMIDs"]==len(pmids) and sum(manifest["counts"])==len(pmids)
+    shards.split(iter(reversed(pmids)),str(tmp_path/"b"),3)
+    for shard in range(3):
+        with open(os.path.join(shards.shard_dir(str(tmp_path/"a"),shard),shards.shard_pmids)) as f:
+            first=f.read().split()
+        with open(os.path.join(shards.shard_dir(str(tmp_path/"b"),shard),shards.shard_pmids)) as f:
+            second=f.read().split()
+        assert all(shards.shard_of(pmid,3)==shard for pmid in first)
+        assert sorted(first)==sorted(second)
+
+def test_run_and_merge(tmp_path,records,stub_server,model,monkeypatch): #### Three shards run at the same time give the results of one run, with their part of the workers and of the rate
+    monkeypatch.chdir(root) # The models of detect_EMBL.py are relative to the repository
+    stub,url=stub_server(records)
+    pmids=list(records)
+    single,expected=search(str(tmp_path/"single"),pmids,1,url,model)
+    report,found=search(str(tmp_path/"sharded"),pmids,3,url,model,processes=3)
+    assert found==expected and len(found)>0
+    assert report["PMIDs"]==single["PMIDs"]==len(pmids)
+    assert report["duplicates"]==0 and report["misplaced"]==0
+    metadata=results.read(os.path.join(str(tmp_path/"sharded"),"merged",results.results_file))["metadata"]
+    assert [shard["workers"] for shard in metadata["shards"]]==[1,1,1] # 2 workers for 3 shards, at least one each
@@ -0,0 +1,42 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+# Tests of verdict_cache.py : versions, reads without writes and eviction of the least recently used verdicts
+########################
+import verdict_cache as vc
+
+#############################                   TESTS                   #############################
+
+def test_version(tmp_path): #### The verdicts of a kind are deleted when it is opened with another version
+    path=str(tmp_path/"cache.sqlite")
+    cache=vc.VerdictCache(path,{"is_EMBL":"v1","geoloc":"g1"})
+    cache.put_many("is_EMBL",[("a","1")])
+    cache.put_many("geoloc",[("a","x")])
+    cache.close()
+    cache=vc.VerdictCache(path,{"is_EMBL":"v2","geoloc":"g1"})
+    assert cache.get_many("is_EMBL",["a"])=={}
+    assert cache.get_many("geoloc",["a"])=={"a":"x"}
+
+def test_hits_do_not_write(tmp_path): #### A verdict used recently is read without a write, an older one gets its time updated
+    cache=vc.VerdictCache(str(tmp_path/"cache.sqlite"),{"is_EMBL":"v1"},touch_every=3600)
+    cache.put_many("is_EMBL",[("a","1"),("b","2")])
+    connection=cache.connection()
+    changes=connection.total_changes
+    assert cache.get_many("is_EMBL",["a","b","c"])=={"a":"1","b":"2"}
+    assert connection.total_changes==changes
+    with connection:
+        connection.execute("UPDATE verdicts SET used=0 WHERE key='a'")
+    changes=connection.total_changes
+    cache.get_many("is_EMBL",["a","b"])
+    assert connection.total_changes==changes+1
+    assert connection.execute("SELECT used FROM verdicts WHERE key='a'").fetchone()[0]>0
+    assert (cache.hits,cache.misses)==(4,1)
+
+def test_eviction(tmp_path): #### The least recently used verdicts are deleted first
+    cache=vc.VerdictCache(str(tmp_path/"cache.sqlite"),{"is_EMBL":"v1"},max_entries=10,touch_every=0)
+    cache.put_many("is_EMBL",[(str(i),str(i)) for i in range(10)])
+    with cache.connection() as connection:
+        connection.execute("UPDATE verdicts SET used=CAST(key AS REAL)")
+    cache.get_many("is_EMBL",["0"]) # Used now, so kept
+    cache.put_many("is_EMBL",[("10","10")])
+    cache.evict()
+    assert set(cache.get_many("is_EMBL",[str(i) for i in range(11)]))=={str(i) for i in range(11)}-{"1","2"} # 90 % of max_entries kept
@@ -0,0 +1,176 @@
+#!/usr/bin/env python
+#-*- coding: utf-8 -*-
+# Persistent cache of the verdicts of detect_EMBL.py
+########################
+import hashlib # Used to version the cache with the content of the models (https://docs.python.org/3/library/hashlib.html)
+import os
+import sqlite3 # Used to store the verdicts in a file shared by every process (https://docs.python.org/3/library/sqlite3.html)
+import time
+
+#############################                   DEFINITIONS                   #############################
+
+def hash_files(files): #### Hash the content of a list of files
+    """This function will compute a hash of the content of different files
+    Description :
+            Here the function reads every file in the order of the list and returns the sha1 of their contents, so any change in one of the files gives a new hash.
+    Args :
+            files (list-str) :
+                    A list of file paths
+    Return :
+            digest (str) :
+                    The hexadecimal sha1 of the files
+    """
+    sha=hashlib.sha1()
+    for path in files:
+        with open(path,"rb") as f:
+            for block in iter(lambda: f.read(1<<20),b""):
+                sha.update(block)
+    return sha.hexdigest()
+
+class VerdictCache(object): #### Key-value store of verdicts in a SQLite file
+    """This class stores verdicts (is_EMBL, get_geoloc_from...) in a SQLite file
+    Description :
+            Each verdict is stored under a kind (the function name) and a key (the prepared string and the arguments of the function). Each kind has a version
+            (e.g. the hash of the models files), when the cache is opened with a different version, all the verdicts of this kind are deleted.
+            The file uses the WAL journal so many processes (the Pool workers) can read and write it at the same time. Each process opens its own connection
+            on first use. When the cache holds more than max_entries verdicts the least recently used ones are deleted. The time a verdict was last used is only
+            written again when it is older than touch_every seconds, so reading verdicts already met (e.g. a rerun of a search) takes no write lock.
+            Hits and misses are counted in each process and added to the stats table of the file by flush_stats().
+    Args :
+            path (str) :
+                    The SQLite file
+            versions (dict) :
+                    A dictionary with a kind as key and its version as value
+            max_entries (int) :
+                    The maximum number of verdicts to keep in the file
+            touch_every (float) :
+                    The number of seconds after which the time a verdict was last used is updated when it is read
+    """
+    check_every=1000 # Number of writes between two checks of the size of the cache
+
+    def __init__(self,path,versions,max_entries=1000000,touch_every=86400):
+        self.path=path
+        self.versions=versions
+        self.max_entries=max_entries
+        self.touch_every=touch_every
+        self.hits=0
+        self.misses=0
+        self._writes=0
+        self._connection=None
+        self._pid=None
+        with self.connection() as connection:
+            connection.execute("CREATE TABLE IF NOT EXISTS verdicts (kind TEXT, key TEXT, version TEXT, value TEXT, used REAL, PRIMARY KEY (kind,key))")
+            connection.execute("CREATE INDEX IF NOT EXISTS verdicts_used ON verdicts (used)")
+            connection.execute("CREATE TABLE IF NOT EXISTS stats (name TEXT PRIMARY KEY, value INTEGER)")
+            for kind in versions: # Invalidation of the verdicts made with another version
+                connection.execute("DELETE FROM verdicts WHERE kind=? AND version!=?",(kind,versions[kind]))
+
+    def connection(self): #### Connection of the current process
+        if self._connection is None or self._pid!=os.getpid():
+            self._connection=sqlite3.connect(self.path,timeout=60,check_same_thread=False)
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._pid=os.getpid()
+        return self._connection
+
+    def __getstate__(self): # Sent to the spawned workers without the connection
+        state=dict(self.__dict__)
+        state["_connection"]=None
+        state["_pid"]=None
+        return state
+
+    def close(self): #### Close the connection of the current process (e.g. before creating a Pool)
+        if self._connection is not None and self._pid==os.getpid():
+            self._connection.close()
+        self._connection=None
+
+    def get_many(self,kind,keys): #### Get verdicts of a list of keys
+        """This function will return the stored verdicts of a list of keys
+        Args :
+                kind (str) :
+                        The kind of verdicts
+                keys (list-str) :
+                        A list of keys
+        Return :
+                found (dict) :
+                        A dictionary with the keys found as key and their stored value (str) as value
+        """
+        found={}
+        stale=[] # Keys last used more than touch_every seconds ago
+        now=time.time()
+        keys=list(set(keys))
+        connection=self.connection()
+        for start in range(0,len(keys),500): # SQLite limits the number of variables of a query
+            sub_keys=keys[start:start+500]
+            rows=connection.execute(
+                "SELECT key,value,used FROM verdicts WHERE kind=? AND version=? AND key IN ("+",".join("?"*len(sub_keys))+")",
+                [kind,self.versions[kind]]+sub_keys)
+            for key,value,used in rows.fetchall():
+                found[key]=value
+                if used is None or used<now-self.touch_every:
+                    stale.append(key)
+        if stale:
+            with connection:
+                connection.executemany("UPDATE verdicts SET used=? WHERE kind=? AND key=?",[(now,kind,key) for key in stale])
+        self.hits+=len(found)
+        self.misses+=len(keys)-len(found)
+        return found
+
+    def get(self,kind,key): #### Get the verdict of a key (None if not found)
+        return self.get_many(kind,[key]).get(key)
+
+    def put_many(self,kind,items): #### Store verdicts
+        """This function will store a list of verdicts
+        Args :
+                kind (str) :
+                        The kind of verdicts
+                items (list-tuple) :
+                        A list of (key, value) with value a string
+        Return :
+                No return
+        """
+        now=time.time()
+        connection=self.connection()
+        with connection:
+            connection.executemany(
+                "INSERT OR REPLACE INTO verdicts (kind,key,version,value,used) VALUES (?,?,?,?,?)",
+                [(kind,key,self.versions[kind],value,now) for key,value in items])
+        self._writes+=len(items)
+        if self._writes>=self.check_every:
+            self._writes=0
+            self.evict()
+
+    def put(self,kind,key,value): #### Store a verdict
+        self.put_many(kind,[(key,value)])
+
+    def evict(self): #### Delete the least recently used verdicts when the cache is full
+        connection=self.connection()
+        size=connection.execute("SELECT COUNT(*) FROM verdicts").fetchone()[0]
+        if size>self.max_entries:
+            with connection:
+                connection.execute(
+                    "DELETE FROM verdicts WHERE rowid IN (SELECT rowid FROM verdicts ORDER BY used LIMIT ?)",
+                    (size-int(self.max_entries*0.9),))
+
+    def flush_stats(self): #### Add hits and misses of this process to the file
+        connection=self.connection()
+        with connection:
+            for name,value in (("hits",self.hits),("misses",self.misses)):
+                connection.execute("INSERT OR IGNORE INTO stats (name,value) VALUES (?,0)",(name,))
+                connection.execute("UPDATE stats SET value=value+? WHERE name=?",(value,name))
+        self.hits=0
+        self.misses=0
+
+    def reset_stats(self): #### Set hits and misses of the file to 0
+        with self.connection() as connection:
+            connection.execute("DELETE FROM stats")
+        self.hits=0
+        self.misses=0
+
+    def stats(self): #### Hits and misses of every process since the last reset and number of verdicts stored
+        connection=self.connection()
+        stats=dict(connection.execute("SELECT name,value FROM stats").fetchall())
+        return {
+            "hits":stats.get("hits",0)+self.hits,
+            "misses":stats.get("misses",0)+self.misses,
+            "entries":connection.execute("SELECT COUNT(*) FROM verdicts").fetchone()[0]}